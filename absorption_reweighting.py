@@ -0,0 +1,249 @@
+"""
+Absorption reweighting ("white Monte Carlo") for planar layer stacks.
+
+Within one wavelength of our tables, only `mu_a` changes between runs. The photon paths only depend on the scattering
+properties, so a single absorption-free run can be recorded with the path length travelled in each layer at every
+interaction. Any set of per-layer absorption coefficients is then applied afterwards with Beer-Lambert weights
+W = exp(-sum(mu_a * L)), rebuilding an `EnergyLogger` (or only the reflectance and absorbance) without any new
+propagation.
+
+Usage:
+    record = record_path_lengths(source, scene)
+    logger = record.reweight({"epidermis": 3.9, "dermis": 0.71, "subcutis": 0.49}, scene)
+    print(record.reflectance([[3.9, 0.71, 0.49], [6.85, 2.45, 1.45]]))
+"""
+from typing import Dict, List, Optional, Sequence, Union
+
+import numpy as np
+from pytissueoptics import EnergyLogger, InteractionKey
+
+from slab_propagation import LayerStack, SlabPropagator
+
+AbsorptionSet = Union[Sequence[float], Dict[str, Union[float, dict, object]]]
+
+
+class _WhiteMaterial:
+    """Absorption-free copy of a layer material (ScatteringMaterial does not allow mu_a=0 with scattering)."""
+    def __init__(self, material):
+        self.mu_s = material.mu_s
+        self.mu_a = 0
+        self.g = material.g
+        self.n = material.n
+
+
+class PathLengthRecord:
+    """
+    Compact record of an absorption-free run. Each row is an interaction of one photon (sorted by photon, then in
+    chronological order) with its position, interaction key, sign (+1 when leaving a surface, -1 when entering it, 0
+    for scattering) and the cumulative path length travelled in each layer so far, all in float32.
+    """
+
+    def __init__(self, stack: LayerStack, keys: List[InteractionKey], position: np.ndarray, photon_id: np.ndarray,
+                 key: np.ndarray, sign: np.ndarray, path_length: np.ndarray, photon_count: int,
+                 source_solid_label: Optional[str] = None, spatial: bool = True):
+        self.stack = stack
+        self.keys = keys
+        self.position = position
+        self.photon_id = photon_id
+        self.key = key
+        self.sign = sign
+        self.path_length = path_length
+        self.photon_count = photon_count
+        self.source_solid_label = source_solid_label
+        self.spatial = spatial
+
+    @property
+    def n_layers(self) -> int:
+        return len(self.stack.layers)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a.nbytes for a in (self.position, self.photon_id, self.key, self.sign, self.path_length))
+
+    def weights(self, mu_a: AbsorptionSet) -> np.ndarray:
+        """Photon weight at each recorded interaction. Shape (n,) or (n, m) for a list of m absorption sets."""
+        mu_a = self._absorption_array(mu_a)
+        return np.exp(-(self.path_length @ mu_a.T).astype(np.float64))
+
+    def reflectance(self, mu_a: AbsorptionSet) -> Union[float, np.ndarray]:
+        """Fraction of the launched energy leaving the stack through its entry surface (front of the first layer)."""
+        return self._surface_energy(mu_a, self.stack.layers[0].label, self.stack.layers[0].front_label, leaving=True)
+
+    def transmittance(self, mu_a: AbsorptionSet) -> Union[float, np.ndarray]:
+        """Fraction of the launched energy leaving the stack through its deepest surface."""
+        return self._surface_energy(mu_a, self.stack.layers[-1].label, self.stack.layers[-1].back_label, leaving=True)
+
+    def absorbance(self, mu_a: AbsorptionSet) -> np.ndarray:
+        """
+        Fraction of the launched energy absorbed in each layer, from the energy balance across the layer surfaces.
+        Shape (n_layers,) or (m, n_layers) for a list of m absorption sets.
+        """
+        weights = self.weights(mu_a)
+        surface = self.key >= self.n_layers
+        layer = (self.key[surface] - self.n_layers) // 6
+        signed = -self.sign[surface, None] * np.atleast_2d(weights.T).T[surface]
+        absorbed = np.stack([np.bincount(layer, weights=column, minlength=self.n_layers) for column in signed.T])
+        if self.source_solid_label is not None:
+            absorbed[:, self.stack.labels.index(self.source_solid_label)] += self.photon_count
+        absorbed /= self.photon_count
+        return absorbed[0] if weights.ndim == 1 else absorbed
+
+    def reweight(self, mu_a: AbsorptionSet, scene, **logger_kwargs) -> EnergyLogger:
+        """
+        Rebuilds an `EnergyLogger` for the given absorption coefficients, as if it was logged by a full simulation.
+        Volumetric deposition is only available for records made with `spatial=True`.
+
+        Args:
+            mu_a (AbsorptionSet): Absorption coefficient of each layer, as a list in layer order or a dict keyed by
+                layer label (case-insensitive) whose values are numbers, material keyword arguments or materials.
+            scene (ScatteringScene): Scene given to the new logger.
+            **logger_kwargs: Forwarded to the `EnergyLogger`.
+        """
+        weights = self.weights(mu_a)
+        if weights.ndim != 1:
+            raise ValueError("Can only rebuild a logger for a single set of absorption coefficients.")
+        logger = EnergyLogger(scene, **logger_kwargs)
+        logger.info["photonCount"] = self.photon_count
+        logger.info["sourceSolidLabel"] = self.source_solid_label
+
+        surface = self.key >= self.n_layers
+        data = np.column_stack((np.zeros(len(weights)), self.position, self.photon_id))
+        data[surface, 0] = self.sign[surface] * weights[surface]
+
+        # Energy absorbed along the segment ending at each interaction, logged in the layer of that segment.
+        previous = np.ones_like(weights)
+        previous[1:] = weights[:-1]
+        previous[np.r_[True, self.photon_id[1:] != self.photon_id[:-1]]] = 1
+        deposit = previous - weights
+        segment_layer = np.where(surface, (self.key - self.n_layers) // 6, self.key)
+        for index, layer in enumerate(self.stack.layers):
+            mask = (segment_layer == index) & (deposit > 0)
+            if self.spatial and np.any(mask):
+                logger.logDataPointArray(np.column_stack((deposit[mask], data[mask, 1:])), InteractionKey(layer.label))
+        for index in np.unique(self.key[surface]):
+            mask = self.key == index
+            logger.logDataPointArray(data[mask], self.keys[index])
+        return logger
+
+    def save(self, filepath: str):
+        """Saves the recorded arrays to a .npz file. The stack itself is not saved."""
+        np.savez(filepath, position=self.position, photon_id=self.photon_id, key=self.key, sign=self.sign,
+                 path_length=self.path_length, photon_count=self.photon_count, spatial=self.spatial,
+                 source_solid_label=self.source_solid_label or "")
+
+    @classmethod
+    def load(cls, filepath: str, stack: LayerStack) -> "PathLengthRecord":
+        """Loads a record saved with `save()` for the same layer stack."""
+        with np.load(filepath) as data:
+            return cls(stack, stack.interaction_keys(), data["position"], data["photon_id"], data["key"], data["sign"],
+                       data["path_length"], int(data["photon_count"]), str(data["source_solid_label"]) or None,
+                       bool(data["spatial"]))
+
+    def _surface_energy(self, mu_a, solid_label: str, surface_label: str, leaving: bool):
+        index = self.keys.index(InteractionKey(solid_label, surface_label))
+        mask = (self.key == index) & (self.sign == (1 if leaving else -1))
+        mu_a = self._absorption_array(mu_a)
+        energy = np.exp(-(self.path_length[mask] @ mu_a.T).astype(np.float64)).sum(axis=0)
+        return energy / self.photon_count
+
+    def _absorption_array(self, mu_a: AbsorptionSet) -> np.ndarray:
+        if isinstance(mu_a, dict):
+            return np.array(self._absorption_from_dict(mu_a), dtype=np.float32)
+        mu_a = np.asarray(mu_a, dtype=np.float32)
+        if mu_a.shape[-1] != self.n_layers:
+            raise ValueError(f"Expected {self.n_layers} absorption coefficients, got {mu_a.shape[-1]}.")
+        return mu_a
+
+    def _absorption_from_dict(self, mu_a: dict) -> List[float]:
+        values = {label.lower(): value for label, value in mu_a.items()}
+        coefficients = []
+        for layer in self.stack.layers:
+            value = values.get(layer.label.lower(), layer.material)
+            if isinstance(value, dict):
+                value = _DictMaterial(value)
+            if hasattr(value, "mu_a"):
+                if getattr(value, "mu_s", layer.material.mu_s) != layer.material.mu_s or \
+                        getattr(value, "g", layer.material.g) != layer.material.g:
+                    raise ValueError(f"Layer '{layer.label}' was recorded with different scattering properties. "
+                                     f"Absorption reweighting requires the same mu_s and g.")
+                value = value.mu_a
+            coefficients.append(float(value))
+        return coefficients
+
+
+class _DictMaterial:
+    def __init__(self, properties: dict):
+        self.__dict__.update(properties)
+
+
+class PathLengthRecorder(SlabPropagator):
+    """
+    Propagates photons without absorption and records their per-layer path lengths instead of logging energy.
+
+    Args:
+        stack (LayerStack): The planar layers. Their mu_s, g and n are used, their mu_a is ignored.
+        batch_size (int): Maximum number of photons propagated together.
+        spatial (bool): Record every scattering event to allow volumetric deposition maps. If False, only surface
+            crossings are kept, which is enough for reflectance, transmittance and per-layer absorbance.
+        max_path_length (float): Photons are terminated after this total path length (cm). Without absorption, they
+            otherwise only stop when leaving the tissue. Reweighted results are biased for absorption coefficients
+            where exp(-mu_a * max_path_length) is not negligible.
+    """
+
+    def __init__(self, stack: LayerStack, batch_size: int = 100000, spatial: bool = True,
+                 max_path_length: float = None):
+        white_materials = [_WhiteMaterial(layer.material) for layer in stack.layers]
+        super().__init__(stack, batch_size=batch_size, channel_materials=[white_materials])
+        self._track_path_lengths = True
+        self._max_path_length = max_path_length
+        self._spatial = spatial
+        self._chunks: List[tuple] = []
+
+    @property
+    def n_layers(self) -> int:
+        return len(self._stack.layers)
+
+    def record(self, source, show_progress: bool = True, rng: np.random.Generator = None) -> PathLengthRecord:
+        """Propagates the photons of the source and returns the recorded interactions."""
+        self._chunks = [(np.empty((0, 3), np.float32), np.empty(0, np.int32), np.empty(0, np.int16),
+                         np.empty(0, np.int8), np.empty((0, self.n_layers), np.float32))]
+        self._propagate_source(source, [None], show_progress, rng)
+        position, photon_id, key, sign, path_length = (np.concatenate(chunk) for chunk in zip(*self._chunks))
+        return PathLengthRecord(self._stack, self._keys, position, photon_id, key, sign, path_length,
+                                source.getPhotonCount(), self._source_solid_label, self._spatial)
+
+    def _flush(self, loggers):
+        if not self._records:
+            return
+        records = np.vstack(self._records)
+        self._records = []
+        key = records[:, 5].astype(np.int16)
+        if not self._spatial:
+            records, key = records[key >= self.n_layers], key[key >= self.n_layers]
+        # Stable sort by photon keeps the chronological order of each photon's interactions.
+        order = np.argsort(records[:, 4], kind="stable")
+        records, key = records[order], key[order]
+        sign = np.sign(records[:, 0]).astype(np.int8)
+        sign[key < self.n_layers] = 0
+        self._chunks.append((records[:, 1:4].astype(np.float32), records[:, 4].astype(np.int32), key, sign,
+                             records[:, 7:].astype(np.float32)))
+
+
+def record_path_lengths(source, scene=None, stack: LayerStack = None, spatial: bool = True,
+                        max_path_length: float = None, show_progress: bool = True) -> PathLengthRecord:
+    """
+    Runs one absorption-free propagation of the source and returns its `PathLengthRecord`.
+
+    Args:
+        source (Source): The photon source.
+        scene (ScatteringScene): Used to detect the layer stack when `stack` is not given.
+        stack (LayerStack): Explicit layer stack.
+        spatial (bool): Record scattering events for volumetric deposition (see `PathLengthRecorder`).
+        max_path_length (float): Optional path length cutoff (cm).
+        show_progress (bool): Print the photon count and the propagation time.
+    """
+    if stack is None:
+        stack = LayerStack.from_scene(scene)
+    recorder = PathLengthRecorder(stack, spatial=spatial, max_path_length=max_path_length)
+    return recorder.record(source, show_progress=show_progress)
+
@@ -0,0 +1,224 @@
+"""
+Convergence-driven photon budgets.
+
+Instead of a hardcoded N, `propagate_adaptive` propagates batches of photons through a `LayerStack` until every
+requested metric reaches a target relative standard error (RSE). Each metric is tallied per photon from the logged
+interactions (using the photon IDs), so its standard error is estimated from the photon-to-photon variance:
+SE = std(x) / sqrt(n). The logger receives the interactions of all the propagated photons, as with `propagate_layered`.
+
+Usage:
+    result = propagate_adaptive(source, scene, logger, metrics=[diffuse_reflectance(stack), AbsorbedEnergy("Blood")],
+                                target_rse=0.01)
+    print(result)
+"""
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import numpy as np
+from pytissueoptics import InteractionKey
+from pytissueoptics.rayscattering import utils
+
+from slab_propagation import LayerStack, SlabPropagator, VarianceReduction
+
+
+class Metric:
+    """Quantity estimated per launched photon from the logged interactions."""
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def select(self, array: np.ndarray, key: InteractionKey) -> Optional[np.ndarray]:
+        """Contribution of each logged data point (value, x, y, z, photonID) to the metric, or None if unrelated."""
+        raise NotImplementedError
+
+
+class SurfaceEnergy(Metric):
+    """Energy leaving (or entering) a solid through one of its surfaces."""
+
+    def __init__(self, solid_label: str, surface_label: str, leaving: bool = True, name: str = None):
+        super().__init__(name or f"{'Leaving' if leaving else 'Entering'} {solid_label} through {surface_label}")
+        self.solid_label = solid_label
+        self.surface_label = surface_label
+        self.leaving = leaving
+
+    def select(self, array, key):
+        if not utils.labelsEqual(key.solidLabel, self.solid_label) or \
+                not utils.labelsEqual(key.surfaceLabel, self.surface_label):
+            return None
+        return np.maximum(array[:, 0] if self.leaving else -array[:, 0], 0)
+
+
+class AbsorbedEnergy(Metric):
+    """Energy deposited in a solid, or in all of them when no solid is given."""
+
+    def __init__(self, solid_label: str = None, name: str = None):
+        super().__init__(name or (f"Absorbed in {solid_label}" if solid_label else "Absorbed"))
+        self.solid_label = solid_label
+
+    def select(self, array, key):
+        if not key.volumetric or (self.solid_label and not utils.labelsEqual(key.solidLabel, self.solid_label)):
+            return None
+        return array[:, 0]
+
+
+class SliceEnergy(Metric):
+    """Energy deposited in a slice of given thickness along an axis, optionally only in one solid."""
+
+    def __init__(self, position: float, thickness: float, axis: int = 2, solid_label: str = None, name: str = None):
+        super().__init__(name or f"Absorbed in slice {'xyz'[axis]}={position}")
+        self.position = position
+        self.thickness = thickness
+        self.axis = axis
+        self.solid_label = solid_label
+
+    def select(self, array, key):
+        if not key.volumetric or (self.solid_label and not utils.labelsEqual(key.solidLabel, self.solid_label)):
+            return None
+        inside = np.abs(array[:, 1 + self.axis] - self.position) <= self.thickness / 2
+        return np.where(inside, array[:, 0], 0)
+
+
+def diffuse_reflectance(stack: LayerStack) -> SurfaceEnergy:
+    """Energy leaving the stack through its entry surface."""
+    entry = stack.layers[0]
+    return SurfaceEnergy(entry.label, entry.front_label, leaving=True, name="Diffuse reflectance")
+
+
+@dataclass
+class MetricEstimate:
+    mean: float
+    standard_error: float
+
+    @property
+    def relative_error(self) -> float:
+        return self.standard_error / abs(self.mean) if self.mean != 0 else np.inf
+
+
+@dataclass
+class AdaptiveResult:
+    photon_count: int
+    converged: bool
+    estimates: Dict[str, MetricEstimate]
+    duration: float
+
+    def __str__(self):
+        status = "Converged" if self.converged else "Did not converge"
+        lines = [f"{status} after {self.photon_count} photons ({self.duration:.2f}s):"]
+        for name, estimate in self.estimates.items():
+            lines.append(f"    {name}: {estimate.mean:.5g} ± {estimate.standard_error:.2g} per photon "
+                         f"(RSE {estimate.relative_error:.2%})")
+        return "\n".join(lines)
+
+
+class MetricTally:
+    """Logger-like sink accumulating per-photon sums of the metrics and forwarding the data to the actual logger."""
+
+    def __init__(self, metrics: List[Metric], logger=None):
+        self._metrics = metrics
+        self._logger = logger
+        self._batch = None
+        self._first_id = 0
+        self._sums = np.zeros((2, len(metrics)))
+        self.photon_count = 0
+
+    @property
+    def batch(self) -> np.ndarray:
+        """Per-photon (metric, photon) values of the current batch."""
+        return self._batch
+
+    def start_batch(self, first_id: int, n_photons: int):
+        self._first_id = first_id
+        self._batch = np.zeros((len(self._metrics), n_photons))
+
+    def end_batch(self):
+        self._sums += (self._batch.sum(axis=1), (self._batch ** 2).sum(axis=1))
+        self.photon_count += self._batch.shape[1]
+
+    def logDataPointArray(self, array: np.ndarray, key: InteractionKey):
+        if self._logger is not None:
+            self._logger.logDataPointArray(array, key)
+        ids = array[:, 4].astype(np.int64) - self._first_id
+        for index, metric in enumerate(self._metrics):
+            values = metric.select(array, key)
+            if values is not None:
+                self._batch[index] += np.bincount(ids, weights=values, minlength=self._batch.shape[1])
+
+    def estimates(self) -> Dict[str, MetricEstimate]:
+        n = max(self.photon_count, 2)
+        mean = self._sums[0] / n
+        variance = np.maximum(self._sums[1] / n - mean ** 2, 0) * n / (n - 1)
+        return {metric.name: MetricEstimate(float(m), float(np.sqrt(v / n)))
+                for metric, m, v in zip(self._metrics, mean, variance)}
+
+
+def propagate_adaptive(source, scene=None, logger=None, metrics: List[Metric] = None, target_rse: float = 0.01,
+                       stack: LayerStack = None, batch_size: int = 1000, min_photons: int = 5000,
+                       max_photons: int = 10 ** 7, show_progress: bool = True, rng: np.random.Generator = None,
+                       variance_reduction: VarianceReduction = None) -> AdaptiveResult:
+    """
+    Propagates photons of the source in batches until the relative standard error of every metric is below
+    `target_rse`, or until `max_photons` photons were propagated.
+
+    Args:
+        source (Source): The photon source. Its N is ignored: its photons are redrawn as many times as needed.
+        scene (ScatteringScene): Used to detect the layer stack when `stack` is not given.
+        logger (EnergyLogger): Optional logger receiving the interactions of all the propagated photons. Its photon
+            count is set to the number of photons used.
+        metrics (List[Metric]): The metrics to converge. Defaults to the diffuse reflectance.
+        target_rse (float): Target relative standard error of every metric (e.g. 0.01 for 1%).
+        stack (LayerStack): Explicit layer stack, required for scenes with overlapping solids.
+        batch_size (int): Number of photons between two convergence checks.
+        min_photons (int): Minimum number of photons before the errors are trusted.
+        max_photons (int): Maximum number of photons.
+        show_progress (bool): Print the estimates each time the photon count doubles.
+        rng (np.random.Generator): Random generator. Defaults to one seeded with the source seed, if any.
+        variance_reduction (VarianceReduction): Optional roulette, splitting and layer importance settings. Split
+            photons keep the ID of their parent, so the errors remain estimated per launched photon.
+
+    Returns:
+        AdaptiveResult: The photons used and the final estimates.
+    """
+    if stack is None:
+        stack = LayerStack.from_scene(scene)
+    metrics = metrics or [diffuse_reflectance(stack)]
+    if rng is None:
+        rng = np.random.default_rng(getattr(source, "_seed", None))
+    propagator = SlabPropagator(stack, batch_size=batch_size, variance_reduction=variance_reduction)
+    tally = MetricTally(metrics, logger)
+
+    t0 = time.time()
+    positions, directions = source.getInitialPositionsAndDirections()
+    propagator.prepare_launch(positions)
+    converged = False
+    next_report = min_photons
+    while tally.photon_count < max_photons:
+        while len(positions) < batch_size:
+            new_positions, new_directions = source.getInitialPositionsAndDirections()
+            positions, directions = np.vstack((positions, new_positions)), np.vstack((directions, new_directions))
+        n_photons = min(batch_size, max_photons - tally.photon_count)
+        tally.start_batch(tally.photon_count, n_photons)
+        propagator.propagate_batch(positions[:n_photons], directions[:n_photons], tally, rng,
+                                   first_id=tally.photon_count)
+        tally.end_batch()
+        positions, directions = positions[n_photons:], directions[n_photons:]
+
+        if tally.photon_count < min_photons:
+            continue
+        estimates = tally.estimates()
+        converged = all(estimate.relative_error <= target_rse for estimate in estimates.values())
+        if show_progress and (converged or tally.photon_count >= next_report):
+            next_report *= 2
+            errors = ", ".join(f"{name} RSE {estimate.relative_error:.2%}" for name, estimate in estimates.items())
+            print(f"{tally.photon_count} photons: {errors}")
+        if converged:
+            break
+
+    if logger is not None:
+        logger.info["photonCount"] = logger.info.get("photonCount", 0) + tally.photon_count
+        logger.info["sourceSolidLabel"] = propagator.source_solid_label
+        logger.info.setdefault("sourceHash", hash(source))
+    result = AdaptiveResult(tally.photon_count, converged, tally.estimates(), time.time() - t0)
+    if show_progress:
+        print(result)
+    return result
@@ -0,0 +1,269 @@
+"""
+Propagation throughput and memory benchmarks over the canonical task scenes.
+
+Each case propagates N photons of the task source through one scene with one engine on the CPU: "mesh" is
+`source.propagate` of pytissueoptics, "numpy" is the vectorized `MeshPropagator` and "slab" is `propagate_layered`.
+The case runs in a fresh process so that its peak resident memory (RSS) is not polluted by the previous cases, and
+measures:
+
+    - photons_per_second: propagated photons per second of propagation;
+    - peak_rss_mb: peak RSS of the process (MiB), and startup_rss_mb before the propagation;
+    - logger_bytes_per_photon: memory held by the `EnergyLogger` data per propagated photon;
+    - time_to_first_plot: seconds from the start of the propagation to a first 2D view written to a PNG file.
+
+Results are written as JSON and compared to a saved baseline: a case regresses when one of its metrics is worse than
+the baseline by more than the tolerance. Engines which do not support a scene (e.g. "slab" on the overlapping layers
+of task8) are reported as skipped.
+
+Usage:
+    python benchmark.py --scenes task1 task6 --N 1000 10000 --output benchmark.json --baseline baseline.json
+    python benchmark.py --output baseline.json  # saves a new baseline
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Dict, List
+
+import numpy as np
+import pytissueoptics
+from pytissueoptics import Cuboid, Cylinder, DivergentSource, EnergyLogger, ScatteringMaterial, ScatteringScene, \
+    Vector, View2DProjectionX
+
+from headless_viewer import HeadlessViewer
+from mesh_propagation import MeshPropagator
+from slab_propagation import propagate_layered
+
+DEFAULT_N = (1000, 10000)
+DEFAULT_TOLERANCE = 0.2
+
+# Direction of improvement of each compared metric: 1 if higher is better, -1 if lower is better.
+METRICS = {"photons_per_second": 1, "peak_rss_mb": -1, "logger_bytes_per_photon": -1, "time_to_first_plot": -1}
+
+
+def _task1_scene() -> ScatteringScene:
+    epidermis = Cuboid(a=1.0, b=1.0, c=0.05, position=Vector(0, 0, 0),
+                       material=ScatteringMaterial(mu_s=60.0, mu_a=3.9, g=0.75, n=1.4), label="Epidermis")
+    dermis = Cuboid(a=1.0, b=1.0, c=0.2, position=Vector(0, 0, 0.05),
+                    material=ScatteringMaterial(mu_s=60.0, mu_a=0.71, g=0.85, n=1.4), label="Dermis")
+    subcutis = Cuboid(a=1.0, b=1.0, c=0.05, position=Vector(0, 0, 0.25),
+                      material=ScatteringMaterial(mu_s=60.0, mu_a=0.49, g=0.49, n=1.4), label="Subcutis")
+    return ScatteringScene([epidermis.stack(dermis, "back").stack(subcutis, "back")])
+
+
+def _task4_scene() -> ScatteringScene:
+    # Blue light, with the 0.1 cm epidermis.
+    epidermis = Cuboid(a=1.0, b=1.0, c=0.1, position=Vector(0, 0, 0),
+                       material=ScatteringMaterial(mu_s=76.5, mu_a=6.85, g=0.75, n=1.4), label="Epidermis")
+    dermis = Cuboid(a=1.0, b=1.0, c=0.2, position=Vector(0, 0, 0.1),
+                    material=ScatteringMaterial(mu_s=76.5, mu_a=2.45, g=0.85, n=1.4), label="Dermis")
+    subcutis = Cuboid(a=1.0, b=1.0, c=0.05, position=Vector(0, 0, 0.3),
+                      material=ScatteringMaterial(mu_s=76.5, mu_a=1.45, g=0.75, n=1.4), label="Subcutis")
+    return ScatteringScene([epidermis.stack(dermis, "back").stack(subcutis, "back")])
+
+
+def _task6_scene() -> ScatteringScene:
+    epidermis = Cuboid(a=1.0, b=1.0, c=0.05, position=Vector(0, 0, 0),
+                       material=ScatteringMaterial(mu_s=60.0, mu_a=3.9, g=0.75, n=1.4), label="Epidermis")
+    dermis = Cuboid(a=1.0, b=1.0, c=0.2, position=Vector(0, 0, 0.05),
+                    material=ScatteringMaterial(mu_s=60.0, mu_a=0.71, g=0.85, n=1.4), label="Dermis")
+    blood = Cuboid(a=1.0, b=1.0, c=0.01, position=Vector(0, 0, 0.22),
+                   material=ScatteringMaterial(mu_s=200.0, mu_a=0.5, g=0.98, n=1.4), label="Blood")
+    subcutis = Cuboid(a=1.0, b=1.0, c=0.05, position=Vector(0, 0, 0.25),
+                      material=ScatteringMaterial(mu_s=60.0, mu_a=0.49, g=0.49, n=1.4), label="Subcutis")
+    return ScatteringScene([epidermis.stack(dermis, "back").stack(blood, "back").stack(subcutis, "back")])
+
+
+def _task8_scene() -> ScatteringScene:
+    from task8 import SkinModelWithBlood
+    return SkinModelWithBlood()
+
+
+def _vessels_scene() -> ScatteringScene:
+    # The task1 layers with 200 parallel vessel segments (1600 triangles) nested in the dermis.
+    scene = _task1_scene()
+    blood = ScatteringMaterial(mu_s=200.0, mu_a=0.5, g=0.98, n=1.4)
+    for i, z in enumerate((0.05, 0.09, 0.13, 0.17, 0.21)):
+        for j, y in enumerate(np.linspace(-0.45, 0.45, 40)):
+            vessel = Cylinder(radius=0.005, length=0.4, u=8, v=1, s=1, position=Vector(0, y, z), material=blood,
+                              label=f"Vessel {i}-{j}", smooth=False)
+            vessel.rotate(yTheta=90)
+            scene.add(vessel)
+    return scene
+
+
+SCENES = {"task1": _task1_scene, "task4": _task4_scene, "task6": _task6_scene, "task8": _task8_scene,
+          "vessels": _vessels_scene}
+ENGINES = ("mesh", "numpy", "slab")
+
+
+def run_case(scene_name: str, engine: str, N: int, seed: int = 42) -> dict:
+    """Runs one case in the current process and returns its measurements."""
+    scene = SCENES[scene_name]()
+    source = DivergentSource(position=Vector(0, 0, -0.2), direction=Vector(0, 0, 1), N=N, diameter=0.1,
+                             divergence=0.4, useHardwareAcceleration=False, seed=seed)
+    logger = EnergyLogger(scene)
+    result = dict(scene=scene_name, engine=engine, N=N, startup_rss_mb=_peak_rss_mb())
+
+    t0 = time.perf_counter()
+    try:
+        if engine == "mesh":
+            source.propagate(scene, logger=logger, showProgress=False)
+        elif engine == "numpy":
+            MeshPropagator(scene).propagate(source, logger=logger, show_progress=False)
+        else:
+            propagate_layered(source, scene, logger=logger, show_progress=False)
+    except ValueError as error:
+        result["skipped"] = str(error)
+        return result
+    duration = time.perf_counter() - t0
+
+    with tempfile.TemporaryDirectory() as directory:
+        viewer = HeadlessViewer(scene, source, logger, output_dir=directory, dpi=72)
+        viewer.show2D(View2DProjectionX())
+        viewer.render()
+    result.update(duration=duration, photons_per_second=N / duration, peak_rss_mb=_peak_rss_mb(),
+                  logger_bytes_per_photon=_logger_nbytes(logger) / N, time_to_first_plot=time.perf_counter() - t0)
+    return result
+
+
+def run_benchmarks(scenes: List[str] = None, engines: List[str] = None, photon_counts: List[int] = DEFAULT_N,
+                   repeats: int = 1, seed: int = 42, show_progress: bool = True) -> dict:
+    """
+    Runs every (scene, engine, N) case in its own process.
+
+    Args:
+        scenes (List[str]): Names of the scenes, among `SCENES`. Defaults to all of them.
+        engines (List[str]): Names of the engines, among `ENGINES`. Defaults to all of them.
+        photon_counts (List[int]): The grid of N.
+        repeats (int): Number of runs of each case. The best value of each metric is kept.
+        seed (int): Seed of the sources.
+        show_progress (bool): Print each case as it completes.
+
+    Returns:
+        dict: The environment of the run under "environment" and the list of cases under "results".
+    """
+    results = []
+    context = get_context("spawn")
+    for scene_name in scenes or SCENES:
+        for engine in engines or ENGINES:
+            for N in photon_counts:
+                runs = []
+                for _ in range(repeats):
+                    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                        runs.append(executor.submit(run_case, scene_name, engine, N, seed).result())
+                result = _best_of(runs)
+                results.append(result)
+                if show_progress:
+                    print(_format(result))
+    return dict(environment=_environment(), results=results)
+
+
+def compare(results: dict, baseline: dict, tolerance: float = DEFAULT_TOLERANCE) -> List[str]:
+    """
+    Returns a description of each metric of each case worse than in the baseline by more than `tolerance`
+    (relative). Cases missing from the baseline are ignored.
+    """
+    reference = {_case_key(case): case for case in baseline["results"]}
+    regressions = []
+    for case in results["results"]:
+        base = reference.get(_case_key(case))
+        if base is None or "skipped" in case or "skipped" in base:
+            continue
+        for metric, sign in METRICS.items():
+            change = (case[metric] - base[metric]) / base[metric]
+            if -sign * change > tolerance:
+                regressions.append(f"{case['scene']}/{case['engine']}/N={case['N']}: {metric} {base[metric]:.4g} "
+                                   f"-> {case[metric]:.4g} ({change:+.1%})")
+    return regressions
+
+
+def _best_of(runs: List[dict]) -> dict:
+    best = dict(runs[0])
+    if "skipped" in best:
+        return best
+    for metric, sign in METRICS.items():
+        values = [run[metric] for run in runs]
+        best[metric] = max(values) if sign > 0 else min(values)
+    best["duration"] = min(run["duration"] for run in runs)
+    return best
+
+
+def _case_key(case: dict) -> tuple:
+    return case["scene"], case["engine"], case["N"]
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return peak / 1024 ** (2 if sys.platform == "darwin" else 1)
+
+
+def _logger_nbytes(logger: EnergyLogger) -> int:
+    """Memory of the logged data points and of the 2D views, with Python lists counted as the objects they hold."""
+    nbytes = sum(view._dataUV.nbytes for view in logger._views if view._dataUV is not None)
+    for data in logger._data.values():
+        for container in (data.points, data.dataPoints):
+            if container is None:
+                continue
+            if container._array is not None:
+                nbytes += container._array.nbytes
+            if container._list:
+                row = container._list[0]
+                row_size = sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+                nbytes += sys.getsizeof(container._list) + len(container._list) * row_size
+    return nbytes
+
+
+def _environment() -> dict:
+    return dict(date=time.strftime("%Y-%m-%dT%H:%M:%S"), python=platform.python_version(), numpy=np.__version__,
+                pytissueoptics=getattr(pytissueoptics, "__version__", "unknown"), platform=platform.platform(),
+                processor=platform.processor(), cpu_count=os.cpu_count())
+
+
+def _format(case: dict) -> str:
+    name = f"{case['scene']:>6} {case['engine']:>4} N={case['N']:<8}"
+    if "skipped" in case:
+        return f"{name} skipped: {case['skipped']}"
+    return (f"{name} {case['photons_per_second']:10.0f} photons/s  peak RSS {case['peak_rss_mb']:7.1f} MiB  "
+            f"logger {case['logger_bytes_per_photon']:8.0f} B/photon  first plot {case['time_to_first_plot']:7.2f}s")
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenes", nargs="+", choices=list(SCENES), default=list(SCENES))
+    parser.add_argument("--engines", nargs="+", choices=ENGINES, default=list(ENGINES))
+    parser.add_argument("--N", nargs="+", type=int, default=list(DEFAULT_N), help="Grid of photon counts.")
+    parser.add_argument("--repeats", type=int, default=1, help="Runs per case; the best of each metric is kept.")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="benchmark.json", help="JSON file of the results.")
+    parser.add_argument("--baseline", help="JSON results to compare to.")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Relative change of a metric counted as a regression.")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.scenes, args.engines, args.N, args.repeats, args.seed)
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Results written to {args.output}")
+    if args.baseline is None:
+        return 0
+
+    with open(args.baseline) as file:
+        baseline: Dict = json.load(file)
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if not regressions:
+        print(f"No regression against {args.baseline} (tolerance {args.tolerance:.0%}).")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+"""
+Fixed-memory `EnergyLogger` accumulating the interactions into preconfigured grids.
+
+An `EnergyLogger` keeps every deposition point so that the `Viewer` can bin them later, which makes its memory grow
+with the number of photons times the number of scattering events. `BinnedEnergyLogger` instead bins the data points as
+soon as they are logged into:
+    - the 2D views of the logger (float32, all default views by default so that `Stats` can report every solid and
+      surface),
+    - a float32 3D deposition grid per solid, from which new volumetric views (e.g. `View2DSliceZ` at any depth) can
+      still be created after the simulation,
+    - exact per-solid and per-surface energy totals.
+Its memory is therefore fixed by the bin sizes, whatever the number of photons. `Viewer.reportStats`, `Viewer.show2D`
+and `Viewer.show1D` work unchanged.
+
+Usage:
+    logger = BinnedEnergyLogger(scene, gridBinSize=0.005)
+    source.propagate(scene, logger=logger)
+    viewer = Viewer(scene, source, logger)
+    viewer.show2D(View2DSliceZ(position=0.15, thickness=0.01))
+"""
+import os
+import pickle
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+from pytissueoptics import EnergyLogger, EnergyType, InteractionKey, ViewGroup
+from pytissueoptics.rayscattering import utils
+from pytissueoptics.rayscattering.display.views import View2D
+
+GRIDS_FILE_SUFFIX = ".grids"
+
+
+class BinnedEnergyLogger(EnergyLogger):
+    """
+    `EnergyLogger` with `keep3D=False` that also accumulates a 3D deposition grid per solid and energy totals.
+
+    Args:
+        scene (ScatteringScene): The scene, as for `EnergyLogger`.
+        filepath (str): Optional file to load from and save to. The grids are saved next to it.
+        views: The 2D views to accumulate. Defaults to all the default views, required by `Stats`.
+        defaultViewEnergyType (EnergyType): Energy type of the default views.
+        defaultBinSize: Bin size of the 2D views (cm), as for `EnergyLogger`.
+        infiniteLimits: Limits used when the scene is infinite, as for `EnergyLogger`.
+        gridBinSize: Bin size of the 3D grids (cm), a float or one value per axis. Defaults to `defaultBinSize`.
+            Volumetric views created after the simulation cannot be finer than this resolution.
+    """
+
+    def __init__(self, scene, filepath: str = None, views: Union[ViewGroup, List[View2D]] = ViewGroup.ALL,
+                 defaultViewEnergyType: EnergyType = EnergyType.DEPOSITION, defaultBinSize: Union[float, tuple] = 0.01,
+                 infiniteLimits=((-5, 5), (-5, 5), (-5, 5)), gridBinSize: Union[float, tuple] = None):
+        gridBinSize = defaultBinSize if gridBinSize is None else gridBinSize
+        self._gridBinSize = np.broadcast_to(np.asarray(gridBinSize, dtype=float), (3,)).copy()
+        self._grids: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self._totals: Dict[InteractionKey, np.ndarray] = {}
+        super().__init__(scene, filepath=filepath, keep3D=False, views=views,
+                         defaultViewEnergyType=defaultViewEnergyType, defaultBinSize=defaultBinSize,
+                         infiniteLimits=infiniteLimits)
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the 2D views and the 3D grids."""
+        view_bytes = sum(view._dataUV.nbytes for view in self._views if view._dataUV is not None)
+        return view_bytes + sum(grid.nbytes for _, grid in self._grids.values())
+
+    def getGrid(self, solidLabel: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the ((x_min, x_max), (y_min, y_max), (z_min, z_max)) limits and the 3D grid of the energy deposited
+        in a solid, or None if nothing was deposited in it.
+        """
+        for label, grid in self._grids.items():
+            if utils.labelsEqual(label, solidLabel):
+                return grid
+        return None
+
+    def getTotal(self, solidLabel: str, surfaceLabel: str = None, leaving: bool = None) -> float:
+        """
+        Exact total energy logged for a solid or one of its surfaces.
+
+        Args:
+            solidLabel (str): The solid.
+            surfaceLabel (str): The surface. If None, returns the energy deposited in the solid.
+            leaving (bool): For surfaces, only the energy leaving (True) or entering (False) the solid. If None,
+                returns the net energy leaving the solid through the surface.
+        """
+        total = np.zeros(2)
+        for key, values in self._totals.items():
+            if utils.labelsEqual(key.solidLabel, solidLabel) and utils.labelsEqual(key.surfaceLabel, surfaceLabel):
+                total += values
+        if surfaceLabel is None or leaving is None:
+            return float(total.sum())
+        return float(total[0] if leaving else -total[1])
+
+    def logDataPointArray(self, array: np.ndarray, key: InteractionKey):
+        positive = array[:, 0] > 0
+        totals = self._totals.setdefault(key, np.zeros(2))
+        totals += (array[positive, 0].sum(), array[~positive, 0].sum())
+        if key.volumetric and key.solidLabel is not None:
+            self._accumulate(array, key.solidLabel)
+        super().logDataPointArray(array, key)
+
+    def addView(self, view: View2D) -> bool:
+        """
+        Adds a view. Volumetric views that cannot be copied from an existing view of the same energy type are binned
+        from the 3D grids.
+        """
+        self._viewFactory.build([view])
+        if view.surfaceLabel is not None or self.isEmpty:
+            return super().addView(view)
+        for existing_view in self._views:
+            if existing_view.energyType != view.energyType or not view.isContainedBy(existing_view):
+                continue
+            if not view.isEqualTo(existing_view):
+                view.initDataFrom(existing_view)
+                self._views.append(view)
+            return True
+        self._extract_from_grids(view)
+        self._views.append(view)
+        return True
+
+    def save(self, filepath: str = None):
+        super().save(filepath)
+        filepath = filepath or self._filepath or self.DEFAULT_LOGGER_PATH
+        with open(filepath + GRIDS_FILE_SUFFIX, "wb") as file:
+            pickle.dump((self._gridBinSize, self._grids, self._totals), file)
+
+    def load(self, filepath: str):
+        super().load(filepath)
+        if os.path.exists(filepath + GRIDS_FILE_SUFFIX):
+            with open(filepath + GRIDS_FILE_SUFFIX, "rb") as file:
+                self._gridBinSize, self._grids, self._totals = pickle.load(file)
+
+    def _accumulate(self, array: np.ndarray, solid_label: str):
+        if solid_label not in self._grids:
+            self._grids[solid_label] = self._create_grid(solid_label)
+        limits, grid = self._grids[solid_label]
+        # Deposition happens inside the solid, so only points on its upper boundaries need to be brought back in.
+        indices = np.floor((array[:, 1:4] - limits[:, 0]) / self._gridBinSize).astype(np.int64)
+        indices = np.clip(indices, 0, np.array(grid.shape) - 1)
+        flat_indices = np.ravel_multi_index(indices.T, grid.shape)
+        values = array[:, 0]
+        if len(values) * 8 < grid.size:
+            np.add.at(grid.reshape(-1), flat_indices, values)
+        else:
+            grid += np.bincount(flat_indices, weights=values, minlength=grid.size).reshape(grid.shape)
+
+    def _create_grid(self, solid_label: str) -> Tuple[np.ndarray, np.ndarray]:
+        solid = self._scene.getSolid(solid_label)
+        limits = np.asarray(solid.getBoundingBox().xyzLimits if solid else self._infiniteLimits, dtype=float)
+        bins = np.maximum(1, np.ceil((limits[:, 1] - limits[:, 0]) / self._gridBinSize - 1e-9)).astype(int)
+        limits[:, 1] = limits[:, 0] + bins * self._gridBinSize
+        return limits, np.zeros(bins, dtype=np.float32)
+
+    def _extract_from_grids(self, view: View2D):
+        for solid_label, (limits, grid) in self._grids.items():
+            if view.solidLabel and not utils.labelsEqual(view.solidLabel, solid_label):
+                continue
+            indices = np.nonzero(grid)
+            centers = [limits[axis, 0] + (indices[axis] + 0.5) * self._gridBinSize[axis] for axis in range(3)]
+            data_points = np.column_stack((grid[indices].astype(np.float64), *centers))
+            if view.energyType == EnergyType.FLUENCE_RATE:
+                data_points = self._fluenceTransform(InteractionKey(solid_label), data_points)
+            view.extractData(data_points)
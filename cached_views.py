@@ -0,0 +1,299 @@
+"""
+Single-pass binning of the 2D views and 1D profiles of an `EnergyLogger` keeping the 3D data.
+
+With `keep3D=True`, `EnergyLogger` bins each view separately: `addView` after the simulation goes over all the logged
+data points for the new view, `Viewer.show2D` does it again for every view it creates, and every `Viewer.show1D` goes
+over the 3D point cloud once more, so the post-processing of task3/4/6/7 (a few depth slices and a profile per
+wavelength) scales with the number of views. `CachedEnergyLogger` instead:
+    - keeps the views added with `addView` (or given to the constructor as a list) pending, and compiles them together
+      with the first view that is displayed, in a single pass over the data of each interaction key,
+    - caches the bin index of every data point along each axis for every binning used so far, along with the order of
+      the points along each axis, so that the views and profiles sharing a binning (e.g. every `View2DSliceZ` of the
+      scene and the X profile) do not bin the points again, and a new slice only goes over the points inside it,
+    - keeps the binned views and profiles until new data is logged, so repeated `show2D` and `show1D` calls are free.
+The binned values are the ones of the `EnergyLogger`, up to the summation order of the floating-point values.
+`CachedViewer` is a `Viewer` that takes its 1D profiles from these caches.
+
+Usage:
+    logger = CachedEnergyLogger(scene)
+    source.propagate(scene, logger=logger)
+    for depth in [0.05, 0.15, 0.25]:
+        logger.addView(View2DSliceZ(position=depth, thickness=0.01, limits=((-1, 1), (-1, 1))))
+    viewer = CachedViewer(scene, source, logger)
+    viewer.show2D(View2DSliceZ(position=0.05, thickness=0.01, limits=((-1, 1), (-1, 1))))
+    viewer.show1D(Direction.X_POS)
+"""
+from typing import Callable, Dict, List, Tuple, Union
+
+import numpy as np
+from pytissueoptics import Direction, EnergyLogger, EnergyType, InteractionKey, Viewer, ViewGroup
+from pytissueoptics.rayscattering import utils
+from pytissueoptics.rayscattering.display.profiles import ProfileFactory
+from pytissueoptics.rayscattering.display.views import View2D, View2DProjection, View2DSlice, View2DSurface
+
+# Number of buckets sorting the data points along an axis, so that a slice only goes over the points of its buckets.
+SLAB_BUCKETS = 1024
+
+
+class _BinnedPoints:
+    """Data points of one interaction key, with their bin indices for every binning used so far."""
+
+    def __init__(self, data: np.ndarray, fluenceTransform: Callable[[np.ndarray], np.ndarray]):
+        self._data = data
+        self._fluenceTransform = fluenceTransform
+        self._fluence = None
+        self._indices: Dict[tuple, np.ndarray] = {}
+        self._buckets: Dict[int, tuple] = {}
+
+    def values(self, energyType: EnergyType) -> np.ndarray:
+        if energyType != EnergyType.FLUENCE_RATE:
+            return self._data[:, 0]
+        if self._fluence is None:
+            # The transform of `EnergyLogger` divides the values in place.
+            self._fluence = self._fluenceTransform(self._data.copy())[:, 0]
+        return self._fluence
+
+    def indices(self, axis: int, limits: Tuple[float, float], bins: int, rows: np.ndarray = None) -> np.ndarray:
+        """
+        Bin of each point (or of the given rows) along an axis, -1 outside. The bins of all the points are kept, while
+        the bins of some rows are only kept if the ones of all the points already are.
+        """
+        key = (axis, *limits, bins)
+        if key in self._indices:
+            return self._indices[key] if rows is None else self._indices[key][rows]
+        if rows is not None:
+            return _bin_indices(self._data[rows, 1 + axis], limits, bins)
+        self._indices[key] = _bin_indices(self._data[:, 1 + axis], limits, bins)
+        return self._indices[key]
+
+    def between(self, axis: int, low: float, high: float) -> np.ndarray:
+        """Sorted rows of the points strictly between two positions along an axis."""
+        if axis not in self._buckets:
+            positions = self._data[:, 1 + axis]
+            start, stop = positions.min(), positions.max()
+            scale = SLAB_BUCKETS / (stop - start) if stop > start else 0
+            buckets = np.minimum(((positions - start) * scale).astype(np.int16), SLAB_BUCKETS - 1)
+            order = np.argsort(buckets, kind="stable")
+            offsets = np.concatenate(([0], np.cumsum(np.bincount(buckets, minlength=SLAB_BUCKETS))))
+            self._buckets[axis] = start, scale, order, offsets
+        start, scale, order, offsets = self._buckets[axis]
+        first, last = (int(np.clip((position - start) * scale, 0, SLAB_BUCKETS - 1)) for position in (low, high))
+        rows = order[offsets[first]:offsets[last + 1]]
+        positions = self._data[rows, 1 + axis]
+        return np.sort(rows[(positions > low) & (positions < high)])
+
+    def histogram2D(self, view: View2D) -> Tuple[np.ndarray, bool]:
+        """
+        Returns the (binsU, binsV) sum of the points of the view in its bins, in the layout of `View2D._dataUV`, and
+        whether any point passed the filter of the view.
+        """
+        rows = None
+        weights = self.values(view.energyType)
+        if isinstance(view, View2DSlice):
+            rows = self.between(view.axis, view.displayPosition - view.thickness / 2,
+                                view.displayPosition + view.thickness / 2)
+            weights = weights[rows]
+        elif isinstance(view, View2DSurface):
+            weights = _crossing(weights, view.surfaceEnergyLeaving)
+        has_data = np.count_nonzero(weights) > 0 if isinstance(view, View2DSurface) else len(weights) > 0
+        u = self.indices(view.axisU, sorted(view.limitsU), view.binsU, rows)
+        v = self.indices(view.axisV, sorted(view.limitsV), view.binsV, rows)
+        inside = (u >= 0) & (v >= 0)
+        flat = u[inside].astype(np.int64) * view.binsV + (view.binsV - 1 - v[inside])
+        histogram = np.bincount(flat, weights=weights[inside], minlength=view.binsU * view.binsV)
+        return histogram.reshape(view.binsU, view.binsV), has_data
+
+    def histogram1D(self, axis: int, limits: Tuple[float, float], bins: int, energyType: EnergyType,
+                    surfaceEnergyLeaving: bool = None) -> np.ndarray:
+        indices = self.indices(axis, limits, bins)
+        weights = self.values(energyType)
+        if surfaceEnergyLeaving is not None:
+            weights = _crossing(weights, surfaceEnergyLeaving)
+        inside = indices >= 0
+        return np.bincount(indices[inside], weights=weights[inside], minlength=bins)
+
+
+def _bin_indices(positions: np.ndarray, limits: Tuple[float, float], bins: int) -> np.ndarray:
+    """Bin of each position (-1 outside), with the bin edges of `np.histogram2d`."""
+    # Same uniform-bin computation as `np.histogram`, corrected against the edges so that the positions on an edge fall
+    # in the same bin as with the `np.searchsorted` of `np.histogram2d`.
+    edges = np.linspace(limits[0], limits[1], bins + 1)
+    inside = (positions >= edges[0]) & (positions <= edges[-1])
+    indices = np.full(len(positions), -1, dtype=np.int32)
+    kept = positions[inside]
+    kept_indices = np.minimum(((kept - edges[0]) * (bins / (edges[-1] - edges[0]))).astype(np.int32), bins - 1)
+    kept_indices -= kept < edges[kept_indices]
+    kept_indices += (kept >= edges[kept_indices + 1]) & (kept_indices != bins - 1)
+    indices[inside] = kept_indices
+    return indices
+
+
+def _crossing(values: np.ndarray, leaving: bool) -> np.ndarray:
+    """Positive energy of the points leaving (or entering) a surface, and 0 for the others."""
+    return np.where(values > 0, values, 0) if leaving else np.where(values < 0, -values, 0)
+
+
+class CachedEnergyLogger(EnergyLogger):
+    """
+    `EnergyLogger` keeping the 3D data, which compiles its views together and caches the binning of the data points.
+
+    Args:
+        scene (ScatteringScene): The scene, as for `EnergyLogger`.
+        filepath (str): Optional file to load from and save to.
+        views: Views known from the start, as for `EnergyLogger`. A list of views is compiled in the first pass, while
+            the views of a `ViewGroup` are only compiled when displayed.
+        defaultViewEnergyType (EnergyType): Energy type of the default views.
+        defaultBinSize: Bin size of the 2D views (cm), as for `EnergyLogger`.
+        infiniteLimits: Limits used when the scene is infinite, as for `EnergyLogger`.
+    """
+
+    def __init__(self, scene, filepath: str = None, views: Union[ViewGroup, List[View2D]] = ViewGroup.ALL,
+                 defaultViewEnergyType: EnergyType = EnergyType.DEPOSITION, defaultBinSize: Union[float, tuple] = 0.01,
+                 infiniteLimits=((-5, 5), (-5, 5), (-5, 5))):
+        self._binned: Dict[InteractionKey, _BinnedPoints] = {}
+        self._profiles: Dict[tuple, np.ndarray] = {}
+        self._pendingViews: List[View2D] = []
+        super().__init__(scene, filepath=filepath, keep3D=True, views=views,
+                         defaultViewEnergyType=defaultViewEnergyType, defaultBinSize=defaultBinSize,
+                         infiniteLimits=infiniteLimits)
+        if not isinstance(views, ViewGroup) and views is not None:
+            self._pendingViews = list(self._views)
+
+    def addView(self, view: View2D) -> bool:
+        """
+        Adds a view without binning it. It is compiled along with the other pending views when one of them is
+        displayed, or copied from an up-to-date view when it only differs from it in orientation.
+        """
+        # Building the context of a view clears its data, so the views of the logger must not be built again.
+        if any(view is existing_view for existing_view in self._views):
+            return True
+        self._viewFactory.build([view])
+        if self._viewExists(view):
+            return True
+        if self.isEmpty:
+            self._views.append(view)
+            self._pendingViews.append(view)
+            return True
+        for existing_view in self._views:
+            if existing_view not in self._outdatedViews and view.energyType == existing_view.energyType and \
+                    view.isContainedBy(existing_view):
+                view.initDataFrom(existing_view)
+                self._views.append(view)
+                return True
+        self._views.append(view)
+        self._pendingViews.append(view)
+        self._outdatedViews.add(view)
+        return True
+
+    def updateView(self, view: View2D):
+        """Compiles the view, if outdated, together with every outdated pending view."""
+        if view not in self._outdatedViews:
+            return
+        pending = [other for other in self._pendingViews if other in self._outdatedViews and other is not view]
+        self._compileViews([view] + pending)
+
+    def getProfile(self, along: Direction, solidLabel: str = None, surfaceLabel: str = None,
+                   surfaceEnergyLeaving: bool = True, limits: Tuple[float, float] = None, binSize: float = None,
+                   energyType: EnergyType = EnergyType.DEPOSITION) -> np.ndarray:
+        """
+        Histogram of a 1D profile along a direction, as `Viewer.show1D` displays it, kept until new data is logged.
+        The arguments are those of `Viewer.show1D`.
+        """
+        return _CachedProfileFactory(self._scene, self).create(along, solidLabel, surfaceLabel, surfaceEnergyLeaving,
+                                                               limits, binSize, energyType).data
+
+    def logDataPointArray(self, array: np.ndarray, key: InteractionKey):
+        super().logDataPointArray(array, key)
+        self._binned.pop(key, None)
+        self._profiles.clear()
+
+    def load(self, filepath: str):
+        super().load(filepath)
+        self._clear_caches()
+
+    def filter(self, detectedBy: Union[str, List[str]]) -> None:
+        super().filter(detectedBy)
+        self._clear_caches()
+
+    def _clear_caches(self):
+        self._binned.clear()
+        self._profiles.clear()
+        self._pendingViews = []
+
+    def _compileViews(self, views: List[View2D], detectedBy: Union[str, List[str]] = None):
+        # Views filtering the photons by detector, or unknown view types, are binned as by `EnergyLogger`.
+        fallback = [view for view in views if detectedBy is not None or view.detectedBy or
+                    not isinstance(view, (View2DProjection, View2DSlice, View2DSurface))]
+        for view in fallback:
+            view._dataUV[:] = 0
+            super()._compileViews([view], detectedBy=view.detectedBy if detectedBy is None else detectedBy)
+        views = [view for view in views if view not in fallback]
+
+        for view in views:
+            view._dataUV[:] = 0
+        for key in self._data:
+            matching = [view for view in views if self._viewMatches(view, key)]
+            if not matching:
+                continue
+            binned = self._binnedPoints(key)
+            if binned is None:
+                continue
+            for view in matching:
+                histogram, has_data = binned.histogram2D(view)
+                view._dataUV += histogram
+                view._hasData = view._hasData or has_data
+        for view in views:
+            self._outdatedViews.discard(view)
+
+    @staticmethod
+    def _viewMatches(view: View2D, key: InteractionKey) -> bool:
+        if view.solidLabel and not utils.labelsEqual(view.solidLabel, key.solidLabel):
+            return False
+        if view.surfaceLabel:
+            return utils.labelsEqual(view.surfaceLabel, key.surfaceLabel)
+        return key.surfaceLabel is None
+
+    def _binnedPoints(self, key: InteractionKey) -> _BinnedPoints:
+        if key not in self._binned:
+            container = self._data[key].dataPoints
+            if container is None or len(container) == 0:
+                return None
+            self._binned[key] = _BinnedPoints(container.getData(), lambda data: self._fluenceTransform(key, data))
+        return self._binned[key]
+
+    def _histogram1D(self, keys: List[InteractionKey], axis: int, limits: Tuple[float, float], bins: int,
+                     energyType: EnergyType, surfaceEnergyLeaving: bool = None) -> np.ndarray:
+        cache_key = (tuple(keys), axis, limits, bins, energyType, surfaceEnergyLeaving)
+        if cache_key not in self._profiles:
+            histogram = np.zeros(bins)
+            for key in keys:
+                binned = self._binnedPoints(key) if key in self._data else None
+                if binned is not None:
+                    histogram += binned.histogram1D(axis, limits, bins, energyType, surfaceEnergyLeaving)
+            self._profiles[cache_key] = histogram
+        return self._profiles[cache_key]
+
+
+class _CachedProfileFactory(ProfileFactory):
+    """`ProfileFactory` binning the 3D data of a `CachedEnergyLogger` through its caches."""
+
+    def _extractHistogramFrom3D(self, horizontalDirection: Direction, solidLabel: str, surfaceLabel: str,
+                                surfaceEnergyLeaving: bool, limits: Tuple[float, float], bins: int,
+                                energyType: EnergyType):
+        if not isinstance(self._logger, CachedEnergyLogger) or (surfaceLabel and not solidLabel):
+            return super()._extractHistogramFrom3D(horizontalDirection, solidLabel, surfaceLabel,
+                                                   surfaceEnergyLeaving, limits, bins, energyType)
+        if solidLabel:
+            keys = [InteractionKey(solidLabel, surfaceLabel)]
+        else:
+            keys = [InteractionKey(label) for label in sorted(self._logger.getStoredSolidLabels(), key=str)]
+        return self._logger._histogram1D(keys, horizontalDirection.axis, tuple(limits), bins, energyType,
+                                         surfaceEnergyLeaving if surfaceLabel else None)
+
+
+class CachedViewer(Viewer):
+    """`Viewer` whose 1D profiles are binned through the caches of a `CachedEnergyLogger`."""
+
+    def __init__(self, scene, source, logger: EnergyLogger):
+        super().__init__(scene, source, logger)
+        self._profileFactory = _CachedProfileFactory(scene, logger)
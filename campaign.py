@@ -0,0 +1,413 @@
+"""
+Declarative experiment campaigns, run as deduplicated jobs over a pool of worker processes.
+
+task3.py, task4.py and task7.py each copy the same Blue/Green/Red/NIR material table, task5.py and task8.py keep their
+own `optical_properties` lists, and every script rebuilds its layer stack by hand. A campaign spec describes the
+experiments instead, as JSON: a table of materials per wavelength shared by all the experiments and, for each
+experiment, its layers, source, number of photons, logger and tallies (the views, profiles and statistics to render),
+with sweeps over any of its parameters.
+
+`plan_campaign` expands the sweeps into variants and resolves each variant into a simulation job: the layers with their
+actual optical properties, the source, the number of photons, the seed, the engine and the logger. Jobs are keyed by a
+digest of this description only, so variants describing the same simulation in different experiments (e.g. task1 and
+task2, or the green model of task5 and the model without blood of task8) share a single job. `run_campaign` then runs
+the job graph over a pool of worker processes: the jobs are submitted by decreasing estimated cost (photons times the
+expected interactions per photon) so that the longest ones do not start last, and the tallies of each variant are
+rendered with a `HeadlessViewer` as soon as its job is done. Job results are saved in the output directory, so a rerun
+campaign, or another campaign sharing some of its jobs, only simulates the missing ones.
+
+Spec format:
+    {
+      "materials": {"Green": {"epidermis": {"mu_s": 60.0, "mu_a": 3.9, "g": 0.75, "n": 1.4}, ...}, ...},
+      "defaults": {"source": {"type": "DivergentSource", "position": [0, 0, -0.2], "direction": [0, 0, 1],
+                              "diameter": 0.1, "divergence": 0.4},
+                   "N": 10000, "seed": 42, "width": 1.0, "engine": "slab"},
+      "experiments": {
+        "task3": {"layers": [{"label": "Epidermis", "thickness": 0.05, "material": "epidermis"}, ...],
+                  "sweep": {"wavelength": ["Blue", "Green", "Red", "NIR"]},
+                  "tallies": [{"view": "View2DSliceZ", "position": 0.05, "thickness": 0.01}, {"profile": "X_POS"},
+                              {"stats": true}]}
+      }
+    }
+A layer material is the name of a material of the wavelength, optionally with overridden properties
+({"material": "subcutis", "g": 0.49}), or explicit properties ({"mu_s": 200.0, "mu_a": 0.5, "g": 0.98, "n": 1.4}).
+Sweep keys are dotted paths to the parameters of the experiment, such as "N", "source.divergence" or
+"layers.Epidermis.thickness", and the variants are the Cartesian product of their values. An experiment can extend
+another one ("extends": "task3"), replacing some of its entries and setting single parameters with the same paths
+("set": {"layers.Epidermis.thickness": 0.1}), so that task4 is task3 with a thicker epidermis. The logger is
+{"type": "energy"} (the default, a `CachedEnergyLogger` keeping the 3D data) or {"type": "binned", "gridBinSize":
+0.01} for a fixed-memory `BinnedEnergyLogger`.
+
+Usage:
+    python campaign.py tasks_campaign.json --output results --workers 4
+    python campaign.py tasks_campaign.json --experiments task3 task4 --dry-run  # Prints the jobs without running them.
+"""
+import argparse
+import copy
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+import numpy as np
+from pytissueoptics import Cuboid, DirectionalSource, Direction, DivergentSource, ScatteringMaterial, \
+    ScatteringScene, Vector
+from pytissueoptics.rayscattering.display import views as pto_views
+
+from binned_logger import BinnedEnergyLogger
+from cached_views import CachedEnergyLogger
+from headless_viewer import HeadlessViewer
+from mesh_propagation import MeshPropagator
+from slab_propagation import propagate_layered
+
+SOURCES = {"DivergentSource": DivergentSource, "DirectionalSource": DirectionalSource}
+LOGGERS = {"energy": CachedEnergyLogger, "binned": BinnedEnergyLogger}
+ENGINES = ("slab", "numpy", "mesh")
+
+# Relative CPU time per interaction of each engine, from the photons/s of `benchmark.py` on the task1 scene.
+ENGINE_COST = {"slab": 1, "numpy": 3, "mesh": 300}
+
+JOBS_DIRECTORY = "jobs"
+LOGGER_FILENAME = "logger"
+DESCRIPTION_FILENAME = "job.json"
+
+# Number of significant digits of the optical properties and thicknesses in the job keys, so that the same value
+# written differently (0.1 or 0.10000000000000001) gives the same job.
+KEY_DIGITS = 12
+
+
+@dataclass
+class CampaignVariant:
+    experiment: str
+    name: str
+    job: str
+    tallies: List[dict]
+
+    @property
+    def id(self) -> str:
+        return f"{self.experiment}/{self.name}" if self.name else self.experiment
+
+
+@dataclass
+class CampaignJob:
+    key: str
+    description: dict
+    cost: float
+    variants: List[str] = field(default_factory=list)
+
+
+@dataclass
+class CampaignPlan:
+    jobs: Dict[str, CampaignJob]
+    variants: List[CampaignVariant]
+
+    def __str__(self):
+        lines = [f"{len(self.variants)} variants in {len(self.jobs)} unique jobs, by decreasing cost:"]
+        for job in self.jobs.values():
+            lines.append(f"  {job.key[:12]} N={job.description['N']:<8} cost {job.cost:10.3g}  "
+                         f"{', '.join(job.variants)}")
+        return "\n".join(lines)
+
+
+def load_spec(filepath: str) -> dict:
+    with open(filepath) as file:
+        return json.load(file)
+
+
+def plan_campaign(spec: dict, experiments: List[str] = None) -> CampaignPlan:
+    """
+    Expands the sweeps of the experiments of a spec into variants and groups the variants by identical job.
+
+    Args:
+        spec (dict): The campaign spec (see the module documentation).
+        experiments (List[str]): Names of the experiments to plan. Defaults to all of them.
+
+    Returns:
+        CampaignPlan: The unique jobs, sorted by decreasing estimated cost, and the variants using them.
+    """
+    names = list(spec["experiments"]) if experiments is None else experiments
+    unknown = set(names) - set(spec["experiments"])
+    if unknown:
+        raise ValueError(f"Unknown experiments {sorted(unknown)}.")
+
+    jobs, variants = {}, []
+    for name in names:
+        experiment = _resolve_experiment(spec, name)
+        for path, value in experiment.pop("set", {}).items():
+            _set_parameter(experiment, path, value)
+        sweep = experiment.pop("sweep", {})
+        for values in itertools.product(*sweep.values()):
+            configuration = copy.deepcopy(experiment)
+            for path, value in zip(sweep, values):
+                _set_parameter(configuration, path, value)
+            description = _describe_job(configuration, spec.get("materials", {}), name)
+            key = hashlib.sha256(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+            variant = CampaignVariant(name, "-".join(str(value) for value in values), key,
+                                      configuration.get("tallies", []))
+            jobs.setdefault(key, CampaignJob(key, description, estimate_cost(description))).variants.append(variant.id)
+            variants.append(variant)
+
+    ordered = sorted(jobs.values(), key=lambda job: job.cost, reverse=True)
+    return CampaignPlan({job.key: job for job in ordered}, variants)
+
+
+def estimate_cost(description: dict) -> float:
+    """
+    Relative CPU cost of a job: its number of photons times the expected number of interactions of a photon, estimated
+    per layer as its optical thickness, capped by the mean number of interactions before absorption (mu_t / mu_a).
+    """
+    interactions = 1.0
+    for layer in description["layers"]:
+        material = layer["material"]
+        mu_t = material["mu_s"] + material["mu_a"]
+        interactions += min(mu_t * layer["thickness"], mu_t / material["mu_a"] if material["mu_a"] > 0 else np.inf)
+    return description["N"] * interactions * ENGINE_COST[description["engine"]]
+
+
+def run_campaign(plan: CampaignPlan, output_dir: str, workers: int = None,
+                 show_progress: bool = True) -> Dict[str, List[str]]:
+    """
+    Runs the missing jobs of a plan over a pool of worker processes, by decreasing cost, and renders the tallies of
+    every variant as soon as its job is done, in `<output_dir>/<experiment>/<variant>`.
+
+    Args:
+        plan (CampaignPlan): The planned campaign.
+        output_dir (str): Directory of the results. The job results are kept in its `jobs` sub-directory and reused by
+            later runs.
+        workers (int): Number of worker processes. Defaults to the number of CPUs. With a single worker, everything
+            runs in the current process.
+        show_progress (bool): Print the jobs as they are done.
+
+    Returns:
+        Dict[str, List[str]]: The files written for each variant, keyed by "<experiment>/<variant>".
+    """
+    workers = workers or os.cpu_count() or 1
+    pending = [job for job in plan.jobs.values() if not os.path.exists(_job_directory(output_dir, job.key))]
+    if show_progress:
+        print(f"Running {len(pending)} jobs ({len(plan.jobs) - len(pending)} already done) for "
+              f"{len(plan.variants)} variants over {workers} workers...")
+    t0 = time.time()
+    written = {}
+
+    if workers == 1:
+        for job in pending:
+            _report(job, _run_job(job.description, _job_directory(output_dir, job.key)), show_progress)
+        for variant in plan.variants:
+            written[variant.id] = _render_variant(plan.jobs[variant.job].description, variant.tallies,
+                                                  _job_directory(output_dir, variant.job),
+                                                  os.path.join(output_dir, variant.id))
+    else:
+        _run_pool(plan, pending, output_dir, workers, written, show_progress)
+    if show_progress:
+        print(f"... done in {time.time() - t0:.2f}s")
+    return {variant.id: written[variant.id] for variant in plan.variants}
+
+
+def _run_pool(plan: CampaignPlan, pending: List[CampaignJob], output_dir: str, workers: int,
+              written: Dict[str, List[str]], show_progress: bool):
+    """Runs the pending jobs by decreasing cost and submits the renders of each job as soon as it is done."""
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        def render(key: str):
+            for variant in plan.variants:
+                if variant.job == key:
+                    renders[executor.submit(_render_variant, plan.jobs[key].description, variant.tallies,
+                                            _job_directory(output_dir, key),
+                                            os.path.join(output_dir, variant.id))] = variant
+
+        running = {executor.submit(_run_job, job.description, _job_directory(output_dir, job.key)): job
+                   for job in pending}
+        renders = {}
+        for key in set(plan.jobs) - {job.key for job in pending}:
+            render(key)
+        while running or renders:
+            done, _ = wait(list(running) + list(renders), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in running:
+                    job = running.pop(future)
+                    _report(job, future.result(), show_progress)
+                    render(job.key)
+                else:
+                    written[renders.pop(future).id] = future.result()
+
+
+def build_scene(description: dict) -> ScatteringScene:
+    """Stacked Cuboids of the layers of a job description, as built by the task scripts."""
+    width = description["width"]
+    stack, z = None, 0.0
+    for layer in description["layers"]:
+        cuboid = Cuboid(a=width, b=width, c=layer["thickness"], position=Vector(0, 0, z),
+                        material=ScatteringMaterial(**layer["material"]), label=layer["label"])
+        stack = cuboid if stack is None else stack.stack(cuboid, "back")
+        z += layer["thickness"]
+    return ScatteringScene([stack])
+
+
+def build_source(description: dict):
+    parameters = dict(description["source"])
+    source_type = SOURCES[parameters.pop("type")]
+    for name in ("position", "direction"):
+        parameters[name] = Vector(*parameters[name])
+    return source_type(N=description["N"], seed=description["seed"],
+                       useHardwareAcceleration=description["engine"] == "mesh", **parameters)
+
+
+def _resolve_experiment(spec: dict, name: str, children=()) -> dict:
+    """The experiment merged over the one it extends, if any, and over the defaults of the spec."""
+    experiment = dict(spec["experiments"][name])
+    parent = experiment.pop("extends", None)
+    if parent is None:
+        return _merge(spec.get("defaults", {}), experiment)
+    if parent not in spec["experiments"]:
+        raise ValueError(f"Experiment '{name}' extends the unknown experiment '{parent}'.")
+    if parent in children + (name,):
+        raise ValueError(f"Experiment '{name}' extends itself through '{parent}'.")
+    return _merge(_resolve_experiment(spec, parent, children + (name,)), experiment)
+
+
+def _merge(defaults: dict, experiment: dict) -> dict:
+    merged = copy.deepcopy(defaults)
+    for name, value in experiment.items():
+        if isinstance(value, dict) and isinstance(merged.get(name), dict) and name != "sweep":
+            merged[name] = _merge(merged[name], value)
+        else:
+            merged[name] = copy.deepcopy(value)
+    return merged
+
+
+def _set_parameter(configuration: dict, path: str, value):
+    *parents, name = path.split(".")
+    target = configuration
+    for parent in parents:
+        if isinstance(target, list):
+            matches = [item for item in target if item.get("label") == parent]
+            if not matches:
+                raise ValueError(f"No layer '{parent}' for the sweep parameter '{path}'.")
+            target = matches[0]
+        else:
+            target = target.setdefault(parent, {})
+    target[name] = value
+
+
+def _describe_job(configuration: dict, materials: dict, experiment: str) -> dict:
+    """Everything changing the results of a variant, with the materials resolved to their optical properties."""
+    wavelength = configuration.get("wavelength")
+    table = materials.get(wavelength, {})
+    if wavelength is not None and wavelength not in materials:
+        raise ValueError(f"Experiment '{experiment}' uses the wavelength '{wavelength}' which has no materials.")
+    engine = configuration.get("engine", "slab")
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine '{engine}' in experiment '{experiment}'. Use one of {ENGINES}.")
+    logger = dict(configuration.get("logger", {"type": "energy"}))
+    if logger.get("type", "energy") not in LOGGERS:
+        raise ValueError(f"Unknown logger '{logger['type']}' in experiment '{experiment}'. Use one of "
+                         f"{tuple(LOGGERS)}.")
+
+    layers = []
+    for layer in configuration["layers"]:
+        properties = {name: value for name, value in layer.items() if name in ("mu_s", "mu_a", "g", "n")}
+        if "material" in layer:
+            if layer["material"] not in table:
+                raise ValueError(f"Material '{layer['material']}' of layer '{layer['label']}' is not defined for the "
+                                 f"wavelength '{wavelength}' of experiment '{experiment}'.")
+            properties = {**table[layer["material"]], **properties}
+        layers.append({"label": layer["label"], "thickness": _round(layer["thickness"]),
+                       "material": {name: _round(value) for name, value in properties.items()}})
+    return {"layers": layers, "width": _round(configuration["width"]), "source": configuration["source"],
+            "N": int(configuration["N"]), "seed": configuration.get("seed"), "engine": engine, "logger": logger}
+
+
+def _round(value: float) -> float:
+    return float(f"{value:.{KEY_DIGITS}g}")
+
+
+def _job_directory(output_dir: str, key: str) -> str:
+    return os.path.join(output_dir, JOBS_DIRECTORY, key)
+
+
+def _make_logger(description: dict, scene, filepath: str = None):
+    parameters = dict(description["logger"])
+    return LOGGERS[parameters.pop("type", "energy")](scene, filepath=filepath, **parameters)
+
+
+def _run_job(description: dict, directory: str) -> float:
+    """Simulates a job and saves its logger in `directory`. Returns the propagation time."""
+    scene, source = build_scene(description), build_source(description)
+    logger = _make_logger(description, scene)
+    t0 = time.time()
+    if description["engine"] == "slab":
+        propagate_layered(source, scene, logger=logger, show_progress=False)
+    elif description["engine"] == "numpy":
+        MeshPropagator(scene).propagate(source, logger=logger, show_progress=False)
+    else:
+        source.propagate(scene, logger=logger, showProgress=False)
+    duration = time.time() - t0
+
+    # Written next to the final directory and renamed, so an interrupted job is never mistaken for a done one.
+    temporary = f"{directory}.{os.getpid()}.tmp"
+    os.makedirs(temporary, exist_ok=True)
+    logger.save(os.path.join(temporary, LOGGER_FILENAME))
+    with open(os.path.join(temporary, DESCRIPTION_FILENAME), "w") as file:
+        json.dump(description, file, indent=2)
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.replace(temporary, directory)
+    return duration
+
+
+def _render_variant(description: dict, tallies: List[dict], job_directory: str, output_dir: str) -> List[str]:
+    scene, source = build_scene(description), build_source(description)
+    logger = _make_logger(description, scene)
+    logger.load(os.path.join(job_directory, LOGGER_FILENAME))
+    logger._filepath = None
+    viewer = HeadlessViewer(scene, source, logger, output_dir=output_dir)
+
+    written = []
+    for tally in tallies:
+        parameters = {name: value for name, value in tally.items() if name not in ("view", "profile", "stats")}
+        if "view" in tally:
+            if "limits" in parameters:
+                parameters["limits"] = tuple(tuple(limits) for limits in parameters["limits"])
+            viewer.show2D(getattr(pto_views, tally["view"])(**parameters))
+        elif "profile" in tally:
+            viewer.show1D(getattr(Direction, tally["profile"]), **parameters)
+        elif "stats" in tally:
+            os.makedirs(output_dir, exist_ok=True)
+            filepath = os.path.join(output_dir, "stats.txt")
+            viewer.reportStats(saveToFile=filepath, verbose=False, **parameters)
+            written.append(filepath)
+        else:
+            raise ValueError(f"Unknown tally {tally}: expected a 'view', 'profile' or 'stats' entry.")
+    return viewer.render() + written
+
+
+def _report(job: CampaignJob, duration: float, show_progress: bool):
+    if show_progress:
+        print(f"    Job {job.key[:12]} ({', '.join(job.variants)}) done in {duration:.2f}s")
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("spec", help="JSON campaign spec.")
+    parser.add_argument("--experiments", nargs="+", help="Experiments to run. Defaults to all of them.")
+    parser.add_argument("--output", default="results", help="Directory of the results.")
+    parser.add_argument("--workers", type=int, help="Number of worker processes. Defaults to the number of CPUs.")
+    parser.add_argument("--dry-run", action="store_true", help="Print the planned jobs without running them.")
+    args = parser.parse_args(argv)
+
+    plan = plan_campaign(load_spec(args.spec), args.experiments)
+    print(plan)
+    if args.dry_run:
+        return 0
+    written = run_campaign(plan, args.output, workers=args.workers)
+    print(f"{sum(len(files) for files in written.values())} files written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
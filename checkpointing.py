@@ -0,0 +1,219 @@
+"""
+Checkpointed, resumable propagation for long runs.
+
+`source.propagate` keeps everything in memory until the end, so a 10^7-photon job interrupted after hours (crash,
+pre-emption of a batch node, wall-time limit) loses all its photons. `propagate_checkpointed` propagates the photons of
+the source in batches with the vectorized engines (planar slabs or meshes) and, every `interval` seconds, writes a
+checkpoint: the tallies of the logger (with `logger.save`, so a `BinnedEnergyLogger` keeps the checkpoints small
+whatever the number of photons), the state of the random generator and the number of photons done. Running the same
+call again resumes from the last checkpoint, and the resumed run gives exactly the results of an uninterrupted one.
+
+Each checkpoint is written to new files before the small state file pointing to them is atomically replaced, so an
+interruption while writing leaves the previous checkpoint intact. `read_checkpoint` loads the partial results of a job
+that is still running (or that was interrupted) into a logger, with a photon count matching the photons done, so they
+can be displayed with a `Viewer` as usual. SIGTERM, sent by most schedulers before pre-empting a job, stops the
+propagation cleanly after writing a last checkpoint.
+
+Usage:
+    for wavelength, properties in materials.items():
+        scene, source = build(properties)  # Sources must be seeded for resumed jobs to continue the same photons.
+        logger = BinnedEnergyLogger(scene)
+        progress = propagate_checkpointed(source, scene, logger, f"checkpoints/{wavelength}.ckpt", interval=300)
+        if not progress.completed:
+            sys.exit(1)  # Requeue the job, it will resume from its checkpoint.
+"""
+import os
+import pickle
+import signal
+import threading
+import time
+from dataclasses import dataclass
+
+import numpy as np
+from pytissueoptics import EnergyLogger
+
+from mesh_propagation import make_propagator
+from result_cache import experiment_key
+from slab_propagation import LayerStack
+
+DEFAULT_BATCH_SIZE = 100000
+DEFAULT_INTERVAL = 600
+
+CHECKPOINT_VERSION = 1
+
+
+@dataclass
+class CheckpointProgress:
+    photon_count: int
+    photons_done: int
+    duration: float
+    logger_path: str
+
+    @property
+    def completed(self) -> bool:
+        return self.photons_done >= self.photon_count
+
+    def __str__(self):
+        return (f"{self.photons_done}/{self.photon_count} photons ({self.photons_done / self.photon_count:.1%}) in "
+                f"{self.duration:.0f}s")
+
+
+def propagate_checkpointed(source, scene, logger: EnergyLogger, checkpoint: str, stack: LayerStack = None,
+                           batch_size: int = DEFAULT_BATCH_SIZE, interval: float = DEFAULT_INTERVAL,
+                           time_limit: float = None, show_progress: bool = True) -> CheckpointProgress:
+    """
+    Propagates the photons of the source in batches, writing a checkpoint every `interval` seconds, and resumes from
+    the checkpoint when there is one.
+
+    Args:
+        source (Source): The photon source. It must be seeded (or be the same object) for a resumed job to continue
+            the photons of the interrupted one; otherwise the remaining photons are redrawn.
+        scene (ScatteringScene): The scene, propagated as planar layers when possible or with a `MeshPropagator`.
+        logger (EnergyLogger): Logger receiving the interactions. It must be empty, and of the same type as the one of
+            the interrupted job when resuming. It is also saved to its own file, if any, once all photons are done.
+        checkpoint (str): Path of the checkpoint state file. The tallies are written next to it.
+        stack (LayerStack): Explicit layer stack, required for scenes with overlapping solids.
+        batch_size (int): Number of photons propagated together. Checkpoints are written between batches, and changing
+            the batch size changes the results.
+        interval (float): Minimum time between two checkpoints (s). A checkpoint is always written at the end.
+        time_limit (float): Stop after a checkpoint once this time (s) is exceeded, e.g. before the wall-time limit of
+            a batch job.
+        show_progress (bool): Print the progress at each checkpoint.
+
+    Returns:
+        CheckpointProgress: The photons done, which are all the photons of the source unless the job was stopped.
+    """
+    propagator = make_propagator(stack if stack is not None else scene, batch_size)
+    key = experiment_key(scene, source, engine=type(propagator).__name__, batch_size=batch_size,
+                         version=CHECKPOINT_VERSION)
+    state = _read_state(checkpoint)
+    if state is not None and state["key"] != key:
+        raise ValueError(f"The checkpoint '{checkpoint}' was written for another simulation. Delete it to start over.")
+
+    if state is None:
+        source_state = np.random.get_state()
+        positions, directions = source.getInitialPositionsAndDirections()
+        launch = propagator.prepare_launch(positions)
+        photon_count = logger.info.get("photonCount", 0)
+        propagator.prepare_logger(logger, source, positions)
+        rng = np.random.default_rng(getattr(source, "_seed", None))
+        photons_done, duration, generation = 0, 0.0, 0
+    else:
+        # The source draws from the global NumPy generator, which is restored to redraw the same initial photons.
+        source_state = state["source_state"]
+        np.random.set_state(source_state)
+        positions, directions = source.getInitialPositionsAndDirections()
+        launch = propagator.prepare_launch(positions)
+        _load_logger(logger, checkpoint, state)
+        photon_count = state["base_photon_count"]
+        rng = np.random.default_rng()
+        rng.bit_generator.state = state["rng"]
+        photons_done, duration, generation = state["photons_done"], state["duration"], state["generation"]
+
+    def write(done: int, elapsed: float):
+        nonlocal generation
+        generation += 1
+        logger.info["photonCount"] = photon_count + done
+        _write_checkpoint(checkpoint, logger, generation, {
+            "key": key, "source_state": source_state, "rng": rng.bit_generator.state, "photons_done": done,
+            "photon_count": len(positions), "base_photon_count": photon_count, "duration": elapsed,
+        })
+
+    if show_progress:
+        print(f"{'Resuming' if photons_done else 'Starting'} {len(positions)} photons at {photons_done} with "
+              f"checkpoints to {checkpoint}...")
+    t0 = time.time() - duration
+    last_checkpoint = time.time()
+    with _StopRequest() as stop:
+        while photons_done < len(positions):
+            stop_index = min(photons_done + batch_size, len(positions))
+            propagator.propagate_batch(positions[photons_done:stop_index], directions[photons_done:stop_index],
+                                       logger, rng, first_id=photons_done, **launch)
+            photons_done = stop_index
+            out_of_time = time_limit is not None and time.time() - t0 >= time_limit
+            if photons_done < len(positions) and time.time() - last_checkpoint < interval and \
+                    not out_of_time and not stop.requested:
+                continue
+            write(photons_done, time.time() - t0)
+            last_checkpoint = time.time()
+            if show_progress:
+                print(f"    Checkpoint: {photons_done}/{len(positions)} photons in {time.time() - t0:.0f}s")
+            if out_of_time or stop.requested:
+                break
+
+    if photons_done >= len(positions) and logger.hasFilePath:
+        logger.save()
+    return CheckpointProgress(len(positions), photons_done, time.time() - t0, _logger_path(checkpoint, generation))
+
+
+def read_checkpoint(checkpoint: str, logger: EnergyLogger = None) -> CheckpointProgress:
+    """
+    Reads the progress of a checkpointed job, which may still be running, and loads its partial tallies into the
+    given empty logger, if any. The photon count of the logger is the number of photons done.
+    """
+    state = _read_state(checkpoint)
+    if state is None:
+        raise FileNotFoundError(f"No checkpoint found at '{checkpoint}'.")
+    if logger is not None:
+        _load_logger(logger, checkpoint, state)
+    return CheckpointProgress(state["photon_count"], state["photons_done"], state["duration"],
+                              _logger_path(checkpoint, state["generation"]))
+
+
+class _StopRequest:
+    """Context in which SIGTERM sets `requested` instead of killing the process, when it can be handled."""
+
+    def __init__(self):
+        self.requested = False
+        self._previous = None
+
+    def __enter__(self):
+        if threading.current_thread() is threading.main_thread() and hasattr(signal, "SIGTERM"):
+            self._previous = signal.signal(signal.SIGTERM, self._request)
+        return self
+
+    def __exit__(self, *args):
+        if self._previous is not None:
+            signal.signal(signal.SIGTERM, self._previous)
+
+    def _request(self, signum, frame):
+        self.requested = True
+
+
+def _logger_path(checkpoint: str, generation: int) -> str:
+    return f"{checkpoint}.{generation}"
+
+
+def _read_state(checkpoint: str):
+    if not os.path.exists(checkpoint):
+        return None
+    with open(checkpoint, "rb") as file:
+        return pickle.load(file)
+
+
+def _write_checkpoint(checkpoint: str, logger: EnergyLogger, generation: int, state: dict):
+    directory = os.path.dirname(os.path.abspath(checkpoint))
+    os.makedirs(directory, exist_ok=True)
+    logger.save(_logger_path(checkpoint, generation))
+    state["generation"] = generation
+    temporary = f"{checkpoint}.tmp"
+    with open(temporary, "wb") as file:
+        pickle.dump(state, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, checkpoint)
+
+    # The previous generation is kept for readers which read the state just before it was replaced.
+    prefix = os.path.basename(checkpoint) + "."
+    for filename in os.listdir(directory):
+        number = filename[len(prefix):].split(".")[0]
+        if filename.startswith(prefix) and number.isdigit() and int(number) < generation - 1:
+            os.remove(os.path.join(directory, filename))
+
+
+def _load_logger(logger: EnergyLogger, checkpoint: str, state: dict):
+    if not logger.isEmpty:
+        raise ValueError("Checkpoints can only be loaded into an empty logger.")
+    filepath = logger._filepath
+    logger.load(_logger_path(checkpoint, state["generation"]))
+    logger._filepath = filepath
@@ -0,0 +1,177 @@
+"""
+Axisymmetric (r, z) energy logger for sources on the axis of laterally uniform layers.
+
+Every source of the task scripts is a `DivergentSource` on the z axis of planar layers, so the deposited energy only
+depends on the distance r to the axis and on the depth z. `CylindricalEnergyLogger` bins the deposition of each solid
+in (r, z) rings instead of x, y, z voxels: each ring collects all the samples around the axis, which lowers the
+variance per bin, and the memory of a solid is a small 2D array. The volumetric 2D views (projections and slices
+along X, Y or Z) are expanded back from the rings when they are displayed, each ring spreading its energy uniformly
+over the part of its volume inside the solid, so `Viewer.show2D`, `Viewer.show1D` and `Viewer.reportStats` work
+unchanged. Surface crossings are binned to the surface views as with `EnergyLogger(keep3D=False)`.
+
+Usage:
+    logger = CylindricalEnergyLogger(scene, radialBinSize=0.005, depthBinSize=0.002)
+    source.propagate(scene, logger=logger)
+    radii, depths, density = logger.getDensity("Dermis")
+    Viewer(scene, source, logger).show2D(View2DSliceZ(position=0.15, thickness=0.01))
+"""
+from typing import List, Tuple, Union
+
+import numpy as np
+from pytissueoptics import EnergyType, InteractionKey, ViewGroup
+from pytissueoptics.rayscattering import utils
+from pytissueoptics.rayscattering.display.views import View2D
+from pytissueoptics.scene import Logger
+
+from binned_logger import BinnedEnergyLogger
+
+# Number of expanded voxels along the radial bin size, so that every ring contains voxel centers.
+VOXELS_PER_RADIAL_BIN = 2
+
+
+class CylindricalEnergyLogger(BinnedEnergyLogger):
+    """
+    `BinnedEnergyLogger` accumulating the deposition of each solid in (r, z) grids around a vertical axis.
+
+    Args:
+        scene (ScatteringScene): The scene, as for `EnergyLogger`.
+        filepath (str): Optional file to load from and save to. The grids are saved next to it.
+        views: The 2D views to provide. Defaults to all the default views, required by `Stats`.
+        defaultViewEnergyType (EnergyType): Energy type of the default views.
+        defaultBinSize: Bin size of the 2D views (cm), as for `EnergyLogger`.
+        infiniteLimits: Limits used when the scene is infinite, as for `EnergyLogger`.
+        radialBinSize (float): Radial resolution of the grids (cm). Defaults to `defaultBinSize`.
+        depthBinSize (float): Depth resolution of the grids (cm). Defaults to `defaultBinSize`.
+        center (Tuple[float, float]): (x, y) position of the symmetry axis, usually the one of the source.
+    """
+
+    def __init__(self, scene, filepath: str = None, views: Union[ViewGroup, List[View2D]] = ViewGroup.ALL,
+                 defaultViewEnergyType: EnergyType = EnergyType.DEPOSITION, defaultBinSize: Union[float, tuple] = 0.01,
+                 infiniteLimits=((-5, 5), (-5, 5), (-5, 5)), radialBinSize: float = None, depthBinSize: float = None,
+                 center: Tuple[float, float] = (0, 0)):
+        default = float(np.min(defaultBinSize))
+        radialBinSize = default if radialBinSize is None else radialBinSize
+        depthBinSize = default if depthBinSize is None else depthBinSize
+        self._center = np.asarray(center, dtype=float)
+        super().__init__(scene, filepath=filepath, views=views, defaultViewEnergyType=defaultViewEnergyType,
+                         defaultBinSize=defaultBinSize, infiniteLimits=infiniteLimits,
+                         gridBinSize=(radialBinSize, radialBinSize, depthBinSize))
+
+    @property
+    def views(self) -> List[View2D]:
+        self._compileViews([view for view in self._views if view in self._outdatedViews])
+        return self._views
+
+    def getGrid(self, solidLabel: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the ((0, r_max), (z_min, z_max)) limits and the (r, z) grid of the energy deposited in a solid, or None
+        if nothing was deposited in it.
+        """
+        return super().getGrid(solidLabel)
+
+    def getDensity(self, solidLabel: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Energy deposited per unit volume (1/cm^3) in each (r, z) ring of a solid, obtained by dividing each ring by
+        its volume 2πr dr dz. Rings crossing the lateral faces of the solid are divided by their full volume.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: Edges of the radial bins, edges of the depth bins and the
+            density.
+        """
+        grid = self.getGrid(solidLabel)
+        if grid is None:
+            raise ValueError(f"No energy was deposited in solid '{solidLabel}'.")
+        limits, energy = grid
+        radii = limits[0, 0] + np.arange(energy.shape[0] + 1) * self._gridBinSize[0]
+        depths = limits[1, 0] + np.arange(energy.shape[1] + 1) * self._gridBinSize[2]
+        volumes = np.pi * np.diff(radii ** 2)[:, None] * self._gridBinSize[2]
+        return radii, depths, energy / volumes
+
+    def logDataPointArray(self, array: np.ndarray, key: InteractionKey):
+        positive = array[:, 0] > 0
+        totals = self._totals.setdefault(key, np.zeros(2))
+        totals += (array[positive, 0].sum(), array[~positive, 0].sum())
+        if not key.volumetric or key.solidLabel is None:
+            # Surface crossings are binned to the surface views only; volumetric views are expanded from the grids.
+            Logger.logDataPointArray(self, array, key)
+            self._compileViews([view for view in self._views if view.surfaceLabel is not None])
+            self._delete3DData()
+            return
+        # Registers the solid for `Stats` without storing its 3D data.
+        self._labels.setdefault(key.solidLabel, [])
+        self._accumulate(array, key.solidLabel)
+        self._nDataPointsRemoved += len(array)
+        self._outdatedViews.update(view for view in self._views if view.surfaceLabel is None)
+
+    def addView(self, view: View2D) -> bool:
+        """Adds a view. Volumetric views are expanded from the (r, z) grids when they are first displayed."""
+        self._viewFactory.build([view])
+        if view.surfaceLabel is not None or self.isEmpty:
+            return super().addView(view)
+        if not self._viewExists(view):
+            self._views.append(view)
+            self._outdatedViews.add(view)
+        return True
+
+    def _compileViews(self, views: List[View2D], detectedBy: Union[str, List[str]] = None):
+        surface_views = [view for view in views if view.surfaceLabel is not None]
+        if surface_views:
+            super()._compileViews(surface_views, detectedBy)
+        for view in views:
+            if view.surfaceLabel is not None:
+                continue
+            view._dataUV[:] = 0
+            view._hasData = False
+            self._extract_from_grids(view)
+            self._outdatedViews.discard(view)
+
+    def _accumulate(self, array: np.ndarray, solid_label: str):
+        if solid_label not in self._grids:
+            self._grids[solid_label] = self._create_grid(solid_label)
+        limits, grid = self._grids[solid_label]
+        radius = np.hypot(array[:, 1] - self._center[0], array[:, 2] - self._center[1])
+        indices = np.floor((np.column_stack((radius, array[:, 3])) - limits[:, 0]) / self._gridBinSize[[0, 2]])
+        indices = np.clip(indices.astype(np.int64), 0, np.array(grid.shape) - 1)
+        flat_indices = np.ravel_multi_index(indices.T, grid.shape)
+        grid += np.bincount(flat_indices, weights=array[:, 0], minlength=grid.size).reshape(grid.shape)
+
+    def _create_grid(self, solid_label: str) -> Tuple[np.ndarray, np.ndarray]:
+        xy_limits, z_limits = self._solid_limits(solid_label)
+        # The grid covers the farthest corner of the solid from the axis.
+        corners = np.abs(xy_limits - self._center[:, None])
+        r_max = np.hypot(*corners.max(axis=1))
+        limits = np.array([[0, r_max], z_limits], dtype=float)
+        bin_size = self._gridBinSize[[0, 2]]
+        bins = np.maximum(1, np.ceil((limits[:, 1] - limits[:, 0]) / bin_size - 1e-9)).astype(int)
+        limits[:, 1] = limits[:, 0] + bins * bin_size
+        return limits, np.zeros(bins, dtype=np.float32)
+
+    def _solid_limits(self, solid_label: str) -> Tuple[np.ndarray, np.ndarray]:
+        solid = self._scene.getSolid(solid_label)
+        limits = np.asarray(solid.getBoundingBox().xyzLimits if solid else self._infiniteLimits, dtype=float)
+        return limits[:2], limits[2]
+
+    def _extract_from_grids(self, view: View2D):
+        """Spreads the energy of each ring uniformly over the voxels of the solid whose center falls in the ring."""
+        voxel_size = self._gridBinSize[0] / VOXELS_PER_RADIAL_BIN
+        for solid_label, (limits, grid) in self._grids.items():
+            if view.solidLabel and not utils.labelsEqual(view.solidLabel, solid_label):
+                continue
+            xy_limits, _ = self._solid_limits(solid_label)
+            x, y = (np.arange(low + voxel_size / 2, high, voxel_size) for low, high in xy_limits)
+            x, y = np.meshgrid(x, y, indexing="ij")
+            ring = np.floor(np.hypot(x - self._center[0], y - self._center[1]) / self._gridBinSize[0]).astype(np.int64)
+            ring = np.minimum(ring, grid.shape[0] - 1).ravel()
+            voxels_per_ring = np.bincount(ring, minlength=grid.shape[0])
+            z_centers = limits[1, 0] + (np.arange(grid.shape[1]) + 0.5) * self._gridBinSize[2]
+
+            # One depth bin at a time to bound the number of expanded points.
+            for z_index in np.nonzero(grid.any(axis=0))[0]:
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    values = np.where(voxels_per_ring > 0, grid[:, z_index] / voxels_per_ring, 0)[ring]
+                inside = values != 0
+                data_points = np.column_stack((values[inside], x.ravel()[inside], y.ravel()[inside],
+                                               np.full(np.count_nonzero(inside), z_centers[z_index])))
+                if view.energyType == EnergyType.FLUENCE_RATE:
+                    data_points = self._fluenceTransform(InteractionKey(solid_label), data_points)
+                view.extractData(data_points)
@@ -0,0 +1,189 @@
+"""
+Depth-attenuation profiles and energy-loss depths computed from simulation tallies.
+
+A `DepthTally` bins the deposited energy by depth below the tissue surface as it is logged, without keeping any point
+cloud, so that its memory use does not depend on the number of photons. The bins are kept separately for interleaved
+groups of photons, from which the uncertainty of the depths where 50% and 90% of the energy is lost is estimated by
+bootstrap.
+
+Usage:
+    tallies = {wavelength: DepthTally.from_stack(stack) for wavelength in materials}
+    SpectralPropagator(stack, materials).propagate(source, tallies)
+    print(loss_depth_table(tallies))
+    plot_depth_profiles(tallies)
+"""
+from typing import Dict, Iterable, Tuple
+
+import matplotlib.pyplot as plt
+import numpy as np
+from pytissueoptics import InteractionKey
+
+from slab_propagation import LayerStack
+
+DEFAULT_LEVELS = (0.5, 0.9)
+
+
+class DepthTally:
+    """
+    Deposited energy binned by depth, for `n_groups` interleaved photon groups (photon ID modulo `n_groups`).
+
+    It has the `logDataPointArray` interface of a logger and can be given to a propagator instead of an
+    `EnergyLogger`. Only volumetric deposition is tallied; energy deposited deeper than `max_depth` is kept in an
+    overflow bin so that the fractions remain relative to the total deposited energy.
+
+    Args:
+        z_surface (float): Z coordinate of the tissue surface (depth 0).
+        max_depth (float): Depth covered by the bins (cm).
+        bin_size (float): Depth resolution (cm).
+        n_groups (int): Number of photon groups used for the bootstrap.
+    """
+    hasFilePath = False
+
+    def __init__(self, z_surface: float = 0, max_depth: float = 0.3, bin_size: float = 0.001, n_groups: int = 100):
+        self.info = {}
+        self._z_surface = z_surface
+        self._bin_size = bin_size
+        self._n_bins = max(1, int(round(max_depth / bin_size)))
+        self._n_groups = n_groups
+        self._energy = np.zeros((n_groups, self._n_bins + 1))
+
+    @classmethod
+    def from_stack(cls, stack: LayerStack, bin_size: float = 0.001, n_groups: int = 100) -> "DepthTally":
+        """Tally covering the whole depth of a layer stack."""
+        return cls(stack.z_top, stack.z_bottom - stack.z_top, bin_size, n_groups)
+
+    @classmethod
+    def from_logger(cls, logger, z_surface: float = 0, max_depth: float = 0.3, bin_size: float = 0.001,
+                    n_groups: int = 100) -> "DepthTally":
+        """Tally of the 3D data points already stored in a logger, one interaction key at a time."""
+        tally = cls(z_surface, max_depth, bin_size, n_groups)
+        tally.info["photonCount"] = logger.info.get("photonCount")
+        for key, data in logger._data.items():
+            if data.dataPoints is not None and len(data.dataPoints) > 0:
+                tally.logDataPointArray(data.dataPoints.getData(), key)
+        return tally
+
+    @property
+    def depths(self) -> np.ndarray:
+        """Depth of the bin edges, starting at the surface."""
+        return np.arange(self._n_bins + 1) * self._bin_size
+
+    @property
+    def bin_size(self) -> float:
+        return self._bin_size
+
+    @property
+    def n_groups(self) -> int:
+        return self._n_groups
+
+    @property
+    def total_energy(self) -> float:
+        return float(self._energy.sum())
+
+    def logDataPointArray(self, array: np.ndarray, key: InteractionKey):
+        """Adds (value, x, y, z[, photonID]) data points. Surface crossings are ignored."""
+        if key.surfaceLabel is not None or len(array) == 0:
+            return
+        bins = np.clip(np.floor((array[:, 3] - self._z_surface) / self._bin_size), 0, self._n_bins).astype(np.int64)
+        if array.shape[1] > 4:
+            groups = array[:, 4].astype(np.int64) % self._n_groups
+        else:
+            # Without photon IDs, rows are spread over the groups, which underestimates the uncertainty.
+            groups = np.arange(len(array)) % self._n_groups
+        self._energy += np.bincount(groups * (self._n_bins + 1) + bins, weights=array[:, 0],
+                                    minlength=self._energy.size).reshape(self._energy.shape)
+
+    def merge(self, other: "DepthTally") -> "DepthTally":
+        """Adds the energy of an independent tally with the same bins."""
+        if other._energy.shape != self._energy.shape or other._bin_size != self._bin_size:
+            raise ValueError("Can only merge depth tallies with the same bins and number of groups.")
+        self._energy += other._energy
+        self.info["photonCount"] = self.info.get("photonCount", 0) + other.info.get("photonCount", 0)
+        return self
+
+    def lost_fraction(self, energy: np.ndarray = None) -> np.ndarray:
+        """Cumulative fraction of the deposited energy lost above each depth of `depths`."""
+        energy = self._energy.sum(axis=0) if energy is None else energy
+        cumulative = np.concatenate(([0], np.cumsum(energy[:-1])))
+        total = energy.sum()
+        return cumulative / total if total > 0 else cumulative
+
+    def remaining_fraction(self) -> np.ndarray:
+        """Fraction of the deposited energy still to be lost below each depth of `depths`."""
+        return 1 - self.lost_fraction()
+
+    def loss_depth(self, level: float, energy: np.ndarray = None) -> float:
+        """Depth at which the given fraction of the deposited energy is lost, linearly interpolated between bins."""
+        lost = self.lost_fraction(energy)
+        if lost[-1] < level:
+            return np.nan
+        index = int(np.searchsorted(lost, level))
+        if index == 0:
+            return 0.0
+        low, high = lost[index - 1], lost[index]
+        return float(self.depths[index - 1] + self._bin_size * (level - low) / (high - low))
+
+    def loss_depths(self, levels: Iterable[float] = DEFAULT_LEVELS, n_bootstrap: int = 1000,
+                    confidence: float = 0.95, rng: np.random.Generator = None) -> Dict[float, Tuple[float, float, float]]:
+        """
+        Loss depths with their bootstrap confidence interval, obtained by resampling the photon groups.
+
+        Returns:
+            Dict[float, Tuple[float, float, float]]: (depth, lower bound, upper bound) for each level.
+        """
+        rng = rng or np.random.default_rng()
+        samples = rng.integers(0, self._n_groups, size=(n_bootstrap, self._n_groups))
+        resampled = np.stack([self._energy[sample].sum(axis=0) for sample in samples])
+        tail = 50 * (1 - confidence)
+        results = {}
+        for level in levels:
+            bootstrap = [self.loss_depth(level, energy) for energy in resampled]
+            low, high = np.nanpercentile(bootstrap, [tail, 100 - tail])
+            results[level] = (self.loss_depth(level), float(low), float(high))
+        return results
+
+
+def loss_depth_table(tallies: Dict[str, DepthTally], levels: Iterable[float] = DEFAULT_LEVELS,
+                     confidence: float = 0.95, **bootstrap_kwargs) -> str:
+    """
+    Formats the loss depths of each tally as a table, one row per tally and one column per level.
+
+    Args:
+        tallies (Dict[str, DepthTally]): Tallies keyed by the name of their row, e.g. "Blue - Task 3".
+        levels (Iterable[float]): Fractions of the deposited energy.
+        confidence (float): Confidence level of the bootstrap intervals.
+        **bootstrap_kwargs: Forwarded to `DepthTally.loss_depths`.
+    """
+    levels = list(levels)
+    name_width = max([len(name) for name in tallies] + [4])
+    header = f"{'Name':<{name_width}}" + "".join(f" | {f'{level:.0%} loss depth (cm) [{confidence:.0%} CI]':<36}"
+                                             for level in levels)
+    lines = [header.rstrip(), "-" * len(header.rstrip())]
+    for name, tally in tallies.items():
+        depths = tally.loss_depths(levels, confidence=confidence, **bootstrap_kwargs)
+        cells = [f"{depth:.4f} [{low:.4f}, {high:.4f}]" for depth, low, high in (depths[level] for level in levels)]
+        lines.append((f"{name:<{name_width}}" + "".join(f" | {cell:<36}" for cell in cells)).rstrip())
+    return "\n".join(lines)
+
+
+def plot_depth_profiles(tallies: Dict[str, DepthTally], linestyles: Dict[str, str] = None, title: str = None,
+                        filepath: str = None):
+    """
+    Overlays the remaining fraction of the deposited energy as a function of depth for each tally. The figure is
+    saved to `filepath` if given, otherwise it is shown.
+    """
+    linestyles = linestyles or {}
+    plt.figure(figsize=(12, 8))
+    for name, tally in tallies.items():
+        plt.plot(tally.depths, tally.remaining_fraction(), label=name, linestyle=linestyles.get(name, "-"))
+    plt.xlabel("Depth (cm)")
+    plt.ylabel("Relative Energy")
+    if title:
+        plt.title(title)
+    plt.legend()
+    plt.grid(True)
+    if filepath:
+        plt.savefig(filepath)
+        plt.close()
+    else:
+        plt.show()
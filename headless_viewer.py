@@ -0,0 +1,155 @@
+"""
+Headless rendering of the `Viewer` 2D views and 1D profiles to files.
+
+The task scripts end with blocking `viewer.show2D(...)` and `viewer.show1D(...)` calls which open one window per view
+and cannot run without a display. `HeadlessViewer` accepts the same calls but only queues them; `render()` then
+compiles all the requested views in a single pass over the logged data and writes each of them as a PNG image, along
+with its raw binned values as a `.npy` array. Figures are drawn with the matplotlib Agg canvas directly, so no GUI
+backend is ever selected.
+
+Usage:
+    viewer = HeadlessViewer(scene, source, logger, output_dir="figures/Blue")
+    viewer.show2D(View2DSliceZ(position=0.05, thickness=0.01, limits=((-1, 1), (-1, 1))))
+    viewer.show1D(Direction.X_POS)
+    viewer.render()
+"""
+import copy
+import os
+import re
+import warnings
+from typing import List
+
+import matplotlib
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from pytissueoptics import Direction, EnergyLogger, EnergyType
+from pytissueoptics.rayscattering.display.views import View2D
+
+from cached_views import CachedViewer
+
+
+class HeadlessViewer(CachedViewer):
+    """
+    `Viewer` writing its 2D views and 1D profiles to files instead of showing them.
+
+    Args:
+        scene (ScatteringScene): The scene, as for `Viewer`.
+        source (Source): The source, as for `Viewer`.
+        logger (EnergyLogger): The logger holding the data to render.
+        output_dir (str): Directory of the written files, created if needed.
+        prefix (str): Prefix of every file name, e.g. the wavelength of the run.
+        dpi (int): Resolution of the PNG images.
+    """
+
+    def __init__(self, scene, source, logger: EnergyLogger, output_dir: str = "figures", prefix: str = "",
+                 dpi: int = 150):
+        super().__init__(scene, source, logger)
+        self._output_dir = output_dir
+        self._prefix = prefix
+        self._dpi = dpi
+        self._requests: List[tuple] = []
+
+    def show2D(self, view: View2D = None, viewIndex: int = None, logScale: bool = True, colormap: str = "viridis"):
+        """Queues a 2D view (given or by index) for `render()`."""
+        assert viewIndex is not None or view is not None, "Either `viewIndex` or `view` must be specified."
+        self._requests.append(("2D", dict(view=view, viewIndex=viewIndex, logScale=logScale, colormap=colormap)))
+
+    def show1D(self, along: Direction, logScale: bool = True, solidLabel: str = None, surfaceLabel: str = None,
+               surfaceEnergyLeaving: bool = True, limits=None, binSize: float = None,
+               energyType: EnergyType = EnergyType.DEPOSITION):
+        """Queues a 1D profile for `render()`."""
+        self._requests.append(("1D", dict(along=along, logScale=logScale, solidLabel=solidLabel,
+                                          surfaceLabel=surfaceLabel, surfaceEnergyLeaving=surfaceEnergyLeaving,
+                                          limits=limits, binSize=binSize, energyType=energyType)))
+
+    def show3D(self, *args, **kwargs):
+        warnings.warn("WARNING: Skipping show3D() in headless mode.")
+
+    def show3DVolumeSlicer(self, *args, **kwargs):
+        warnings.warn("WARNING: Skipping show3DVolumeSlicer() in headless mode.")
+
+    def render(self) -> List[str]:
+        """
+        Compiles every queued view at once and writes them to the output directory as `<index>_<name>.png` and
+        `<index>_<name>.npy`. The queue is emptied.
+
+        Returns:
+            List[str]: The written PNG files, in the order of the requests.
+        """
+        os.makedirs(self._output_dir, exist_ok=True)
+        views = {}
+        for index, (kind, request) in enumerate(self._requests):
+            if kind == "2D":
+                views[index] = self._get_view(request["view"], request["viewIndex"])
+        # Single pass over the logged 3D data for all the views requiring it.
+        outdated = [view for view in views.values() if view is not None and view in self._logger._outdatedViews]
+        if outdated:
+            self._logger._compileViews(outdated)
+
+        filepaths = []
+        for index, (kind, request) in enumerate(self._requests):
+            if kind == "2D":
+                if views[index] is None:
+                    continue
+                filepaths.append(self._save_view(index, views[index], request["logScale"], request["colormap"]))
+            else:
+                filepaths.append(self._save_profile(index, **request))
+        self._requests = []
+        return filepaths
+
+    def _get_view(self, view: View2D, viewIndex: int):
+        if viewIndex is None:
+            if not self._logger.addView(view):
+                warnings.warn(f"ERROR: Cannot render view {view.name}. Failed to create the view.")
+                return None
+            viewIndex = self._logger._getViewIndex(view)
+        return self._logger.getView(viewIndex)
+
+    def _save_view(self, index: int, view: View2D, logScale: bool, colormap: str) -> str:
+        filepath = self._filepath(index, view.name, view.displayPosition)
+        np.save(filepath + ".npy", view.getImageData(logScale=False))
+
+        cmap = copy.copy(matplotlib.colormaps[colormap])
+        cmap.set_bad(cmap.colors[0])
+        figure = Figure()
+        axes = figure.add_subplot()
+        # N.B.: imshow() expects the data to be (y, x), so we need to transpose the array.
+        axes.imshow(view.getImageData(logScale=logScale).T, cmap=cmap, extent=view.limitsU + view.limitsV)
+        axes.set_title(view.name)
+        axes.set_xlabel("xyz"[view.axisU])
+        axes.set_ylabel("xyz"[view.axisV])
+        return self._save_figure(figure, filepath)
+
+    def _save_profile(self, index: int, along: Direction, logScale: bool, **kwargs) -> str:
+        profile = self._profileFactory.create(along, **kwargs)
+        filepath = self._filepath(index, profile.name)
+        limits = sorted(profile.limits)
+        data = profile.data
+        if along.isNegative:
+            data = np.flip(data, axis=0)
+            limits = (limits[1], limits[0])
+        np.save(filepath + ".npy", data)
+
+        figure = Figure()
+        axes = figure.add_subplot()
+        bins = np.linspace(limits[0], limits[1], data.size + 1)[:-1]
+        axes.bar(bins, data, width=np.diff(bins)[0], align="edge")
+        if logScale:
+            axes.set_yscale("log")
+        axes.set_title(profile.name)
+        axes.set_xlim(*limits)
+        axes.set_xlabel("xyz"[along.axis])
+        axes.set_ylabel("Deposited energy" if profile.energyType == EnergyType.DEPOSITION else "Fluence rate")
+        return self._save_figure(figure, filepath)
+
+    def _save_figure(self, figure: Figure, filepath: str) -> str:
+        FigureCanvasAgg(figure)
+        figure.savefig(filepath + ".png", dpi=self._dpi)
+        return filepath + ".png"
+
+    def _filepath(self, index: int, name: str, position: float = None) -> str:
+        if position is not None:
+            name += f" at {position:g}"
+        slug = re.sub(r"[^0-9A-Za-z.]+", "_", name).strip("_")
+        return os.path.join(self._output_dir, f"{self._prefix}{index:02d}_{slug}")
@@ -0,0 +1,392 @@
+"""
+Precomputed reflectance, absorbance and depth-profile lookup tables for inverse fitting.
+
+Fitting measured skin spectra searches for the per-layer `mu_a` and `mu_s` and the epidermis thickness (the variable of
+task4.py), which is far too slow with a propagation inside the optimizer loop. `build_lookup_table` tabulates a layer
+stack over a grid of per-layer parameters ("<layer>.<parameter>" with mu_a, mu_s, mu_s_prime = mu_s (1 - g), g or
+thickness) and stores, for every grid point, the diffuse reflectance, the transmittance, the absorbance of each layer
+and the depth profile of the deposited energy.
+
+The absorption axes cost almost nothing: each point of the other (scattering) axes is propagated once without
+absorption with a `PathLengthRecorder`, and every combination of absorption coefficients is reweighted from that
+record at once (see absorption_reweighting.py). All the records launch the same photons with the same random
+generator, so neighbouring grid points are correlated and the table is smooth along the scattering axes too. Each
+value comes with its Monte Carlo standard error, estimated from the spread of interleaved groups of photons.
+
+The results are written as raw `.npy` arrays next to a small `lut.json` index, and `LookupTable` memory-maps them, so
+a large table is opened instantly and only the pages it reads are loaded. `LookupTable.interpolate` is a vectorized
+multilinear interpolation over the grid, answering thousands of queries per millisecond. The standard errors are
+interpolated in the same way, which is exact when the corner values are fully correlated (as along the absorption axes,
+reweighted from the same photons) and an upper bound otherwise. Queries outside the grid return NaN.
+
+Usage:
+    axes = {"Epidermis.mu_a": np.geomspace(0.5, 8, 9), "Dermis.mu_a": np.geomspace(0.1, 3, 9),
+            "Dermis.mu_s_prime": [6, 9, 12], "Epidermis.thickness": [0.05, 0.075, 0.1]}
+    build_lookup_table(source, "luts/skin", axes, scene=scene)
+    table = LookupTable("luts/skin")
+    reflectance, error = table.interpolate(points, outputs=["reflectance"])["reflectance"]
+"""
+import dataclasses
+import itertools
+import json
+import os
+import shutil
+import time
+from typing import Dict, List, Sequence, Tuple, Union
+
+import numpy as np
+from pytissueoptics import InteractionKey, ScatteringMaterial
+
+from absorption_reweighting import PathLengthRecord, PathLengthRecorder
+from slab_propagation import LayerStack
+
+PARAMETERS = ("mu_a", "mu_s", "mu_s_prime", "g", "thickness")
+OUTPUTS = ("reflectance", "transmittance", "absorbance", "depth_profile")
+
+DEFAULT_DEPTH_BIN_SIZE = 0.005
+DEFAULT_GROUPS = 32
+
+# Maximum number of float64 values of the weight matrix (interactions x absorption sets) reweighted at once.
+MAX_WEIGHT_VALUES = 2 ** 22
+
+INDEX_FILENAME = "lut.json"
+
+
+def build_lookup_table(source, directory: str, axes: Dict[str, Sequence[float]], scene=None,
+                       stack: LayerStack = None, depth_bin_size: float = DEFAULT_DEPTH_BIN_SIZE,
+                       n_groups: int = DEFAULT_GROUPS, max_path_length: float = None,
+                       show_progress: bool = True) -> "LookupTable":
+    """
+    Tabulates the results of a layer stack over a grid of layer parameters and writes them to `directory`.
+
+    Args:
+        source (Source): The photon source, launched for each point of the scattering axes.
+        directory (str): Directory of the table, replaced if it exists.
+        axes (Dict[str, Sequence[float]]): Increasing values of each tabulated parameter, keyed by
+            "<layer label>.<parameter>" (case-insensitive label) with a parameter among `PARAMETERS`. The other
+            parameters keep the values of the stack. A layer cannot have both a mu_s and a mu_s_prime axis.
+        scene (ScatteringScene): Used to detect the layer stack when `stack` is not given.
+        stack (LayerStack): Explicit layer stack, e.g. for the overlapping models of task5.py and task8.py.
+        depth_bin_size (float): Bin size of the depth profiles (cm). They span the thickest stack of the grid.
+        n_groups (int): Number of interleaved photon groups used to estimate the standard errors.
+        max_path_length (float): Optional path length cutoff of the absorption-free records (cm), see
+            `PathLengthRecorder`.
+        show_progress (bool): Print the progress over the scattering points.
+
+    Returns:
+        LookupTable: The written table.
+    """
+    if stack is None:
+        stack = LayerStack.from_scene(scene)
+    grid = _TableGrid(stack, axes)
+    photon_count = source.getPhotonCount()
+    if photon_count < 2 * n_groups:
+        raise ValueError(f"At least {2 * n_groups} photons are required to estimate errors from {n_groups} groups.")
+    depth_edges = np.arange(0, grid.max_thickness + depth_bin_size, depth_bin_size)
+
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    channels = {"reflectance": (), "transmittance": (), "absorbance": (len(stack.layers),),
+                "depth_profile": (len(depth_edges) - 1,)}
+    arrays = {}
+    for name, shape in channels.items():
+        for suffix in ("", "_error"):
+            arrays[name + suffix] = np.lib.format.open_memmap(os.path.join(directory, f"{name}{suffix}.npy"), "w+",
+                                                              np.float32, grid.shape + shape)
+
+    # Same initial photons and random generator for every scattering point.
+    source_state = np.random.get_state()
+    seed = getattr(source, "_seed", None)
+    t0 = time.time()
+    scattering_points = list(itertools.product(*(range(len(grid.values[name])) for name in grid.scattering)))
+    for count, point in enumerate(scattering_points):
+        np.random.set_state(source_state)
+        configured = grid.stack_at(dict(zip(grid.scattering, point)))
+        recorder = PathLengthRecorder(configured, spatial=True, max_path_length=max_path_length)
+        record = recorder.record(source, show_progress=False, rng=np.random.default_rng(seed))
+        results = _tabulate(record, grid.absorption_sets(), depth_edges, n_groups)
+        for name, values in results.items():
+            # Writes the (absorption sets, ...) results through a view of the table with the axes of this point
+            # first, in the same order as the product of the absorption axes.
+            view = np.moveaxis(arrays[name], grid.scattering_positions + grid.absorption_positions,
+                               range(len(grid.names)))
+            view[point] = values.reshape(grid.absorption_shape + values.shape[1:])
+        if show_progress:
+            print(f"    {count + 1}/{len(scattering_points)} scattering points in {time.time() - t0:.1f}s")
+
+    for array in arrays.values():
+        array.flush()
+    index = {"axes": {name: [float(value) for value in values] for name, values in grid.values.items()},
+             "outputs": list(channels), "layers": stack.labels, "depth_edges": depth_edges.tolist(),
+             "photon_count": photon_count, "n_groups": n_groups, "created": time.time()}
+    # The index is written last, so an interrupted build is never mistaken for a complete table.
+    with open(os.path.join(directory, INDEX_FILENAME), "w") as file:
+        json.dump(index, file, indent=2)
+    return LookupTable(directory)
+
+
+class LookupTable:
+    """
+    Memory-mapped table written by `build_lookup_table`.
+
+    Args:
+        directory (str): Directory of the table.
+    """
+
+    def __init__(self, directory: str):
+        index_path = os.path.join(directory, INDEX_FILENAME)
+        if not os.path.exists(index_path):
+            raise FileNotFoundError(f"No complete lookup table found in '{directory}'.")
+        with open(index_path) as file:
+            index = json.load(file)
+        self._directory = directory
+        self.axes = {name: np.array(values) for name, values in index["axes"].items()}
+        self.layers: List[str] = index["layers"]
+        self.depth_edges = np.array(index["depth_edges"])
+        self.photon_count: int = index["photon_count"]
+        self.values = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+                       for name in index["outputs"]}
+        self.errors = {name: np.load(os.path.join(directory, f"{name}_error.npy"), mmap_mode="r")
+                       for name in index["outputs"]}
+
+        self._names = list(self.axes)
+        self._strides = np.cumprod([1] + [len(values) for values in self.axes.values()][:0:-1])[::-1]
+        self._varying = [d for d, values in enumerate(self.axes.values()) if len(values) > 1]
+
+    @property
+    def names(self) -> List[str]:
+        """Names of the axes, in the order of the columns of the query points."""
+        return list(self._names)
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return tuple(len(values) for values in self.axes.values())
+
+    @property
+    def depths(self) -> np.ndarray:
+        """Depth below the surface of the center of each bin of the depth profiles (cm)."""
+        return (self.depth_edges[:-1] + self.depth_edges[1:]) / 2
+
+    def interpolate(self, points: Union[np.ndarray, Dict[str, np.ndarray]],
+                    outputs: Sequence[str] = None) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        """
+        Multilinear interpolation of the tabulated results and of their standard errors.
+
+        Args:
+            points: Query points, as a (queries, axes) array with the columns in the order of `names`, or as a dict of
+                arrays keyed by axis name.
+            outputs (Sequence[str]): Outputs to interpolate, among `OUTPUTS`. Defaults to all of them; requesting
+                fewer is faster.
+
+        Returns:
+            Dict[str, Tuple[np.ndarray, np.ndarray]]: (values, standard errors) of each output, of shape (queries,)
+            for the reflectance and the transmittance, (queries, layers) for the absorbance and (queries, depth bins)
+            for the depth profile. Queries outside the grid are NaN.
+        """
+        points = self._points(points)
+        outputs = list(self.values) if outputs is None else list(outputs)
+        unknown = set(outputs) - set(self.values)
+        if unknown:
+            raise ValueError(f"Unknown outputs {sorted(unknown)}. Use some of {list(self.values)}.")
+
+        base = np.zeros(len(points), np.intp)
+        fractions = {}
+        inside = np.ones(len(points), bool)
+        for d, values in enumerate(self.axes.values()):
+            inside &= (points[:, d] >= values[0]) & (points[:, d] <= values[-1])
+            if d not in self._varying:
+                continue
+            lower = np.clip(np.searchsorted(values, points[:, d], side="right") - 1, 0, len(values) - 2)
+            fractions[d] = (points[:, d] - values[lower]) / (values[lower + 1] - values[lower])
+            base += lower * self._strides[d]
+
+        flat = {}
+        for name in outputs:
+            for kind, arrays in (("values", self.values), ("errors", self.errors)):
+                array = arrays[name]
+                flat[name, kind] = array.reshape(int(np.prod(self.shape)), -1)
+        results = {key: np.zeros((len(points), array.shape[1])) for key, array in flat.items()}
+        for corner in itertools.product((0, 1), repeat=len(self._varying)):
+            index = base.copy()
+            weight = np.ones(len(points))
+            for d, upper in zip(self._varying, corner):
+                if upper:
+                    index += self._strides[d]
+                    weight *= fractions[d]
+                else:
+                    weight *= 1 - fractions[d]
+            for key, array in flat.items():
+                results[key] += weight[:, None] * array[index]
+
+        interpolated = {}
+        for name in outputs:
+            values, errors = results[name, "values"], results[name, "errors"]
+            values[~inside], errors[~inside] = np.nan, np.nan
+            if self.values[name].ndim == len(self.shape):
+                values, errors = values[:, 0], errors[:, 0]
+            interpolated[name] = (values, errors)
+        return interpolated
+
+    def _points(self, points) -> np.ndarray:
+        if isinstance(points, dict):
+            missing = set(self._names) - set(points)
+            if missing:
+                raise ValueError(f"Missing values for the axes {sorted(missing)}.")
+            return np.column_stack([np.atleast_1d(np.asarray(points[name], dtype=float)) for name in self._names])
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        if points.shape[1] != len(self._names):
+            raise ValueError(f"Expected {len(self._names)} columns ({', '.join(self._names)}), got "
+                             f"{points.shape[1]}.")
+        return points
+
+
+class _TableGrid:
+    """Parsed axes of a table: which layer parameter each one changes, and the layer stack at a grid point."""
+
+    def __init__(self, stack: LayerStack, axes: Dict[str, Sequence[float]]):
+        if not axes:
+            raise ValueError("A lookup table requires at least one axis.")
+        self.stack = stack
+        self.names = list(axes)
+        self.values = {name: np.asarray(values, dtype=float) for name, values in axes.items()}
+        labels = {label.lower(): index for index, label in enumerate(stack.labels)}
+        self.targets = {}
+        for name, values in self.values.items():
+            label, _, parameter = name.rpartition(".")
+            if label.lower() not in labels or parameter not in PARAMETERS:
+                raise ValueError(f"Invalid axis '{name}'. Expected '<layer>.<parameter>' with a layer among "
+                                 f"{stack.labels} and a parameter among {PARAMETERS}.")
+            if values.ndim != 1 or len(values) == 0 or np.any(np.diff(values) <= 0):
+                raise ValueError(f"The values of axis '{name}' must be strictly increasing.")
+            self.targets[name] = (labels[label.lower()], parameter)
+        for layer in range(len(stack.layers)):
+            parameters = [parameter for index, parameter in self.targets.values() if index == layer]
+            if "mu_s" in parameters and "mu_s_prime" in parameters:
+                raise ValueError(f"Layer '{stack.labels[layer]}' cannot have both a mu_s and a mu_s_prime axis.")
+
+        self.absorption = [name for name in self.names if self.targets[name][1] == "mu_a"]
+        self.scattering = [name for name in self.names if self.targets[name][1] != "mu_a"]
+        self.absorption_positions = [self.names.index(name) for name in self.absorption]
+        self.scattering_positions = [self.names.index(name) for name in self.scattering]
+        self.absorption_shape = tuple(len(self.values[name]) for name in self.absorption)
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return tuple(len(self.values[name]) for name in self.names)
+
+    @property
+    def max_thickness(self) -> float:
+        thicknesses = [layer.thickness for layer in self.stack.layers]
+        for name in self.scattering:
+            layer, parameter = self.targets[name]
+            if parameter == "thickness":
+                thicknesses[layer] = max(thicknesses[layer], self.values[name][-1])
+        return sum(thicknesses)
+
+    def absorption_sets(self) -> np.ndarray:
+        """(sets, layers) absorption coefficients of every combination of the absorption axes, in product order."""
+        base = [layer.material.mu_a for layer in self.stack.layers]
+        sets = []
+        for values in itertools.product(*(self.values[name] for name in self.absorption)):
+            coefficients = list(base)
+            for name, value in zip(self.absorption, values):
+                coefficients[self.targets[name][0]] = value
+            sets.append(coefficients)
+        return np.array(sets, dtype=np.float32)
+
+    def stack_at(self, point: Dict[str, int]) -> LayerStack:
+        """Layer stack at the given indices of the scattering axes, with the layers below thicker ones shifted."""
+        properties = [dict(mu_s=layer.material.mu_s, g=layer.material.g, n=layer.material.n,
+                           thickness=layer.thickness) for layer in self.stack.layers]
+        reduced = {}
+        for name, index in point.items():
+            layer, parameter = self.targets[name]
+            if parameter == "mu_s_prime":
+                reduced[layer] = self.values[name][index]
+            else:
+                properties[layer][parameter] = self.values[name][index]
+        for layer, mu_s_prime in reduced.items():
+            properties[layer]["mu_s"] = mu_s_prime / (1 - properties[layer]["g"])
+
+        layers = []
+        z = self.stack.z_top
+        for layer, values in zip(self.stack.layers, properties):
+            material = ScatteringMaterial(mu_s=values["mu_s"], mu_a=layer.material.mu_a, g=values["g"],
+                                          n=values["n"])
+            layers.append(dataclasses.replace(layer, material=material, z_min=z, z_max=z + values["thickness"],
+                                              side_labels=dict(layer.side_labels)))
+            z += values["thickness"]
+        return LayerStack(layers, self.stack.lateral_limits, self.stack.world_material)
+
+
+class _Categories:
+    """Rows of a record grouped by category, to sum any per-row values into (categories, columns) with reduceat."""
+
+    def __init__(self, category: np.ndarray, mask: np.ndarray, size: int):
+        rows = np.flatnonzero(mask)
+        order = np.argsort(category[rows], kind="stable")
+        self._rows = rows[order]
+        sorted_category = category[self._rows]
+        self._starts = np.flatnonzero(np.r_[True, sorted_category[1:] != sorted_category[:-1]]) \
+            if len(rows) else np.empty(0, np.intp)
+        self._categories = sorted_category[self._starts]
+        self._size = size
+
+    def sum(self, values: np.ndarray) -> np.ndarray:
+        result = np.zeros((self._size, values.shape[1]))
+        if len(self._rows):
+            result[self._categories] = np.add.reduceat(values[self._rows], self._starts, axis=0)
+        return result
+
+
+def _tabulate(record: PathLengthRecord, mu_a: np.ndarray, depth_edges: np.ndarray,
+              n_groups: int) -> Dict[str, np.ndarray]:
+    """
+    Reflectance, transmittance, layer absorbance and depth profile of a record for every set of absorption
+    coefficients, with their standard errors from the spread of the interleaved photon groups.
+    """
+    n_layers, n_bins = record.n_layers, len(depth_edges) - 1
+    group = record.photon_id % n_groups
+    group_sizes = np.bincount(np.arange(record.photon_count) % n_groups, minlength=n_groups)
+    surface = record.key >= n_layers
+    segment_layer = np.where(surface, (record.key - n_layers) // 6, record.key)
+    depth_bin = np.clip(np.searchsorted(depth_edges, record.position[:, 2] - record.stack.z_top, side="right") - 1,
+                        0, n_bins - 1)
+    first = np.r_[True, record.photon_id[1:] != record.photon_id[:-1]]
+    top, bottom = record.stack.layers[0], record.stack.layers[-1]
+    front = record.keys.index(InteractionKey(top.label, top.front_label))
+    back = record.keys.index(InteractionKey(bottom.label, bottom.back_label))
+    leaving = record.sign == 1
+
+    everything = np.ones(len(record.key), bool)
+    categories = {
+        "reflectance": (_Categories(group, (record.key == front) & leaving, n_groups), 1),
+        "transmittance": (_Categories(group, (record.key == back) & leaving, n_groups), 1),
+        "absorbance": (_Categories(group * n_layers + segment_layer, everything, n_groups * n_layers), n_layers),
+        "depth_profile": (_Categories(group * n_bins + depth_bin, everything, n_groups * n_bins), n_bins),
+    }
+    sums = {name: np.zeros((len(mu_a), n_groups, width)) for name, (_, width) in categories.items()}
+
+    chunk = max(1, MAX_WEIGHT_VALUES // max(len(record.key), 1))
+    for start in range(0, len(mu_a), chunk):
+        stop = min(start + chunk, len(mu_a))
+        weights = np.exp(-(record.path_length @ mu_a[start:stop].T).astype(np.float64))
+        # Energy absorbed along the segment ending at each interaction, as in `PathLengthRecord.reweight`.
+        previous = np.ones_like(weights)
+        previous[1:] = weights[:-1]
+        previous[first] = 1
+        deposit = previous - weights
+        for name, (category, width) in categories.items():
+            values = weights if name in ("reflectance", "transmittance") else deposit
+            sums[name][start:stop] = category.sum(values).reshape(n_groups, width, -1).transpose(2, 0, 1)
+
+    results = {}
+    for name, total in sums.items():
+        estimates = total / group_sizes[:, None]
+        values = total.sum(axis=1) / record.photon_count
+        errors = estimates.std(axis=1, ddof=1) / np.sqrt(n_groups)
+        if name in ("reflectance", "transmittance"):
+            values, errors = values[:, 0], errors[:, 0]
+        results[name], results[name + "_error"] = values, errors
+    return results
@@ -0,0 +1,750 @@
+"""
+Vectorized NumPy photon propagation in any pytissueoptics scene, for machines without OpenCL.
+
+task1.py and task2.py drop N from 100000 to 1000 without hardware acceleration because `source.propagate` then moves
+one Python `Photon` at a time. `MeshPropagator` moves whole batches of photons as NumPy arrays through the polygons of
+the scene instead: free paths, Henyey-Greenstein deflections, Möller-Trumbore intersections with all the triangles,
+Fresnel reflection and refraction, weight updates and roulette are all computed for the batch at once, and the
+photons that die are compacted out of the arrays after each step. It follows the same rules as the pytissueoptics
+`Photon` (environments on both sides of each polygon, surfaces only tested from one of their two environments, the
+same interaction keys and signs), so it handles overlapping scenes built with `ignoreIntersections=True` the same way,
+and it writes to a regular `EnergyLogger`.
+
+Scenes of more than `INDEXED_TRIANGLES` triangles, such as a dermis holding hundreds of vessel segments, are not tested
+against every triangle: a `SpatialIndex` resolves most free paths, which are short, from the few cells of a uniform
+grid they cross, and the other rays descend a bounding volume hierarchy. Both give exactly the hits of the full test.
+
+Planar layer stacks are still best propagated with `propagate_layered`. `propagate_vectorized` picks the planar-slab
+engine when the scene is a layer stack and this one otherwise.
+
+Usage:
+    N = 100000
+    source = DivergentSource(position=Vector(0, 0, -0.2), direction=Vector(0, 0, 1), N=N, diameter=0.1, divergence=0.4)
+    propagate_vectorized(source, scene, logger=logger)
+"""
+import time
+from contextlib import nullcontext
+from typing import Dict, List, Optional
+
+import numpy as np
+from pytissueoptics import EnergyLogger, InteractionKey, Vector
+from pytissueoptics.scene.geometry.polygon import WORLD_LABEL
+
+from profiling import PropagationProfile
+from slab_propagation import ROULETTE_CHANCE, WEIGHT_THRESHOLD, LayerStack, PhotonBatch, SlabPropagator, \
+    _total_attenuation, deflect, fresnel_reflectance, propagate_layered, uniform
+
+# Distance (cm) behind a photon within which a surface is still intersected, for photons sitting on a surface.
+EPSILON = 1e-9
+
+# Tolerance on the barycentric coordinates, so that rays hitting the edge shared by two triangles do not leak through.
+EDGE_TOLERANCE = 1e-9
+
+# Maximum number of (photon, triangle) pairs tested at once, bounding the memory of the intersection tests.
+MAX_PAIRS = 2 ** 20
+
+# Maximum number of triangles in a leaf of a `BoundingVolumeHierarchy`.
+LEAF_SIZE = 4
+
+# Padding (cm) of the bounding boxes, so that flat boxes around axis-aligned faces are not missed by rounding errors.
+BOX_PADDING = 1e-7
+
+# Approximate number of cells per triangle of a `UniformGrid`, and maximum number of cells along each axis.
+GRID_CELLS_PER_TRIANGLE = 4
+GRID_MAX_RESOLUTION = 128
+
+# Margin (cm) of the plane distance pre-test of `SpatialIndex`, well above the rounding errors of the full test.
+PLANE_TOLERANCE = 1e-6
+
+# Maximum number of grid cells overlapped by a ray segment resolved by the grid instead of the hierarchy.
+GRID_QUERY_CELLS = 8
+
+# Scenes of more triangles than this are tested through a `SpatialIndex`.
+INDEXED_TRIANGLES = 64
+
+_NOT_PROFILED = nullcontext()
+
+
+class TriangleMesh:
+    """
+    The polygons of a scene as arrays of triangles, with the index of the environment on each side.
+
+    Environment 0 is the world; the others are the solids (or stack layers) in order of appearance. Polygons with
+    more than three vertices are split in fans of triangles sharing the polygon normal.
+    """
+
+    def __init__(self, scene):
+        self.labels: List[str] = [WORLD_LABEL]
+        self.materials = [scene.getWorldEnvironment().material]
+        vertices, normals, inside, outside, surface_labels = [], [], [], [], []
+        for polygon in scene.getPolygons():
+            environments = []
+            for environment in (polygon.insideEnvironment, polygon.outsideEnvironment):
+                if environment is None or environment.solid is None:
+                    environments.append(0)
+                    continue
+                if environment.solid.isDetector:
+                    raise ValueError(f"Solid '{environment.solidLabel}' is a detector, which is not supported by "
+                                     f"the vectorized propagation.")
+                if environment.solidLabel not in self.labels:
+                    self.labels.append(environment.solidLabel)
+                    self.materials.append(environment.material)
+                environments.append(self.labels.index(environment.solidLabel))
+            points = [vertex.array for vertex in polygon.vertices]
+            for i in range(1, len(points) - 1):
+                vertices.append((points[0], points[i], points[i + 1]))
+                normals.append(polygon.normal.array)
+                inside.append(environments[0])
+                outside.append(environments[1])
+                surface_labels.append(polygon.surfaceLabel)
+
+        vertices = np.asarray(vertices, dtype=float).reshape(-1, 3, 3)
+        self.v0 = vertices[:, 0]
+        self.edge1 = vertices[:, 1] - vertices[:, 0]
+        self.edge2 = vertices[:, 2] - vertices[:, 0]
+        self.normal = np.asarray(normals, dtype=float).reshape(-1, 3)
+        # Unnormalized geometric normal of each triangle, defining its plane.
+        self.plane = np.cross(self.edge1, self.edge2)
+        self.inside = np.asarray(inside, dtype=np.int64)
+        self.outside = np.asarray(outside, dtype=np.int64)
+        self.surface_labels = surface_labels
+        self.bounds = np.stack((vertices.min(axis=1), vertices.max(axis=1)), axis=1) if len(vertices) else \
+            np.zeros((0, 2, 3))
+
+    def __len__(self):
+        return len(self.v0)
+
+    def environment_of(self, environment) -> int:
+        return 0 if environment.solid is None else self.labels.index(environment.solidLabel)
+
+    def intersect(self, origin: np.ndarray, direction: np.ndarray, environment: np.ndarray,
+                  triangles: np.ndarray = None):
+        """
+        Closest triangle crossed by each ray out of its current environment.
+
+        Args:
+            origin (np.ndarray): (N, 3) ray origins.
+            direction (np.ndarray): (N, 3) normalized ray directions.
+            environment (np.ndarray): (N,) index of the environment of each ray.
+            triangles (np.ndarray): Optional indices of the candidate triangles. Defaults to all of them.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The distance to the closest triangle (inf if none) and its index (-1 if
+            none).
+        """
+        if triangles is None:
+            triangles = np.arange(len(self))
+        n_rays = len(origin)
+        distance = np.full(n_rays, np.inf)
+        closest = np.full(n_rays, -1, dtype=np.int64)
+        if len(triangles) == 0:
+            return distance, closest
+        v0, edge1, edge2 = self.v0[triangles], self.edge1[triangles], self.edge2[triangles]
+        normal, inside, outside = self.normal[triangles], self.inside[triangles], self.outside[triangles]
+
+        chunk = max(1, MAX_PAIRS // len(triangles))
+        for start in range(0, n_rays, chunk):
+            o, d, env = origin[start:start + chunk], direction[start:start + chunk], environment[start:start + chunk]
+            # A surface is only crossed from one of its two environments, towards the other one.
+            going_inside = d @ normal.T < 0
+            next_environment = np.where(going_inside, inside, outside)
+            candidate = ((inside == env[:, None]) | (outside == env[:, None])) & (next_environment != env[:, None])
+
+            # Möller-Trumbore, for every (ray, triangle) pair.
+            p = np.cross(d[:, None, :], edge2[None, :, :])
+            determinant = np.einsum("rtk,tk->rt", p, edge1)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                inverse = 1 / determinant
+                s = o[:, None, :] - v0[None, :, :]
+                u = np.einsum("rtk,rtk->rt", s, p) * inverse
+                q = np.cross(s, edge1[None, :, :])
+                v = np.einsum("rtk,rk->rt", q, d) * inverse
+                t = np.einsum("rtk,tk->rt", q, edge2) * inverse
+                valid = candidate & (np.abs(determinant) > 1e-14) & (u >= -EDGE_TOLERANCE) & \
+                    (v >= -EDGE_TOLERANCE) & (u + v <= 1 + EDGE_TOLERANCE) & (t >= -EPSILON)
+            t = np.where(valid, np.maximum(t, 0), np.inf)
+
+            index = np.argmin(t, axis=1)
+            rows = np.arange(len(o))
+            distance[start:start + chunk] = t[rows, index]
+            closest[start:start + chunk] = np.where(np.isfinite(t[rows, index]), triangles[index], -1)
+        return distance, closest
+
+
+class BoundingVolumeHierarchy:
+    """
+    Binary tree of axis-aligned bounding boxes over triangles of a `TriangleMesh`, split at the median centroid along
+    the longest axis, down to `LEAF_SIZE` triangles per leaf. Whole batches of rays traverse it level by level: each
+    (ray, node) pair whose box is crossed before the closest hit found so far, and before the maximum distance of the
+    ray, is replaced by its two children, and the triangles of the leaves reached are tested pair by pair. Since the
+    maximum distance of a scattering photon is its next free path, most photons only visit the few boxes around them
+    and an intersection query costs O(log n) instead of O(n) for n triangles.
+
+    Args:
+        mesh (TriangleMesh): The triangles.
+        triangles (np.ndarray): Indices of the triangles to index. Defaults to all of them.
+        leaf_size (int): Maximum number of triangles per leaf.
+    """
+
+    def __init__(self, mesh: TriangleMesh, triangles: np.ndarray = None, leaf_size: int = LEAF_SIZE):
+        self._mesh = mesh
+        triangles = np.arange(len(mesh)) if triangles is None else np.asarray(triangles, dtype=np.int64)
+        bounds = mesh.bounds[triangles]
+        centroids = mesh.v0[triangles] + (mesh.edge1[triangles] + mesh.edge2[triangles]) / 3
+
+        order = np.arange(len(triangles))
+        max_nodes = max(1, 2 * len(triangles) - 1)
+        self._lower = np.full((max_nodes, 3), np.inf)
+        self._upper = np.full((max_nodes, 3), -np.inf)
+        self._range = np.zeros((max_nodes, 2), dtype=np.int64)
+        self._left = np.full(max_nodes, -1, dtype=np.int64)
+        self._right = np.full(max_nodes, -1, dtype=np.int64)
+        n_nodes = 1
+        pending = [(0, 0, len(triangles))]
+        while pending:
+            node, start, stop = pending.pop()
+            items = order[start:stop]
+            self._range[node] = start, stop
+            if len(items) == 0:
+                continue
+            self._lower[node] = bounds[items, 0].min(axis=0) - BOX_PADDING
+            self._upper[node] = bounds[items, 1].max(axis=0) + BOX_PADDING
+            extent = np.ptp(centroids[items], axis=0)
+            if len(items) <= leaf_size or not np.any(extent > 0):
+                continue
+            axis = np.argmax(extent)
+            middle = len(items) // 2
+            order[start:stop] = items[np.argpartition(centroids[items, axis], middle)]
+            self._left[node], self._right[node] = n_nodes, n_nodes + 1
+            pending.append((n_nodes, start, start + middle))
+            pending.append((n_nodes + 1, start + middle, stop))
+            n_nodes += 2
+        self._lower, self._upper, self._range = self._lower[:n_nodes], self._upper[:n_nodes], self._range[:n_nodes]
+        self._left, self._right = self._left[:n_nodes], self._right[:n_nodes]
+        self._triangles = triangles[order]
+
+    @property
+    def node_count(self) -> int:
+        return len(self._lower)
+
+    def intersect(self, origin: np.ndarray, direction: np.ndarray, environment: np.ndarray,
+                  max_distance: np.ndarray = None):
+        """
+        Closest indexed triangle crossed by each ray out of its current environment, within its maximum distance.
+        Same rules and results as `TriangleMesh.intersect`, except that triangles beyond the maximum distance of a ray
+        are not reported.
+
+        Args:
+            origin (np.ndarray): (N, 3) ray origins.
+            direction (np.ndarray): (N, 3) normalized ray directions.
+            environment (np.ndarray): (N,) index of the environment of each ray.
+            max_distance (np.ndarray): (N,) distance beyond which triangles are ignored. Defaults to inf.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The distance to the closest triangle (inf if none) and its index (-1 if
+            none).
+        """
+        n_rays = len(origin)
+        best = np.full(n_rays, np.inf) if max_distance is None else np.array(max_distance, dtype=float)
+        closest = np.full(n_rays, -1, dtype=np.int64)
+        with np.errstate(divide="ignore"):
+            inverse = 1 / np.where(direction == 0, 1e-300, direction)
+
+        ray = np.arange(n_rays)
+        node = np.zeros(n_rays, dtype=np.int64)
+        while len(ray):
+            # Slab test of the boxes, up to the closest hit found so far.
+            with np.errstate(over="ignore", invalid="ignore"):
+                t_lower = (self._lower[node] - origin[ray]) * inverse[ray]
+                t_upper = (self._upper[node] - origin[ray]) * inverse[ray]
+            t_enter = np.minimum(t_lower, t_upper).max(axis=1)
+            t_exit = np.maximum(t_lower, t_upper).min(axis=1)
+            crossed = (t_enter <= t_exit) & (t_exit >= -EPSILON) & (t_enter <= best[ray])
+            ray, node = ray[crossed], node[crossed]
+
+            leaf = self._left[node] < 0
+            if np.any(leaf):
+                start, stop = self._range[node[leaf], 0], self._range[node[leaf], 1]
+                owner, rank = _ragged(stop - start)
+                _closest_hits(self._mesh, ray[leaf][owner], self._triangles[start[owner] + rank], origin, direction,
+                              environment, best, closest)
+            inner = ~leaf
+            ray = np.concatenate((ray[inner], ray[inner]))
+            node = np.concatenate((self._left[node[inner]], self._right[node[inner]]))
+
+        best[closest < 0] = np.inf
+        return best, closest
+
+
+class UniformGrid:
+    """
+    Uniform grid of cells over triangles of a `TriangleMesh`, listing in each cell the triangles whose padded bounding
+    box overlaps it. The cells are roughly cubic, about `cells_per_triangle` per triangle. A short ray segment can
+    only cross the triangles listed in the cells overlapping its bounding box, which are found without any traversal.
+
+    Args:
+        mesh (TriangleMesh): The triangles.
+        triangles (np.ndarray): Indices of the triangles to index. Defaults to all of them.
+        cells_per_triangle (float): Number of cells per indexed triangle.
+    """
+
+    def __init__(self, mesh: TriangleMesh, triangles: np.ndarray = None,
+                 cells_per_triangle: float = GRID_CELLS_PER_TRIANGLE):
+        triangles = np.arange(len(mesh)) if triangles is None else np.asarray(triangles, dtype=np.int64)
+        lower = mesh.bounds[triangles, 0] - BOX_PADDING
+        upper = mesh.bounds[triangles, 1] + BOX_PADDING
+        self._lower = lower.min(axis=0) if len(triangles) else np.zeros(3)
+        extent = upper.max(axis=0) - self._lower if len(triangles) else np.ones(3)
+        # Flat extents (e.g. a single plane) still get one cell of a sensible size.
+        extent = np.maximum(extent, 1e-3 * extent.max())
+        size = (np.prod(extent) / max(1.0, cells_per_triangle * len(triangles))) ** (1 / 3)
+        self.shape = np.clip(np.ceil(extent / size), 1, GRID_MAX_RESOLUTION).astype(np.int64)
+        self._cell_size = extent / self.shape
+
+        owner, cell = self._box_cells(*self._cell_range(lower, upper))
+        order = np.argsort(cell, kind="stable")
+        self._cell_triangles = triangles[owner[order]]
+        self._cell_start = np.concatenate(([0], np.cumsum(np.bincount(cell, minlength=np.prod(self.shape)))))
+
+    def candidates(self, origin: np.ndarray, direction: np.ndarray, max_distance: np.ndarray):
+        """
+        Triangles listed around the segment of each ray of finite maximum distance whose bounding box overlaps at most
+        `GRID_QUERY_CELLS` cells.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: The mask of the rays resolved by the grid, and the (ray,
+            triangle) pairs to test for them.
+        """
+        resolved = np.isfinite(max_distance)
+        end = origin + direction * np.where(resolved, max_distance, 0)[:, None]
+        low, high = self._cell_range(np.minimum(origin, end), np.maximum(origin, end))
+        resolved &= np.prod(high - low + 1, axis=1) <= GRID_QUERY_CELLS
+        rays = np.nonzero(resolved)[0]
+        owner, cell = self._box_cells(low[rays], high[rays])
+        start = self._cell_start[cell]
+        cell_owner, rank = _ragged(self._cell_start[cell + 1] - start)
+        return resolved, rays[owner[cell_owner]], self._cell_triangles[start[cell_owner] + rank]
+
+    def _cell_range(self, lower: np.ndarray, upper: np.ndarray):
+        """Range of cells overlapping each box, empty (high < low) for boxes outside of the grid."""
+        low = np.floor((lower - self._lower) / self._cell_size).astype(np.int64)
+        high = np.floor((upper - self._lower) / self._cell_size).astype(np.int64)
+        outside = np.any((high < 0) | (low >= self.shape), axis=1)
+        low, high = np.clip(low, 0, self.shape - 1), np.clip(high, 0, self.shape - 1)
+        high[outside] = low[outside] - 1
+        return low, high
+
+    def _box_cells(self, low: np.ndarray, high: np.ndarray):
+        """Index of the box and flat index of the cell for every cell of each box of cells."""
+        counts = np.maximum(high - low + 1, 0)
+        owner, rank = _ragged(np.prod(counts, axis=1))
+        counts = counts[owner]
+        x = low[owner, 0] + rank % counts[:, 0]
+        y = low[owner, 1] + rank // counts[:, 0] % counts[:, 1]
+        z = low[owner, 2] + rank // (counts[:, 0] * counts[:, 1])
+        return owner, (z * self.shape[1] + y) * self.shape[0] + x
+
+
+class SpatialIndex:
+    """
+    Acceleration structure of the triangles bounding an environment: a `UniformGrid` for the short free paths of
+    scattering photons, and a `BoundingVolumeHierarchy` for the other rays (e.g. photons crossing the world). Gives
+    the same results as `TriangleMesh.intersect` for every triangle closer than the maximum distance of a ray.
+
+    Args:
+        mesh (TriangleMesh): The triangles.
+        triangles (np.ndarray): Indices of the triangles to index. Defaults to all of them.
+    """
+
+    def __init__(self, mesh: TriangleMesh, triangles: np.ndarray = None):
+        self._mesh = mesh
+        self.grid = UniformGrid(mesh, triangles)
+        self.hierarchy = BoundingVolumeHierarchy(mesh, triangles)
+
+    def intersect(self, origin: np.ndarray, direction: np.ndarray, environment: np.ndarray,
+                  max_distance: np.ndarray = None):
+        """Same arguments and returns as `BoundingVolumeHierarchy.intersect`."""
+        best = np.full(len(origin), np.inf) if max_distance is None else np.array(max_distance, dtype=float)
+        closest = np.full(len(origin), -1, dtype=np.int64)
+        resolved, pair_ray, triangle = self.grid.candidates(origin, direction, best)
+        _closest_hits(self._mesh, pair_ray, triangle, origin, direction, environment, best, closest)
+        others = np.nonzero(~resolved)[0]
+        if len(others):
+            best[others], closest[others] = self.hierarchy.intersect(origin[others], direction[others],
+                                                                     environment[others], best[others])
+        best[closest < 0] = np.inf
+        return best, closest
+
+
+def _ragged(counts: np.ndarray):
+    """Owner and rank within its owner of each item, for items grouped in consecutive runs of `counts`."""
+    owner = np.repeat(np.arange(len(counts)), counts)
+    rank = np.arange(len(owner)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owner, rank
+
+
+def _closest_hits(mesh: TriangleMesh, pair_ray, triangle, origin, direction, environment, best, closest):
+    """
+    Möller-Trumbore test of (ray, triangle) pairs with the same rules as `TriangleMesh.intersect`, keeping in `best`
+    and `closest` the closest triangle of each ray that is not farther than its current `best` distance.
+    """
+    # Only the surfaces of the environment of the ray, crossed towards another environment, are tested.
+    env = environment[pair_ray]
+    inside, outside = mesh.inside[triangle], mesh.outside[triangle]
+    candidate = (inside == env) | (outside == env)
+    pair_ray, triangle, inside, outside, env = (values[candidate] for values in (pair_ray, triangle, inside, outside,
+                                                                                env))
+    d = direction[pair_ray]
+    going_inside = np.einsum("ik,ik->i", d, mesh.normal[triangle]) < 0
+    candidate = np.where(going_inside, inside, outside) != env
+
+    # Triangles whose plane is clearly behind the ray or beyond its best distance are discarded before the full test.
+    s = origin[pair_ray] - mesh.v0[triangle]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t_plane = -np.einsum("ik,ik->i", s, mesh.plane[triangle]) / np.einsum("ik,ik->i", d, mesh.plane[triangle])
+    candidate &= ~((t_plane < -EPSILON - PLANE_TOLERANCE) | (t_plane > best[pair_ray] + PLANE_TOLERANCE))
+    pair_ray, triangle, d, s = pair_ray[candidate], triangle[candidate], d[candidate], s[candidate]
+    if len(pair_ray) == 0:
+        return
+
+    edge1, edge2 = mesh.edge1[triangle], mesh.edge2[triangle]
+    p = np.cross(d, edge2)
+    determinant = np.einsum("ik,ik->i", p, edge1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inverse = 1 / determinant
+        u = np.einsum("ik,ik->i", s, p) * inverse
+        q = np.cross(s, edge1)
+        v = np.einsum("ik,ik->i", q, d) * inverse
+        t = np.einsum("ik,ik->i", q, edge2) * inverse
+        valid = (np.abs(determinant) > 1e-14) & (u >= -EDGE_TOLERANCE) & (v >= -EDGE_TOLERANCE) & \
+            (u + v <= 1 + EDGE_TOLERANCE) & (t >= -EPSILON)
+    t = np.maximum(t, 0)
+    valid &= t <= best[pair_ray]
+    if not np.any(valid):
+        return
+    pair_ray, triangle, t = pair_ray[valid], triangle[valid], t[valid]
+
+    # Closest triangle of each ray, the lowest index first on ties as with `TriangleMesh.intersect`.
+    order = np.lexsort((triangle, t, pair_ray))
+    pair_ray, triangle, t = pair_ray[order], triangle[order], t[order]
+    first = np.unique(pair_ray, return_index=True)[1]
+    ray, triangle, t = pair_ray[first], triangle[first], t[first]
+    better = (t < best[ray]) | (closest[ray] < 0) | ((t == best[ray]) & (triangle < closest[ray]))
+    best[ray[better]] = t[better]
+    closest[ray[better]] = triangle[better]
+
+
+class MeshPropagator:
+    """
+    Vectorized propagation of photon batches through the polygons of a `ScatteringScene`.
+
+    Args:
+        scene (ScatteringScene): Any scene without detectors, including scenes with `ignoreIntersections=True`.
+        batch_size (int): Maximum number of photons propagated together, bounding memory usage.
+    """
+
+    def __init__(self, scene, batch_size: int = 20000):
+        self._scene = scene
+        self._batch_size = batch_size
+        self._mesh = TriangleMesh(scene)
+        materials = self._mesh.materials
+        self._mu_t = np.array([_total_attenuation(material) for material in materials])
+        mu_a = np.array([getattr(material, "mu_a", 0) for material in materials])
+        self._albedo = np.divide(mu_a, self._mu_t, out=np.zeros_like(mu_a), where=self._mu_t > 0)
+        self._g = np.array([getattr(material, "g", 0) for material in materials])
+        self._n = np.array([material.n for material in materials])
+
+        # Volumetric keys are indexed by environment; surface keys follow, for the inside and outside of each triangle.
+        self._keys: List[Optional[InteractionKey]] = [None] + [InteractionKey(label)
+                                                               for label in self._mesh.labels[1:]]
+        key_index: Dict[InteractionKey, int] = {}
+        self._inside_key, self._outside_key = (np.full(len(self._mesh), -1, dtype=np.int64) for _ in range(2))
+        for side, keys in ((self._mesh.inside, self._inside_key), (self._mesh.outside, self._outside_key)):
+            for triangle, (environment, surface_label) in enumerate(zip(side, self._mesh.surface_labels)):
+                if environment == 0:
+                    continue
+                key = InteractionKey(self._mesh.labels[environment], surface_label)
+                if key not in key_index:
+                    key_index[key] = len(self._keys)
+                    self._keys.append(key)
+                keys[triangle] = key_index[key]
+
+        self._environment_triangles = [np.nonzero((self._mesh.inside == environment) |
+                                                  (self._mesh.outside == environment))[0]
+                                       for environment in range(len(self._mesh.labels))]
+        # Scenes of many triangles (e.g. a dermis holding hundreds of vessel segments) are tested through an index.
+        self._index = SpatialIndex(self._mesh) if len(self._mesh) > INDEXED_TRIANGLES else None
+        self._records: List[np.ndarray] = []
+        self._profile: Optional[PropagationProfile] = None
+
+    @property
+    def mesh(self) -> TriangleMesh:
+        return self._mesh
+
+    def propagate(self, source, logger: EnergyLogger = None, show_progress: bool = True,
+                  rng: np.random.Generator = None, profile: PropagationProfile = None):
+        """
+        Propagates all the photons of a pytissueoptics `Source` and logs them to the given logger.
+
+        Args:
+            source (Source): Any pytissueoptics source; only its initial positions and directions are used.
+            logger (EnergyLogger): Logger receiving the deposited and surface-crossing energy.
+            show_progress (bool): Print the photon count and the propagation time.
+            rng (np.random.Generator): Random generator. Defaults to one seeded with the source seed, if any.
+            profile (PropagationProfile): Optional profile receiving the time and events of each propagation stage.
+        """
+        if rng is None:
+            rng = np.random.default_rng(getattr(source, "_seed", None))
+        positions, directions = source.getInitialPositionsAndDirections()
+        environment = self._source_environment(positions)
+        if logger is not None:
+            self._prepare_logger(logger, source, environment)
+
+        t0 = time.time()
+        if show_progress:
+            print(f"Propagating {len(positions)} photons through {len(self._mesh)} triangles...")
+        self._profile = profile
+        try:
+            for start in range(0, len(positions), self._batch_size):
+                stop = start + self._batch_size
+                self.propagate_batch(positions[start:stop], directions[start:stop], logger, rng, first_id=start,
+                                     environment=self._mesh.environment_of(environment))
+        finally:
+            self._profile = None
+        if show_progress:
+            print(f"... done in {time.time() - t0:.2f}s")
+        if logger is not None and logger.hasFilePath:
+            logger.save()
+
+    def propagate_batch(self, positions: np.ndarray, directions: np.ndarray, logger: EnergyLogger = None,
+                        rng: np.random.Generator = None, first_id: int = 0, environment: int = 0):
+        """
+        Propagates one batch of photons given their (N, 3) initial positions and normalized directions.
+
+        Args:
+            positions (np.ndarray): Initial positions.
+            directions (np.ndarray): Initial normalized directions.
+            logger (EnergyLogger): Logger receiving the interactions.
+            rng (np.random.Generator): Random generator, or `PhotonStreams` to draw from per-photon streams.
+            first_id (int): Photon ID of the first photon of the batch.
+            environment (int): Index of the environment of the photons in `mesh.labels` (0 for the world).
+        """
+        rng = rng or np.random.default_rng()
+        self._records = []
+        profile = self._profile
+        if profile is not None:
+            profile.photon_count += len(positions)
+        photons = PhotonBatch(position=np.array(positions, dtype=np.float64),
+                              direction=np.array(directions, dtype=np.float64),
+                              channel=np.zeros(len(positions), dtype=np.int64),
+                              ids=np.arange(first_id, first_id + len(positions)))
+        # The `layer` of the batch holds the environment index of each photon.
+        photons.layer[:] = environment
+
+        with self._stage("other"):
+            while len(photons) > 0:
+                with self._stage("scattering", len(photons)):
+                    new_step = photons.step_left <= 0
+                    photons.step_left[new_step] = -np.log(1 - uniform(rng, photons, new_step))
+                    mu_t = self._mu_t[photons.layer]
+                    with np.errstate(divide="ignore"):
+                        distance = np.where(mu_t > 0, photons.step_left / np.where(mu_t > 0, mu_t, 1), np.inf)
+
+                with self._stage("geometry", len(photons)):
+                    hit_distance, triangle = self._intersect(photons, distance)
+                hits = (triangle >= 0) & (hit_distance <= distance)
+
+                with self._stage("scattering", 0):
+                    # Photons in a non-scattering environment without any surface ahead leave the scene.
+                    escaped = ~hits & np.isinf(distance)
+                    photons.weight[escaped] = 0
+                    scatters = ~hits & ~escaped
+                    photons.move(scatters, distance[scatters])
+                    photons.step_left[scatters] = 0
+                    environment = photons.layer[scatters]
+                    deposit = photons.weight[scatters] * self._albedo[environment]
+                    photons.weight[scatters] -= deposit
+                    self._record(photons, scatters, deposit, environment)
+                    self._scatter(photons, scatters, self._g[environment], rng)
+                if profile is not None:
+                    self._count_environments("interactions", environment)
+
+                if np.any(hits):
+                    with self._stage("interface", np.count_nonzero(hits)):
+                        photons.move(hits, hit_distance[hits])
+                        photons.step_left[hits] -= hit_distance[hits] * mu_t[hits]
+                        self._cross(photons, hits, triangle, rng)
+
+                with self._stage("roulette"):
+                    killed = self._roulette(photons, rng)
+                if profile is not None and killed is not None:
+                    self._count_environments("roulette_kills", photons.layer[killed])
+                photons.keep(photons.weight > 0)
+
+            with self._stage("logging"):
+                self._flush(logger)
+
+    def _intersect(self, photons: PhotonBatch, max_distance: np.ndarray):
+        """
+        Tests the photons against the spatial index of the scene or, for small scenes, the photons of each environment
+        against the triangles bounding that environment only. Triangles beyond the maximum distance of a photon may
+        not be reported.
+        """
+        if self._index is not None:
+            return self._index.intersect(photons.position, photons.direction, photons.layer, max_distance)
+        distance = np.full(len(photons), np.inf)
+        triangle = np.full(len(photons), -1, dtype=np.int64)
+        for environment in np.unique(photons.layer):
+            selected = np.nonzero(photons.layer == environment)[0]
+            distance[selected], triangle[selected] = self._mesh.intersect(
+                photons.position[selected], photons.direction[selected], photons.layer[selected],
+                self._environment_triangles[environment])
+        return distance, triangle
+
+    def _cross(self, photons: PhotonBatch, hits: np.ndarray, triangle: np.ndarray, rng):
+        """Reflects or refracts the photons reaching a triangle, logging the energy crossing it."""
+        index = np.nonzero(hits)[0]
+        triangle = triangle[index]
+        u = photons.direction[index]
+        normal = self._mesh.normal[triangle]
+        cos_normal = np.einsum("ij,ij->i", u, normal)
+        leaving = cos_normal > 0
+        current = photons.layer[index]
+        target = np.where(leaving, self._mesh.outside[triangle], self._mesh.inside[triangle])
+
+        n1, n2 = self._n[current], self._n[target]
+        R, cos_out = fresnel_reflectance(np.abs(cos_normal), n1, n2)
+        reflected = uniform(rng, photons, hits) <= R
+        # Normal oriented along the propagation, for the refraction.
+        along = normal * np.sign(cos_normal)[:, None]
+        ratio = (n1 / n2)[:, None]
+        refracted_u = ratio * u + (cos_out - (n1 / n2) * np.abs(cos_normal))[:, None] * along
+        refracted_u /= np.linalg.norm(refracted_u, axis=1)[:, None]
+        u = np.where(reflected[:, None], u - 2 * cos_normal[:, None] * normal, refracted_u)
+        photons.direction[index] = u
+
+        crossing = index[~reflected]
+        if len(crossing):
+            # Same data points as `Photon._logIntersection`: positive when leaving the inside solid of the surface.
+            value = np.where(leaving, 1.0, -1.0)[~reflected] * photons.weight[crossing]
+            crossed = triangle[~reflected]
+            mask = np.zeros(len(photons), dtype=bool)
+            mask[crossing] = True
+            self._record(photons, mask, value, self._inside_key[crossed])
+            outside_key = self._outside_key[crossed]
+            solid_outside = outside_key >= 0
+            mask[crossing[~solid_outside]] = False
+            self._record(photons, mask, -value[solid_outside], outside_key[solid_outside])
+        if self._profile is not None:
+            self._count_environments("reflections", current[reflected])
+            self._count_environments("crossings_out", current[~reflected])
+            self._count_environments("crossings_in", target[~reflected])
+        photons.layer[crossing] = target[~reflected]
+
+    @staticmethod
+    def _scatter(photons: PhotonBatch, mask, g, rng):
+        if not np.any(mask):
+            return
+        rnd = uniform(rng, photons, mask)
+        photons.direction[mask] = deflect(photons.direction[mask], g, rnd, 2 * np.pi * uniform(rng, photons, mask))
+
+    @staticmethod
+    def _roulette(photons: PhotonBatch, rng) -> Optional[np.ndarray]:
+        weight = photons.weight
+        low = (weight < WEIGHT_THRESHOLD) & (weight > 0)
+        if not np.any(low):
+            return None
+        survives = uniform(rng, photons, low) < ROULETTE_CHANCE
+        weight[low] = np.where(survives, weight[low] / ROULETTE_CHANCE, 0)
+        return low & (weight == 0)
+
+    def _record(self, photons: PhotonBatch, mask, value, key):
+        """Buffers data points of the masked photons as rows of (value, x, y, z, photonID, key index)."""
+        if len(value) == 0:
+            return
+        with self._stage("logging", len(value)):
+            self._records.append(np.column_stack((value, photons.position[mask], photons.ids[mask], key)))
+
+    def _flush(self, logger: Optional[EnergyLogger]):
+        if not self._records or logger is None:
+            self._records = []
+            return
+        records = np.vstack(self._records)
+        self._records = []
+        key = records[:, 5].astype(np.int64)
+        # World interactions (key 0) are not logged, as with the pytissueoptics photons.
+        order = np.argsort(key, kind="stable")
+        records, key = records[order], key[order]
+        keys, starts = np.unique(key, return_index=True)
+        for index, start, stop in zip(keys, starts, list(starts[1:]) + [len(key)]):
+            if index > 0:
+                logger.logDataPointArray(records[start:stop, :5], self._keys[index])
+
+    def _stage(self, name: str, events: int = 0):
+        return _NOT_PROFILED if self._profile is None else self._profile.stage(name, events)
+
+    def _count_environments(self, counter: str, environment: np.ndarray):
+        counts = np.bincount(environment, minlength=len(self._mesh.labels))
+        for label, n in zip(self._mesh.labels, counts):
+            if n:
+                self._profile.count(label, counter, int(n))
+
+    def prepare_launch(self, positions: np.ndarray) -> dict:
+        """
+        Locates the source from the initial positions of its photons before they are propagated with
+        `propagate_batch`, and returns the extra arguments of `propagate_batch` (the environment of the source).
+        """
+        environment = self._source_environment(positions)
+        return dict(environment=self._mesh.environment_of(environment) if environment else 0)
+
+    def prepare_logger(self, logger, source, positions: np.ndarray):
+        """Adds the photon count and the solid of the source to the info of a logger given to `propagate_batch`."""
+        self._prepare_logger(logger, source, self._source_environment(positions))
+
+    def _source_environment(self, positions: np.ndarray):
+        return self._scene.getEnvironmentAt(Vector(*positions[0])) if len(positions) else None
+
+    def _prepare_logger(self, logger, source, environment):
+        # Same bookkeeping as `Source._prepareLogger` so that `Stats` can normalize the energies.
+        logger.info["photonCount"] = logger.info.get("photonCount", 0) + source.getPhotonCount()
+        logger.info["sourceSolidLabel"] = environment.solidLabel if environment and environment.solid else None
+        logger.info.setdefault("sourceHash", hash(source))
+
+
+def make_propagator(model, batch_size: int = None):
+    """
+    Vectorized propagator of a model given as a scene (propagated as planar layers when possible, or with a
+    `MeshPropagator` otherwise), a `LayerStack` or an existing `SlabPropagator` or `MeshPropagator`, returned as is.
+
+    Args:
+        model: The model to propagate through.
+        batch_size (int): Maximum number of photons propagated together. Defaults to the one of each engine.
+    """
+    if isinstance(model, (SlabPropagator, MeshPropagator)):
+        return model
+    options = {} if batch_size is None else dict(batch_size=batch_size)
+    if isinstance(model, LayerStack):
+        return SlabPropagator(model, **options)
+    try:
+        stack = LayerStack.from_scene(model)
+    except ValueError:
+        return MeshPropagator(model, **options)
+    return SlabPropagator(stack, **options)
+
+
+def propagate_vectorized(source, scene, logger: EnergyLogger = None, show_progress: bool = True,
+                         profile: PropagationProfile = None):
+    """
+    Drop-in replacement for `source.propagate(scene, logger=logger)` on the CPU. Planar layer stacks are propagated
+    with `propagate_layered` and any other scene with a `MeshPropagator`.
+
+    Returns:
+        The `SlabPropagator` or `MeshPropagator` used, which can be reused with other sources.
+    """
+    try:
+        stack = LayerStack.from_scene(scene)
+    except ValueError:
+        propagator = MeshPropagator(scene)
+        propagator.propagate(source, logger=logger, show_progress=show_progress, profile=profile)
+        return propagator
+    return propagate_layered(source, scene, logger=logger, stack=stack, show_progress=show_progress, profile=profile)
@@ -0,0 +1,170 @@
+"""
+Correlated sampling for model A/B studies.
+
+Two independent runs hide a small difference between models, such as the one caused by the thin blood layer of task 8,
+under the noise of both runs. `compare_paired` launches the same photons (same initial positions and directions)
+through every variant of a model and draws their random numbers from per-photon streams (`PhotonStreams`), so that a
+photon follows the same history in every variant until its path reaches a part of the model that differs. Metrics are
+tallied per photon, and the difference of each variant to the reference (the first variant) is estimated from the
+per-photon differences: SE = std(x_B - x_A) / sqrt(n). When the histories are correlated, this error is much smaller
+than the error of two independent runs of the same size, sqrt(SE_A² + SE_B²). Both errors are reported with their
+variance ratio, i.e. how many times more photons independent runs would need to reach the same error.
+
+Variants are scenes (propagated as planar layer stacks when possible, or with a `MeshPropagator` otherwise), explicit
+`LayerStack`s or propagators. Variants that only differ in absorption can also share a single absorption-free history
+set with `absorption_reweighting`.
+
+Usage:
+    models = {"Without blood": SkinModelWithoutBlood(), "With blood": SkinModelWithBlood()}
+    result = compare_paired(source, models, metrics=[AbsorbedEnergy("Dermis"), AbsorbedEnergy()])
+    print(result)
+"""
+import time
+from dataclasses import dataclass
+from typing import Dict, List
+
+import numpy as np
+from pytissueoptics import EnergyLogger
+
+from adaptive_propagation import Metric, MetricEstimate, MetricTally
+from mesh_propagation import make_propagator
+from slab_propagation import PhotonStreams
+
+
+@dataclass
+class PairedDifference:
+    mean: float
+    standard_error: float
+    independent_error: float
+
+    @property
+    def variance_reduction(self) -> float:
+        """Variance of independent runs over the variance of the paired estimate."""
+        if self.standard_error == 0:
+            return np.inf
+        return (self.independent_error / self.standard_error) ** 2
+
+
+@dataclass
+class PairedResult:
+    photon_count: int
+    reference: str
+    estimates: Dict[str, Dict[str, MetricEstimate]]
+    differences: Dict[str, Dict[str, PairedDifference]]
+    duration: float
+
+    def __str__(self):
+        lines = [f"{self.photon_count} photons per variant ({self.duration:.2f}s), per photon:"]
+        for variant, estimates in self.estimates.items():
+            lines.append(f"  {variant}{' (reference)' if variant == self.reference else ''}:")
+            for name, estimate in estimates.items():
+                line = f"    {name}: {estimate.mean:.5g} ± {estimate.standard_error:.2g}"
+                difference = self.differences.get(variant, {}).get(name)
+                if difference is not None:
+                    line += (f", difference {difference.mean:+.4g} ± {difference.standard_error:.2g} "
+                             f"(independent runs ± {difference.independent_error:.2g}, "
+                             f"variance / {difference.variance_reduction:.3g})")
+                lines.append(line)
+        return "\n".join(lines)
+
+
+class _DifferenceTally:
+    """Sums of the per-photon differences of each variant to the reference."""
+
+    def __init__(self, n_variants: int, n_metrics: int):
+        self._sums = np.zeros((2, n_variants, n_metrics))
+        self.photon_count = 0
+
+    def add(self, values: np.ndarray):
+        """Adds the (variants, metrics, photons) per-photon values of a batch."""
+        difference = values - values[0]
+        self._sums += (difference.sum(axis=2), (difference ** 2).sum(axis=2))
+        self.photon_count += values.shape[2]
+
+    def estimates(self):
+        n = max(self.photon_count, 2)
+        mean = self._sums[0] / n
+        variance = np.maximum(self._sums[1] / n - mean ** 2, 0) * n / (n - 1)
+        return mean, np.sqrt(variance / n)
+
+
+def compare_paired(source, variants: Dict[str, object], metrics: List[Metric],
+                   loggers: Dict[str, EnergyLogger] = None, batch_size: int = 10000, seed: int = None,
+                   correlated: bool = True, show_progress: bool = True) -> PairedResult:
+    """
+    Propagates the photons of the source through every variant with shared random streams and estimates the metrics
+    of each variant along with their difference to the first variant.
+
+    Args:
+        source (Source): The photon source. Its photons are launched once in each variant.
+        variants (Dict[str, object]): Scenes, `LayerStack`s, `SlabPropagator`s or `MeshPropagator`s by name. The first
+            one is the reference.
+        metrics (List[Metric]): The metrics to compare. A metric about a solid missing in a variant is 0 there.
+        loggers (Dict[str, EnergyLogger]): Optional loggers by variant name, receiving the interactions of the
+            variant, e.g. for a `Viewer`.
+        batch_size (int): Number of photons propagated together in each variant.
+        seed (int): Seed of the random streams. Defaults to the source seed, if any.
+        correlated (bool): Share the random streams between the variants. With False, every variant uses its own
+            random generator and only the initial photons are shared, as in independent runs.
+        show_progress (bool): Print the photon count and the propagation time.
+
+    Returns:
+        PairedResult: The estimates of each variant and their differences to the reference.
+    """
+    if len(variants) < 2:
+        raise ValueError("A paired comparison requires at least two variants.")
+    loggers = loggers or {}
+    unknown = set(loggers) - set(variants)
+    if unknown:
+        raise ValueError(f"Loggers given for unknown variants {sorted(unknown)}.")
+    names = list(variants)
+    propagators = [make_propagator(variants[name], batch_size) for name in names]
+    if any(getattr(propagator, "n_channels", 1) > 1 for propagator in propagators):
+        raise ValueError("Paired comparisons require single-channel propagators.")
+    if seed is None:
+        seed = getattr(source, "_seed", None)
+    if correlated:
+        rngs = [PhotonStreams(seed)] * len(names)
+    else:
+        rngs = [np.random.default_rng(stream) for stream in np.random.SeedSequence(seed).spawn(len(names))]
+
+    t0 = time.time()
+    positions, directions = source.getInitialPositionsAndDirections()
+    arguments = [propagator.prepare_launch(positions) for propagator in propagators]
+    for name, propagator in zip(names, propagators):
+        if loggers.get(name) is not None:
+            propagator.prepare_logger(loggers[name], source, positions)
+    if show_progress:
+        print(f"Propagating {len(positions)} {'paired' if correlated else 'independent'} photons through "
+              f"{len(names)} variants...")
+
+    tallies = [MetricTally(metrics, loggers.get(name)) for name in names]
+    differences = _DifferenceTally(len(names), len(metrics))
+    for start in range(0, len(positions), batch_size):
+        stop = min(start + batch_size, len(positions))
+        values = np.empty((len(names), len(metrics), stop - start))
+        for index, (propagator, tally, rng, launch) in enumerate(zip(propagators, tallies, rngs, arguments)):
+            tally.start_batch(start, stop - start)
+            propagator.propagate_batch(positions[start:stop], directions[start:stop], tally, rng, first_id=start,
+                                       **launch)
+            values[index] = tally.batch
+            tally.end_batch()
+        differences.add(values)
+    if show_progress:
+        print(f"... done in {time.time() - t0:.2f}s")
+
+    for logger in loggers.values():
+        if logger is not None and logger.hasFilePath:
+            logger.save()
+
+    mean, error = differences.estimates()
+    estimates = {name: tally.estimates() for name, tally in zip(names, tallies)}
+    reference = estimates[names[0]]
+    paired = {}
+    for index, name in enumerate(names[1:], start=1):
+        paired[name] = {}
+        for m, metric in enumerate(metrics):
+            independent = np.hypot(reference[metric.name].standard_error, estimates[name][metric.name].standard_error)
+            paired[name][metric.name] = PairedDifference(float(mean[index, m]), float(error[index, m]),
+                                                         float(independent))
+    return PairedResult(differences.photon_count, names[0], estimates, paired, time.time() - t0)
@@ -0,0 +1,304 @@
+"""
+Pencil-beam impulse response of a layer stack and its convolution with arbitrary beam profiles.
+
+For laterally invariant layers, the response to any beam is the response to an infinitely thin (pencil) beam convolved
+with the profile of the beam on the tissue surface. `PencilBeamResponse.cached` simulates the pencil-beam Green's
+function of a layer stack once, tabulated in (r, z) rings, and caches it on disk. `convolve` then gives the deposited
+energy, fluence and diffuse reflectance maps of any pytissueoptics source, lateral offset or scanning pattern by FFT
+convolution, in seconds instead of a new Monte Carlo run.
+
+The divergence of a beam changes both where its photons reach the surface and their incidence angle. The entry
+positions are convolved exactly. Incidence angles are handled by simulating one Green's function per angle of
+`angles` and assigning each photon to the nearest one; azimuthal asymmetry of oblique incidence is averaged out. The
+default normal incidence is accurate for the small divergences used in the task scripts, where refraction and the
+first scattering events quickly randomize the directions.
+
+Usage:
+    response = PencilBeamResponse.cached(stack)
+    for diameter in [0.05, 0.1, 0.2]:
+        source = DivergentSource(position=Vector(0, 0, -0.2), direction=Vector(0, 0, 1), N=100000,
+                                 diameter=diameter, divergence=0.4)
+        beam = response.convolve(source)
+        print(diameter, beam.total_reflectance, beam.depth_profile())
+"""
+import hashlib
+import json
+import os
+from dataclasses import dataclass
+from typing import Sequence, Tuple
+
+import numpy as np
+from pytissueoptics import InteractionKey
+
+from slab_propagation import LayerStack, SlabPropagator
+
+DEFAULT_CACHE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "pencil_beam")
+
+# Height above the surface where the pencil beam is launched (cm).
+LAUNCH_HEIGHT = 1e-6
+
+# Sub-samples per radial bin used to compute the overlap of the Cartesian voxels with the rings.
+KERNEL_SUBSAMPLING = 4
+
+
+@dataclass
+class BeamResponse:
+    """
+    Response of a layer stack to a beam, per launched photon, on a regular (x, y, z) grid.
+
+    Attributes:
+        x_edges, y_edges, z_edges (np.ndarray): Edges of the bins (cm).
+        deposition (np.ndarray): Fraction of the launched energy deposited in each (x, y, z) voxel.
+        reflectance (np.ndarray): Diffuse reflectance per unit area (1/cm^2) in each (x, y) bin of the surface.
+        total_reflectance (float): Fraction of the launched energy leaving through the surface, including the
+            reflectance beyond the maps.
+        mu_a (np.ndarray): Absorption coefficient at each depth bin, used to compute the fluence.
+    """
+    x_edges: np.ndarray
+    y_edges: np.ndarray
+    z_edges: np.ndarray
+    deposition: np.ndarray
+    reflectance: np.ndarray
+    total_reflectance: float
+    mu_a: np.ndarray
+
+    @property
+    def voxel_volume(self) -> float:
+        return float((self.x_edges[1] - self.x_edges[0]) * (self.y_edges[1] - self.y_edges[0]) *
+                     (self.z_edges[1] - self.z_edges[0]))
+
+    @property
+    def fluence(self) -> np.ndarray:
+        """Fluence per launched photon (1/cm^2) in each voxel, zero where there is no absorption."""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(self.mu_a > 0, self.deposition / (self.voxel_volume * self.mu_a), 0)
+
+    def depth_profile(self) -> np.ndarray:
+        """Fraction of the launched energy deposited in each depth bin of the maps."""
+        return self.deposition.sum(axis=(0, 1))
+
+
+class PencilBeamResponse:
+    """
+    Green's function of a layer stack: energy deposited in (r, z) rings and diffusely reflected in r rings around a
+    pencil beam entering the surface at the origin, per launched photon and for each incidence angle.
+
+    Args:
+        stack (LayerStack): The simulated layers.
+        radii (np.ndarray): Edges of the radial bins (cm).
+        depths (np.ndarray): Edges of the depth bins (cm), from the top of the stack.
+        angles (np.ndarray): Incidence angles of the simulated pencil beams (radians).
+        deposition (np.ndarray): (angles, radii, depths) deposited energy per launched photon.
+        reflectance (np.ndarray): (angles, radii + 1) reflected energy per launched photon, with an overflow bin.
+        photon_count (int): Number of photons simulated per angle.
+    """
+
+    def __init__(self, stack: LayerStack, radii: np.ndarray, depths: np.ndarray, angles: np.ndarray,
+                 deposition: np.ndarray, reflectance: np.ndarray, photon_count: int):
+        self._stack = stack
+        self.radii = radii
+        self.depths = depths
+        self.angles = angles
+        self.deposition = deposition
+        self.reflectance = reflectance
+        self.photon_count = photon_count
+
+    @classmethod
+    def simulate(cls, stack: LayerStack, N: int = 100000, max_radius: float = 1.0, radial_bin_size: float = 0.005,
+                 depth_bin_size: float = 0.005, angles: Sequence[float] = (0.0,), seed: int = None,
+                 batch_size: int = 20000, show_progress: bool = True) -> "PencilBeamResponse":
+        """
+        Propagates N pencil-beam photons per incidence angle through the stack, without its lateral limits.
+
+        Args:
+            stack (LayerStack): The layers.
+            N (int): Number of photons per incidence angle.
+            max_radius (float): Radius covered by the radial bins (cm).
+            radial_bin_size (float): Radial resolution (cm).
+            depth_bin_size (float): Depth resolution (cm).
+            angles (Sequence[float]): Incidence angles (radians) of the simulated pencil beams, in the x-z plane.
+            seed (int): Seed of the random generator.
+            batch_size (int): Number of photons propagated together.
+            show_progress (bool): Print the progress of each angle.
+        """
+        infinite_stack = LayerStack(stack.layers, world_material=stack.world_material)
+        propagator = SlabPropagator(infinite_stack, batch_size=batch_size)
+        rng = np.random.default_rng(seed)
+        radii = np.arange(max(1, int(round(max_radius / radial_bin_size))) + 1) * radial_bin_size
+        n_depths = max(1, int(np.ceil((stack.z_bottom - stack.z_top) / depth_bin_size - 1e-9)))
+        depths = np.arange(n_depths + 1) * depth_bin_size
+
+        angles = np.asarray(angles, dtype=float)
+        deposition = np.zeros((len(angles), len(radii) - 1, n_depths))
+        reflectance = np.zeros((len(angles), len(radii)))
+        for index, angle in enumerate(angles):
+            if show_progress:
+                print(f"Simulating the pencil-beam response at {np.degrees(angle):.1f}° with {N} photons...")
+            tally = _GreenTally(infinite_stack, radii, depths)
+            direction = np.array([np.sin(angle), 0, np.cos(angle)])
+            for start in range(0, N, batch_size):
+                n_photons = min(batch_size, N - start)
+                positions = np.tile([0, 0, stack.z_top - LAUNCH_HEIGHT], (n_photons, 1))
+                propagator.propagate_batch(positions, np.tile(direction, (n_photons, 1)), tally, rng,
+                                           first_id=start)
+            deposition[index], reflectance[index] = tally.deposition / N, tally.reflectance / N
+        return cls(stack, radii, depths, angles, deposition, reflectance, N)
+
+    @classmethod
+    def cached(cls, stack: LayerStack, directory: str = DEFAULT_CACHE_DIRECTORY, show_progress: bool = True,
+               **simulate_kwargs) -> "PencilBeamResponse":
+        """
+        Loads the response of the stack from the cache directory, or simulates and stores it. The cache key covers
+        the geometry and optical properties of the layers and all the simulation parameters.
+        """
+        key = response_key(stack, **simulate_kwargs)
+        filepath = os.path.join(directory, key + ".npz")
+        if os.path.exists(filepath):
+            if show_progress:
+                print(f"Loaded pencil-beam response {key[:12]} from cache.")
+            return cls.load(filepath, stack)
+        response = cls.simulate(stack, show_progress=show_progress, **simulate_kwargs)
+        os.makedirs(directory, exist_ok=True)
+        response.save(filepath)
+        return response
+
+    def save(self, filepath: str):
+        np.savez_compressed(filepath, radii=self.radii, depths=self.depths, angles=self.angles,
+                            deposition=self.deposition, reflectance=self.reflectance, photon_count=self.photon_count)
+
+    @classmethod
+    def load(cls, filepath: str, stack: LayerStack) -> "PencilBeamResponse":
+        with np.load(filepath) as data:
+            return cls(stack, data["radii"], data["depths"], data["angles"], data["deposition"], data["reflectance"],
+                       int(data["photon_count"]))
+
+    def convolve(self, source, bin_size: float = 0.01, limits: Tuple[Tuple[float, float], Tuple[float, float]] = None,
+                 offsets: Sequence[Tuple[float, float]] = None) -> BeamResponse:
+        """
+        Response to a beam, obtained by convolving the pencil-beam response with the entry profile of the beam.
+
+        Args:
+            source: A pytissueoptics `Source` above the stack, or its (positions, directions) arrays. Only the initial
+                positions and directions are used, so its N sets the sampling of the beam profile only.
+            bin_size (float): Lateral resolution of the maps (cm).
+            limits: ((x_min, x_max), (y_min, y_max)) of the maps. Defaults to the entry profile extended by the radius
+                of the Green's function.
+            offsets (Sequence[Tuple[float, float]]): Optional (x, y) positions of a scanning pattern. The beam is
+                repeated at each offset with the same total energy per position.
+        """
+        positions, directions = (source.getInitialPositionsAndDirections() if hasattr(source, "getPhotonCount")
+                                 else source)
+        entry, angle = self._entry_points(np.asarray(positions, dtype=float), np.asarray(directions, dtype=float))
+        offsets = np.zeros((1, 2)) if offsets is None else np.asarray(offsets, dtype=float)
+        entry = (entry[None, :, :] + offsets[:, None, :]).reshape(-1, 2)
+        angle = np.tile(angle, len(offsets))
+        if limits is None:
+            margin = self.radii[-1]
+            limits = [(entry[:, axis].min() - margin, entry[:, axis].max() + margin) for axis in range(2)]
+        x_edges, y_edges = (np.arange(low, high + bin_size / 2, bin_size) for low, high in limits)
+
+        # Each photon of the profile carries 1 / N of the energy of one launched photon.
+        weight = np.full(len(entry), 1 / len(positions))
+        nearest = np.argmin(np.abs(angle[:, None] - self.angles[None, :]), axis=1)
+        deposition = np.zeros((len(x_edges) - 1, len(y_edges) - 1, len(self.depths) - 1))
+        reflectance = np.zeros(deposition.shape[:2])
+        total_reflectance = 0.0
+        for index in range(len(self.angles)):
+            selected = nearest == index
+            if not np.any(selected):
+                continue
+            profile = np.histogram2d(entry[selected, 0], entry[selected, 1], bins=(x_edges, y_edges),
+                                     weights=weight[selected])[0]
+            deposition_kernel, reflectance_kernel = self._kernels(index, bin_size)
+            for z_index in range(deposition.shape[2]):
+                deposition[:, :, z_index] += _fft_convolve(profile, deposition_kernel[:, :, z_index])
+            reflectance += _fft_convolve(profile, reflectance_kernel) / bin_size ** 2
+            total_reflectance += weight[selected].sum() * self.reflectance[index].sum()
+
+        z_edges = self._stack.z_top + self.depths
+        z_centers = (z_edges[:-1] + z_edges[1:]) / 2
+        layers = np.clip(self._stack.layer_at(z_centers), 0, len(self._stack.layers) - 1)
+        mu_a = np.array([getattr(self._stack.layers[layer].material, "mu_a", 0) for layer in layers])
+        return BeamResponse(x_edges, y_edges, z_edges, deposition, reflectance, float(total_reflectance), mu_a)
+
+    def _entry_points(self, positions: np.ndarray, directions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Points where the photons reach the top surface and their incidence angle."""
+        uz = directions[:, 2]
+        if np.any(positions[:, 2] > self._stack.z_top) or np.any(uz <= 0):
+            raise ValueError("The beam must start above the stack and point towards it.")
+        distance = (self._stack.z_top - positions[:, 2]) / uz
+        entry = positions[:, :2] + directions[:, :2] * distance[:, None]
+        return entry, np.arccos(np.clip(uz, -1, 1))
+
+    def _kernels(self, angle_index: int, bin_size: float) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Deposition (x, y, z) and reflectance (x, y) of a pencil beam on a Cartesian grid centered on the beam. The
+        energy of each ring is shared between the voxels in proportion to their overlap with it, estimated on a finer
+        sub-grid, so that the energy of every ring is conserved.
+        """
+        n_rings = len(self.radii) - 1
+        half_width = int(np.ceil(self.radii[-1] / bin_size))
+        size = 2 * half_width + 1
+        subsampling = int(np.ceil(bin_size / np.diff(self.radii).min())) * KERNEL_SUBSAMPLING
+        coordinates = ((np.arange(size * subsampling) + 0.5) / subsampling - half_width - 0.5) * bin_size
+        radius = np.hypot(*np.meshgrid(coordinates, coordinates, indexing="ij")).ravel()
+        voxel_index = np.arange(size * subsampling) // subsampling
+        voxel = (voxel_index[:, None] * size + voxel_index[None, :]).ravel()
+        ring = np.searchsorted(self.radii, radius, side="right") - 1
+        inside = ring < n_rings
+
+        pairs, counts = np.unique(voxel[inside] * n_rings + ring[inside], return_counts=True)
+        pair_voxel, pair_ring = np.divmod(pairs, n_rings)
+        overlap = counts / np.bincount(pair_ring, weights=counts, minlength=n_rings)[pair_ring]
+        # Pairs are sorted by voxel, so the contributions of each voxel are contiguous.
+        starts = np.concatenate(([0], np.nonzero(np.diff(pair_voxel))[0] + 1))
+        energy = np.column_stack((self.deposition[angle_index], self.reflectance[angle_index][:-1]))
+        kernels = np.zeros((size * size, energy.shape[1]))
+        kernels[pair_voxel[starts]] = np.add.reduceat(overlap[:, None] * energy[pair_ring], starts, axis=0)
+        kernels = kernels.reshape(size, size, -1)
+        return kernels[:, :, :-1], kernels[:, :, -1]
+
+
+def response_key(stack: LayerStack, **simulate_kwargs) -> str:
+    """Hex digest identifying the pencil-beam response of a stack for the given simulation parameters."""
+    layers = [[layer.label, layer.z_min, layer.z_max] + [getattr(layer.material, name, None)
+                                                           for name in ("mu_s", "mu_a", "g", "n")]
+              for layer in stack.layers]
+    parameters = {name: np.asarray(value).tolist() for name, value in simulate_kwargs.items()}
+    description = {"layers": layers, "world": stack.world_material.n, "parameters": parameters}
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class _GreenTally:
+    """Logger-like sink binning the deposited and reflected energy around the origin."""
+
+    def __init__(self, stack: LayerStack, radii: np.ndarray, depths: np.ndarray):
+        self._stack = stack
+        self._radii = radii
+        self._depths = depths
+        self._entry_key = InteractionKey(stack.layers[0].label, stack.layers[0].front_label)
+        self.deposition = np.zeros((len(radii) - 1, len(depths) - 1))
+        self.reflectance = np.zeros(len(radii))
+
+    def logDataPointArray(self, array: np.ndarray, key: InteractionKey):
+        radius = np.hypot(array[:, 1], array[:, 2])
+        ring = np.minimum(np.searchsorted(self._radii, radius, side="right") - 1, len(self._radii) - 1)
+        if key.volumetric:
+            depth = np.searchsorted(self._depths, array[:, 3] - self._stack.z_top, side="right") - 1
+            depth = np.clip(depth, 0, len(self._depths) - 2)
+            # Energy deposited beyond the maximum radius is not part of the maps.
+            kept = ring < len(self._radii) - 1
+            self.deposition += np.bincount(ring[kept] * self.deposition.shape[1] + depth[kept],
+                                           weights=array[kept, 0],
+                                           minlength=self.deposition.size).reshape(self.deposition.shape)
+        elif key == self._entry_key:
+            leaving = array[:, 0] > 0
+            self.reflectance += np.bincount(ring[leaving], weights=array[leaving, 0], minlength=len(self._radii))
+
+
+def _fft_convolve(profile: np.ndarray, kernel: np.ndarray) -> np.ndarray:
+    """Linear convolution of a 2D profile with a centered kernel of odd size, cropped to the profile shape."""
+    shape = (profile.shape[0] + kernel.shape[0] - 1, profile.shape[1] + kernel.shape[1] - 1)
+    result = np.fft.irfft2(np.fft.rfft2(profile, shape) * np.fft.rfft2(kernel, shape), shape)
+    offset = (kernel.shape[0] // 2, kernel.shape[1] // 2)
+    return result[offset[0]:offset[0] + profile.shape[0], offset[1]:offset[1] + profile.shape[1]]
@@ -0,0 +1,227 @@
+"""
+Per-stage profiling of photon propagation.
+
+A `PropagationProfile` collects the cumulative time and number of events of each propagation stage:
+
+    - geometry: distances to the layer boundaries (slab) or ray-mesh intersections (mesh);
+    - interface: Fresnel reflection and refraction at the boundaries between solids and with the world;
+    - scattering: free path sampling, absorption and Henyey-Greenstein deflection;
+    - roulette: Russian roulette and the other variance reduction games;
+    - logging: data points sent to the `EnergyLogger`;
+    - other: everything else inside the propagation loop.
+Stage times are exclusive: the logging done while crossing an interface is only counted as logging. The profile also
+counts, for each solid, the interactions (scattering events), the interface crossings out of and into it, the
+Fresnel reflections on its boundaries and the photons killed by roulette in it.
+
+Profiling is opt-in. The planar-slab engine takes the profile as an argument of `propagate` and is not instrumented
+otherwise. The mesh propagation of pytissueoptics is profiled on the CPU by `profile_propagation`, which wraps the
+`Photon` methods for the duration of the propagation only.
+
+Usage:
+    profile = PropagationProfile()
+    propagate_layered(source, scene, logger, profile=profile)  # or profile_propagation(source, scene, logger)
+    print(profile.report())
+"""
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Dict, List
+
+from pytissueoptics.rayscattering.photon import WEIGHT_THRESHOLD, Photon
+
+STAGES = ("geometry", "interface", "scattering", "roulette", "logging", "other")
+
+
+@dataclass
+class StageStats:
+    time: float = 0
+    calls: int = 0
+    events: int = 0
+
+
+@dataclass
+class SolidStats:
+    interactions: int = 0
+    crossings_out: int = 0
+    crossings_in: int = 0
+    reflections: int = 0
+    roulette_kills: int = 0
+
+
+class _Stage:
+    """Context manager timing one stage, excluding the time spent in the stages nested in it."""
+    __slots__ = ("_profile", "_name", "_events")
+
+    def __init__(self, profile: "PropagationProfile", name: str, events: int):
+        self._profile = profile
+        self._name = name
+        self._events = events
+
+    def __enter__(self):
+        self._profile._enter(self._name, self._events)
+
+    def __exit__(self, *exc_info):
+        self._profile._exit()
+
+
+class PropagationProfile:
+    """Cumulative time and events per propagation stage, and interaction counts per solid."""
+
+    def __init__(self):
+        self.stages: Dict[str, StageStats] = {name: StageStats() for name in STAGES}
+        self.solids: Dict[str, SolidStats] = {}
+        self.photon_count = 0
+        self._active: List[list] = []
+
+    @property
+    def total_time(self) -> float:
+        return sum(stats.time for stats in self.stages.values())
+
+    def stage(self, name: str, events: int = 0) -> _Stage:
+        """Context manager adding the time spent in its block to the stage, along with a number of events."""
+        return _Stage(self, name, events)
+
+    def count(self, solid_label: str, counter: str, n: int = 1):
+        """Adds `n` to one of the `SolidStats` counters of a solid."""
+        stats = self.solids.get(solid_label)
+        if stats is None:
+            stats = self.solids[solid_label] = SolidStats()
+        setattr(stats, counter, getattr(stats, counter) + n)
+
+    def merge(self, other: "PropagationProfile") -> "PropagationProfile":
+        """Adds the statistics of another profile, e.g. from another batch or process."""
+        for name, stats in other.stages.items():
+            own = self.stages.setdefault(name, StageStats())
+            own.time += stats.time
+            own.calls += stats.calls
+            own.events += stats.events
+        for label, stats in other.solids.items():
+            for counter, value in asdict(stats).items():
+                self.count(label, counter, value)
+        self.photon_count += other.photon_count
+        return self
+
+    def as_dict(self) -> dict:
+        return dict(photon_count=self.photon_count, stages={name: asdict(stats) for name, stats in self.stages.items()},
+                    solids={label: asdict(stats) for label, stats in self.solids.items()})
+
+    def report(self) -> str:
+        total = self.total_time or 1
+        n = max(self.photon_count, 1)
+        lines = [f"{self.photon_count} photons in {self.total_time:.3f}s",
+                 f"{'Stage':<12}{'Time (s)':>10}{'Share':>8}{'Calls':>10}{'Events':>12}{'Events/photon':>15}"]
+        for name, stats in self.stages.items():
+            lines.append(f"{name:<12}{stats.time:>10.3f}{stats.time / total:>8.1%}{stats.calls:>10}"
+                         f"{stats.events:>12}{stats.events / n:>15.2f}")
+        lines.append(f"{'Solid':<12}{'Interactions/photon':>21}{'Out':>10}{'In':>10}{'Reflections':>13}"
+                     f"{'Roulette kills':>16}")
+        for label, stats in self.solids.items():
+            lines.append(f"{str(label):<12}{stats.interactions / n:>21.2f}{stats.crossings_out:>10}"
+                         f"{stats.crossings_in:>10}{stats.reflections:>13}{stats.roulette_kills:>16}")
+        return "\n".join(lines)
+
+    def __str__(self):
+        return self.report()
+
+    def _enter(self, name: str, events: int):
+        now = time.perf_counter()
+        if self._active:
+            parent = self._active[-1]
+            self.stages[parent[0]].time += now - parent[1]
+        stats = self.stages[name]
+        stats.calls += 1
+        stats.events += events
+        self._active.append([name, now])
+
+    def _exit(self):
+        now = time.perf_counter()
+        name, start = self._active.pop()
+        self.stages[name].time += now - start
+        if self._active:
+            self._active[-1][1] = now
+
+
+def profile_propagation(source, scene, logger=None, profile: PropagationProfile = None,
+                        showProgress: bool = False) -> PropagationProfile:
+    """
+    Propagates a pytissueoptics source with `source.propagate` on the CPU while profiling its photons. The OpenCL
+    kernel cannot be instrumented, so a source built with hardware acceleration (whose photons were loaded as
+    `CLPhotons`) is given CPU photons drawn from its distribution for the run, then restored to its OpenCL photons.
+
+    Args:
+        source (Source): The photon source.
+        scene (ScatteringScene): The scene to propagate in.
+        logger (EnergyLogger): Optional logger, as for `source.propagate`.
+        profile (PropagationProfile): Profile to add to. A new one is created by default.
+        showProgress (bool): Show the propagation progress bar.
+    """
+    profile = profile or PropagationProfile()
+    useHardwareAcceleration = source._useHardwareAcceleration
+    photons = source._photons
+    source._useHardwareAcceleration = False
+    try:
+        if useHardwareAcceleration:
+            source._photons = []
+            source._loadPhotonsCPU()
+        with _instrumented_photons(profile):
+            source.propagate(scene, logger=logger, showProgress=showProgress)
+    finally:
+        source._useHardwareAcceleration = useHardwareAcceleration
+        source._photons = photons
+    return profile
+
+
+@contextmanager
+def _instrumented_photons(profile: PropagationProfile):
+    original = {name: getattr(Photon, name) for name in ("propagate", "_getIntersection", "reflectOrRefract",
+                                                         "scatter", "roulette", "_logIntersection",
+                                                         "_logWeightDecrease", "_detectAndLog")}
+
+    def propagate(photon):
+        profile.photon_count += 1
+        with profile.stage("other"):
+            original["propagate"](photon)
+
+    def getIntersection(photon, distance):
+        with profile.stage("geometry", 1):
+            return original["_getIntersection"](photon, distance)
+
+    def reflectOrRefract(photon, intersection):
+        label = photon.solidLabel
+        with profile.stage("interface", 1):
+            distanceLeft = original["reflectOrRefract"](photon, intersection)
+        if photon.solidLabel == label:
+            profile.count(label, "reflections")
+        else:
+            profile.count(label, "crossings_out")
+            profile.count(photon.solidLabel, "crossings_in")
+        return distanceLeft
+
+    def scatter(photon):
+        profile.count(photon.solidLabel, "interactions")
+        with profile.stage("scattering", 1):
+            original["scatter"](photon)
+
+    def roulette(photon):
+        weight = photon.weight
+        with profile.stage("roulette", 1 if 0 < weight < WEIGHT_THRESHOLD else 0):
+            original["roulette"](photon)
+        if weight > 0 and photon.weight == 0:
+            profile.count(photon.solidLabel, "roulette_kills")
+
+    def logged(name: str):
+        def log(photon, *args):
+            with profile.stage("logging", 1 if photon._logger else 0):
+                original[name](photon, *args)
+        return log
+
+    wrappers = dict(propagate=propagate, _getIntersection=getIntersection, reflectOrRefract=reflectOrRefract,
+                    scatter=scatter, roulette=roulette, _logIntersection=logged("_logIntersection"),
+                    _logWeightDecrease=logged("_logWeightDecrease"), _detectAndLog=logged("_detectAndLog"))
+    for name, wrapper in wrappers.items():
+        setattr(Photon, name, wrapper)
+    try:
+        yield profile
+    finally:
+        for name, method in original.items():
+            setattr(Photon, name, method)
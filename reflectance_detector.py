@@ -0,0 +1,188 @@
+"""
+Surface reflectance detector for backscatter studies.
+
+Backscattered light was studied by logging the full volumetric deposition with an `EnergyLogger` and looking at a
+depth slice or a 1D profile as a stand-in. A `ReflectanceDetector` is instead attached to the entry surface of the top
+layer: it only receives the photons leaving the tissue through it, binned by their radial distance to the source axis,
+their exit angle and optionally their path length in the tissue. When it is the only logger of a propagation, the
+volumetric interactions are not recorded at all, so its memory is a few histograms whatever the number of photons.
+
+The specular reflection at the entry surface is not part of the detected light, as with the `EnergyLogger` surfaces.
+
+Usage:
+    detector = ReflectanceDetector(max_radius=1, max_path_length=2)
+    propagate_layered(source, scene, logger=detector)
+    radii, reflectance, error = detector.radial_reflectance()
+    detector.plot()
+"""
+from typing import Tuple
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+
+class ReflectanceDetector:
+    """
+    Weight of the photons leaving the entry surface binned by radius, exit angle and path length.
+
+    It has the `logExitArray` interface used by `SlabPropagator` and is given to a propagator instead of an
+    `EnergyLogger`. Photons leaving beyond `max_radius` or `max_path_length` are kept in overflow bins so that the
+    total reflectance remains exact.
+
+    Args:
+        max_radius (float): Radius covered by the radial bins (cm).
+        radial_bin_size (float): Radial resolution (cm).
+        angle_bins (int): Number of exit angle bins between 0 (normal to the surface) and 90 degrees.
+        center (Tuple[float, float]): (x, y) position of the source axis.
+        max_path_length (float): Path length covered by the path length bins (cm). If None, path lengths are not
+            tracked.
+        path_length_bin_size (float): Path length resolution (cm).
+    """
+    hasFilePath = False
+
+    def __init__(self, max_radius: float = 1.0, radial_bin_size: float = 0.01, angle_bins: int = 18,
+                 center: Tuple[float, float] = (0, 0), max_path_length: float = None,
+                 path_length_bin_size: float = 0.01):
+        self.info = {}
+        self._center = np.asarray(center, dtype=float)
+        self._radial_bin_size = radial_bin_size
+        self._n_radii = max(1, int(round(max_radius / radial_bin_size)))
+        self._n_angles = angle_bins
+        self._path_length_bin_size = path_length_bin_size
+        self._n_path_lengths = 0 if max_path_length is None else max(1, int(round(max_path_length /
+                                                                                  path_length_bin_size)))
+        shape = (self._n_radii + 1, self._n_angles, self._n_path_lengths + 1)
+        self._weight = np.zeros(shape)
+        self._weight_squared = np.zeros(shape)
+
+    @property
+    def requiresPathLength(self) -> bool:
+        return self._n_path_lengths > 0
+
+    @property
+    def radii(self) -> np.ndarray:
+        """Edges of the radial bins (cm)."""
+        return np.arange(self._n_radii + 1) * self._radial_bin_size
+
+    @property
+    def angles(self) -> np.ndarray:
+        """Edges of the exit angle bins (radians)."""
+        return np.linspace(0, np.pi / 2, self._n_angles + 1)
+
+    @property
+    def path_lengths(self) -> np.ndarray:
+        """Edges of the path length bins (cm)."""
+        return np.arange(self._n_path_lengths + 1) * self._path_length_bin_size
+
+    @property
+    def photon_count(self) -> int:
+        return self.info.get("photonCount") or 0
+
+    @property
+    def histogram(self) -> np.ndarray:
+        """Detected weight per (radius, angle, path length) bin, with the overflow bins last along radius and path."""
+        return self._weight
+
+    def logExitArray(self, array: np.ndarray):
+        """Adds exiting photons as rows of (weight, x, y, z, photonID, ux, uy, uz, path length)."""
+        if len(array) == 0:
+            return
+        radius = np.hypot(array[:, 1] - self._center[0], array[:, 2] - self._center[1])
+        radial_bin = np.minimum(np.floor(radius / self._radial_bin_size), self._n_radii).astype(np.int64)
+        angle = np.arccos(np.clip(np.abs(array[:, 7]), 0, 1))
+        angle_bin = np.minimum(np.floor(angle / (np.pi / 2) * self._n_angles), self._n_angles - 1).astype(np.int64)
+        path_bin = np.zeros(len(array), dtype=np.int64)
+        if self.requiresPathLength:
+            path_bin = np.minimum(np.floor(array[:, 8] / self._path_length_bin_size),
+                                  self._n_path_lengths).astype(np.int64)
+
+        index = np.ravel_multi_index((radial_bin, angle_bin, path_bin), self._weight.shape)
+        weight = array[:, 0]
+        self._weight += np.bincount(index, weights=weight, minlength=self._weight.size).reshape(self._weight.shape)
+        self._weight_squared += np.bincount(index, weights=weight ** 2,
+                                            minlength=self._weight.size).reshape(self._weight.shape)
+
+    def merge(self, other: "ReflectanceDetector") -> "ReflectanceDetector":
+        """Adds the detected weight of an independent detector with the same bins."""
+        if other._weight.shape != self._weight.shape or other._radial_bin_size != self._radial_bin_size or \
+                other._path_length_bin_size != self._path_length_bin_size:
+            raise ValueError("Can only merge reflectance detectors with the same bins.")
+        self._weight += other._weight
+        self._weight_squared += other._weight_squared
+        self.info["photonCount"] = self.photon_count + other.photon_count
+        return self
+
+    def total_reflectance(self) -> float:
+        """Fraction of the launched photon weight leaving through the entry surface."""
+        return float(self._weight.sum() / self._normalization())
+
+    def radial_reflectance(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Reflectance per unit area R(r) (1/cm^2) of each radial bin, normalized by the launched photons.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: Bin centers (cm), reflectance and its standard error.
+        """
+        radii = self.radii
+        areas = np.pi * (radii[1:] ** 2 - radii[:-1] ** 2)
+        return self._profile(axis=0, sizes=areas, edges=radii)
+
+    def angular_reflectance(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Reflectance per unit solid angle (1/sr) of each exit angle bin, normalized by the launched photons.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: Bin centers (degrees), reflectance and its standard error.
+        """
+        angles = self.angles
+        solid_angles = 2 * np.pi * (np.cos(angles[:-1]) - np.cos(angles[1:]))
+        centers, reflectance, error = self._profile(axis=1, sizes=solid_angles, edges=angles)
+        return np.degrees(centers), reflectance, error
+
+    def path_length_distribution(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Reflectance per unit path length (1/cm) of each path length bin, normalized by the launched photons.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: Bin centers (cm), reflectance and its standard error.
+        """
+        if not self.requiresPathLength:
+            raise ValueError("Path lengths are not tracked. Set `max_path_length` to tally them.")
+        path_lengths = self.path_lengths
+        return self._profile(axis=2, sizes=np.diff(path_lengths), edges=path_lengths)
+
+    def plot(self, title: str = None, filepath: str = None):
+        """Plots the radial, angular and path length (if tracked) reflectance. Saved to `filepath` if given."""
+        profiles = [(self.radial_reflectance(), "Radius (cm)", "R(r) (1/cm²)", True),
+                    (self.angular_reflectance(), "Exit angle (°)", "R(θ) (1/sr)", False)]
+        if self.requiresPathLength:
+            profiles.append((self.path_length_distribution(), "Path length (cm)", "R(l) (1/cm)", True))
+        figure, axes = plt.subplots(1, len(profiles), figsize=(6 * len(profiles), 5))
+        for ax, ((centers, values, errors), xlabel, ylabel, log) in zip(axes, profiles):
+            ax.errorbar(centers, values, yerr=errors, fmt=".-", markersize=3)
+            if log:
+                ax.set_yscale("log")
+            ax.set_xlabel(xlabel)
+            ax.set_ylabel(ylabel)
+            ax.grid(True)
+        figure.suptitle(title or f"Diffuse reflectance {self.total_reflectance():.4f}")
+        if filepath:
+            plt.savefig(filepath)
+            plt.close(figure)
+        else:
+            plt.show()
+
+    def _profile(self, axis: int, sizes: np.ndarray, edges: np.ndarray):
+        other_axes = tuple(i for i in range(3) if i != axis)
+        weight = self._weight.sum(axis=other_axes)[:len(sizes)]
+        weight_squared = self._weight_squared.sum(axis=other_axes)[:len(sizes)]
+        n = self._normalization()
+        # Variance of the mean contribution per launched photon, assuming one exit per photon and bin.
+        variance = np.maximum(weight_squared / n - (weight / n) ** 2, 0) / max(n - 1, 1)
+        centers = (edges[:-1] + edges[1:]) / 2
+        return centers, weight / n / sizes, np.sqrt(variance) / sizes
+
+    def _normalization(self) -> int:
+        if not self.photon_count:
+            raise ValueError("The number of launched photons is unknown. Propagate photons to the detector first.")
+        return self.photon_count
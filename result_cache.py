@@ -0,0 +1,289 @@
+"""
+Content-addressed on-disk cache of simulation results.
+
+Results are keyed by a SHA-256 digest of everything that defines a simulation: the scene geometry (solid labels,
+vertices and surface labels), the optical properties of every material at the time of the run, the source type and
+parameters, its number of photons and seed, and the propagation engine. The 3D data points of each interaction key
+are stored as separate `.npy` files which are memory-mapped when loaded, so a cached `EnergyLogger` is rebuilt in
+milliseconds and its pages are only read from disk when used. When the cache grows beyond `max_size`, the least
+recently used entries are deleted.
+
+Usage:
+    cache = ResultCache()
+    logger = cache.propagate(source, scene)  # Simulated on the first run, loaded afterwards.
+"""
+import dataclasses
+import functools
+import hashlib
+import json
+import os
+import shutil
+import time
+import warnings
+from typing import Callable, Optional
+
+import numpy as np
+from pytissueoptics import EnergyLogger, InteractionKey, ScatteringMaterial
+from pytissueoptics.scene.logger.listArrayContainer import ListArrayContainer
+from pytissueoptics.scene.logger.logger import InteractionData
+
+DEFAULT_CACHE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "results")
+DEFAULT_MAX_SIZE = 2 * 1024 ** 3
+
+# Coordinates are rounded before hashing so that equivalent geometries built in a different order share their key.
+HASH_DECIMALS = 9
+
+INDEX_FILENAME = "index.json"
+
+
+def experiment_key(scene, source, **parameters) -> str:
+    """
+    Hex digest identifying a simulation of `source` in `scene`.
+
+    Args:
+        scene (ScatteringScene): The scene. Materials are read at call time, so that materials modified after the
+            creation of the solids (as in task5.py and task8.py) are hashed with their actual values.
+        source (Source): The source. Its type, parameters, number of photons and seed are hashed.
+        **parameters: Any other JSON-serializable parameter changing the results, e.g. the propagation engine.
+    """
+    description = {
+        "solids": [_describe_solid(solid) for solid in sorted(scene.getSolids(), key=lambda s: s.getLabel())],
+        "world": _describe_material(scene.getWorldEnvironment().material),
+        "source": _describe_source(source),
+        "parameters": parameters,
+    }
+    encoded = json.dumps(description, sort_keys=True, default=_describe_value).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class ResultCache:
+    """
+    Directory of cached `EnergyLogger` results, one sub-directory per experiment key.
+
+    Args:
+        directory (str): Root directory of the cache, created if needed.
+        max_size (int): Maximum total size in bytes. Least recently used entries are evicted above it.
+    """
+
+    def __init__(self, directory: str = DEFAULT_CACHE_DIRECTORY, max_size: int = DEFAULT_MAX_SIZE):
+        self._directory = directory
+        self._max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def directory(self) -> str:
+        return self._directory
+
+    @property
+    def size(self) -> int:
+        """Total size of the cached entries in bytes."""
+        return sum(self._entry_size(key) for key in self._keys())
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(os.path.join(self._directory, key, INDEX_FILENAME))
+
+    def propagate(self, source, scene, engine: Callable = None, show_progress: bool = True,
+                  engine_key: str = None, **logger_kwargs) -> EnergyLogger:
+        """
+        Returns the logger of the simulation of `source` in `scene`, from the cache if it was already run.
+
+        Args:
+            source (Source): The photon source.
+            scene (ScatteringScene): The scene.
+            engine (Callable): Optional propagation function called as `engine(source, scene, logger)`, such as
+                `propagate_layered` or `functools.partial(propagate_layered, stack=stack)`. Defaults to
+                `source.propagate`. Named functions are keyed by their qualified name and partials also by their
+                arguments.
+            show_progress (bool): Print whether the result was loaded or simulated.
+            engine_key (str): Explicit key of the engine, required for engines without a qualified name such as
+                lambdas and local functions. It must change whenever the engine gives different results.
+            **logger_kwargs: Forwarded to the `EnergyLogger`. With `keep3D=False`, the simulation is still cached
+                with its 3D data, then binned into the requested logger.
+
+        Unseeded sources draw different photons at every run, so their results are simulated but never cached.
+        """
+        if getattr(source, "_seed", None) is None:
+            warnings.warn("WARNING: The source has no seed, its results are not cached. Seed the source to cache them.")
+            return self._simulate(source, scene, EnergyLogger(scene, **logger_kwargs), engine, show_progress)
+
+        if engine_key is None:
+            engine_key = _describe_engine(engine)
+        key = experiment_key(scene, source, engine=engine_key)
+        logger = self.load(key, scene, **logger_kwargs)
+        if logger is not None:
+            if show_progress:
+                print(f"Loaded {logger.info.get('photonCount')} photons from cache entry {key[:12]}.")
+            return logger
+
+        logger = self._simulate(source, scene, EnergyLogger(scene, **dict(logger_kwargs, keep3D=True)), engine,
+                                show_progress)
+        self.store(key, logger)
+        if logger_kwargs.get("keep3D", True):
+            return logger
+        return self.load(key, scene, **logger_kwargs)
+
+    def load(self, key: str, scene, **logger_kwargs) -> Optional[EnergyLogger]:
+        """
+        Rebuilds the cached logger of `key`, or returns None on a cache miss. The 3D data points are memory-mapped
+        (read-only) when the logger keeps 3D data; otherwise they are binned to its views as they are loaded.
+        """
+        if key not in self:
+            return None
+        entry = os.path.join(self._directory, key)
+        index_path = os.path.join(entry, INDEX_FILENAME)
+        with open(index_path) as file:
+            index = json.load(file)
+        os.utime(index_path)
+
+        logger = EnergyLogger(scene, **logger_kwargs)
+        logger.info.update(index["info"])
+        for item in index["keys"]:
+            interaction_key = InteractionKey(item["solidLabel"], item["surfaceLabel"])
+            data = np.load(os.path.join(entry, item["filename"]), mmap_mode="r")
+            if logger.has3D:
+                # Bypasses `logDataPointArray` which would copy the memory-mapped array.
+                logger._validateKey(interaction_key)
+                container = ListArrayContainer()
+                container._array = data
+                logger._data[interaction_key] = InteractionData(dataPoints=container)
+            else:
+                logger.logDataPointArray(np.asarray(data), interaction_key)
+        logger._outdatedViews = set(logger.views)
+        return logger
+
+    def store(self, key: str, logger: EnergyLogger):
+        """Writes the 3D data points of a logger under `key`, then evicts old entries if needed."""
+        if not logger.has3D:
+            raise ValueError("Only loggers keeping their 3D data (keep3D=True) can be cached.")
+        entry = os.path.join(self._directory, key)
+        temporary = f"{entry}.{os.getpid()}.tmp"
+        os.makedirs(temporary, exist_ok=True)
+
+        items = []
+        for index, (interaction_key, data) in enumerate(logger._data.items()):
+            if data.dataPoints is None or len(data.dataPoints) == 0:
+                continue
+            filename = f"{index:04d}.npy"
+            np.save(os.path.join(temporary, filename), data.dataPoints.getData())
+            items.append({"solidLabel": interaction_key.solidLabel, "surfaceLabel": interaction_key.surfaceLabel,
+                          "filename": filename})
+        info = {name: value for name, value in logger.info.items() if _is_json_value(value)}
+        with open(os.path.join(temporary, INDEX_FILENAME), "w") as file:
+            json.dump({"keys": items, "info": info, "created": time.time()}, file)
+
+        try:
+            os.replace(temporary, entry)
+        except OSError:
+            # The entry was stored meanwhile (e.g. by another process running the same experiment).
+            shutil.rmtree(temporary, ignore_errors=True)
+        self.evict(keep=key)
+
+    def evict(self, max_size: int = None, keep: str = None):
+        """
+        Deletes the least recently used entries until the cache fits in `max_size` (defaults to the cache size limit).
+        The entry `keep` is never deleted, even if it is larger than the limit on its own.
+        """
+        max_size = self._max_size if max_size is None else max_size
+        sizes = {key: self._entry_size(key) for key in self._keys()}
+        total = sum(sizes.values())
+        for key in sorted(sizes, key=self._last_access):
+            if total <= max_size:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(self._directory, key), ignore_errors=True)
+            total -= sizes[key]
+
+    def clear(self):
+        self.evict(max_size=0)
+
+    @staticmethod
+    def _simulate(source, scene, logger: EnergyLogger, engine: Optional[Callable], show_progress: bool) -> EnergyLogger:
+        if engine is None:
+            source.propagate(scene, logger=logger, showProgress=show_progress)
+        else:
+            engine(source, scene, logger)
+        return logger
+
+    def _keys(self):
+        return [key for key in os.listdir(self._directory) if key in self]
+
+    def _entry_size(self, key: str) -> int:
+        entry = os.path.join(self._directory, key)
+        return sum(os.path.getsize(os.path.join(entry, filename)) for filename in os.listdir(entry))
+
+    def _last_access(self, key: str) -> float:
+        return os.path.getmtime(os.path.join(self._directory, key, INDEX_FILENAME))
+
+
+def _describe_solid(solid) -> dict:
+    vertices = np.round([vertex.array for vertex in solid.getVertices()], HASH_DECIMALS) + 0.0
+    vertices = vertices[np.lexsort(vertices.T[::-1])]
+    surfaces = {}
+    for surface_label in solid.surfaceLabels:
+        polygons = solid.getPolygons(surface_label)
+        surfaces[surface_label] = {
+            "polygons": len(polygons),
+            "inside": _describe_material(polygons[0].insideEnvironment.material) if polygons else None,
+            "outside": _describe_material(polygons[0].outsideEnvironment.material) if polygons else None,
+        }
+    return {"label": solid.getLabel(), "vertices": hashlib.sha256(vertices.tobytes()).hexdigest(),
+            "material": _describe_material(solid.getEnvironment().material), "surfaces": surfaces}
+
+
+def _describe_material(material) -> Optional[list]:
+    if material is None:
+        return None
+    return [getattr(material, name, None) for name in ("mu_s", "mu_a", "g", "n")]
+
+
+def _describe_source(source) -> dict:
+    return {"type": type(source).__name__, "components": list(source._hashComponents),
+            "N": source.getPhotonCount(), "seed": getattr(source, "_seed", None)}
+
+
+def _describe_engine(engine: Optional[Callable]):
+    if engine is None:
+        return None
+    if isinstance(engine, functools.partial):
+        return {"function": _describe_engine(engine.func), "args": list(engine.args),
+                "keywords": dict(engine.keywords)}
+    name = getattr(engine, "__qualname__", None)
+    if name is None or "<lambda>" in name or "<locals>" in name:
+        raise ValueError(f"The engine {engine!r} cannot be identified by its name. Use a module-level function or "
+                         f"pass an explicit `engine_key`.")
+    return f"{engine.__module__}.{name}"
+
+
+def _describe_value(value):
+    if hasattr(value, "array"):
+        return np.round(value.array, HASH_DECIMALS).tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return {"shape": list(value.shape), "data": hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest()}
+    if isinstance(value, ScatteringMaterial):
+        return _describe_material(value)
+    if callable(value):
+        return _describe_engine(value)
+    # Dataclasses and plain objects (such as a `LayerStack` given to a partial engine) are described by their fields,
+    # never by their default repr, which holds a memory address that can be reused by another object.
+    if dataclasses.is_dataclass(value):
+        attributes = {field.name: getattr(value, field.name) for field in dataclasses.fields(value)}
+    elif hasattr(value, "__dict__"):
+        attributes = vars(value)
+    else:
+        return repr(value)
+    return {"type": type(value).__name__, **{name: _string_keys(attribute) for name, attribute in attributes.items()}}
+
+
+def _string_keys(value):
+    if isinstance(value, dict):
+        return {str(key): _string_keys(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_string_keys(item) for item in value]
+    return value
+
+
+def _is_json_value(value) -> bool:
+    return value is None or isinstance(value, (str, int, float, bool))
@@ -0,0 +1,934 @@
+"""
+Planar-slab (MCML-style) photon propagation for laterally wide layer stacks.
+
+Every skin model in this repository is a z-stack of axis-aligned Cuboids. Instead of ray-tracing each photon step
+against the triangle mesh, the propagator below moves whole batches of photons as NumPy arrays and only computes
+distances to the planes bounding the current layer. The interaction data is written to a regular `EnergyLogger` with
+the same keys (layer label, surface label) and sign conventions as `Source.propagate`, so `Viewer.show2D`,
+`Viewer.show1D` and `Viewer.reportStats` keep working.
+
+Usage:
+    scene = ScatteringScene([stacked_tissue])
+    logger = EnergyLogger(scene)
+    source = DivergentSource(position=Vector(0, 0, -0.2), direction=Vector(0, 0, 1), N=N, diameter=0.1, divergence=0.4)
+    propagate_layered(source, scene, logger=logger)
+"""
+import time
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from pytissueoptics import EnergyLogger, InteractionKey, ScatteringMaterial
+
+from profiling import PropagationProfile
+
+# Same constants as the pytissueoptics Photon so both engines give statistically identical results.
+WEIGHT_THRESHOLD = 1e-4
+ROULETTE_CHANCE = 0.1
+
+# Geometric tolerance (cm) when comparing plane coordinates extracted from the scene meshes.
+TOLERANCE = 1e-6
+
+# Lateral faces of a layer, in the order of the (axis, side) pairs used internally.
+SIDE_NAMES = {(0, 0): "left", (0, 1): "right", (1, 0): "bottom", (1, 1): "top"}
+
+# Maximum number of copies a photon is split into by default, bounding the growth of a batch.
+MAX_SPLIT = 16
+
+# Shared no-op stage used when the propagation is not profiled.
+_NOT_PROFILED = nullcontext()
+
+# Constants of the SplitMix64 generator used by the per-photon random streams.
+_GOLDEN_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+_MIX_1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX_2 = np.uint64(0x94D049BB133111EB)
+
+
+@dataclass
+class SlabLayer:
+    """
+    A single planar layer of the stack, spanning [z_min, z_max].
+
+    The surface labels default to the ones created by `Cuboid.stack(..., "back")` so that the logged keys match the
+    ones of the mesh-based propagation.
+    """
+    label: str
+    material: ScatteringMaterial
+    z_min: float
+    z_max: float
+    front_label: Optional[str] = None
+    back_label: Optional[str] = None
+    side_labels: Dict[Tuple[int, int], str] = field(default_factory=dict)
+
+    @property
+    def thickness(self) -> float:
+        return self.z_max - self.z_min
+
+
+class LayerStack:
+    """
+    Ordered stack of contiguous planar layers, from the entry surface (lowest z) to the deepest layer.
+
+    Args:
+        layers (List[SlabLayer]): Contiguous layers sorted by depth.
+        lateral_limits (tuple): Optional ((x_min, x_max), (y_min, y_max)) common to all layers. Photons crossing these
+            planes leave the tissue. None means laterally infinite layers.
+        world_material (ScatteringMaterial): Non-scattering medium surrounding the stack.
+    """
+
+    def __init__(self, layers: List[SlabLayer], lateral_limits=None, world_material: ScatteringMaterial = None):
+        if len(layers) == 0:
+            raise ValueError("A layer stack requires at least one layer.")
+        self.layers = sorted(layers, key=lambda layer: layer.z_min)
+        self.lateral_limits = lateral_limits
+        self.world_material = world_material or ScatteringMaterial()
+
+        for above, below in zip(self.layers[:-1], self.layers[1:]):
+            if abs(above.z_max - below.z_min) > TOLERANCE:
+                raise ValueError(f"Layers '{above.label}' and '{below.label}' are not contiguous "
+                                 f"(z={above.z_max} and z={below.z_min}).")
+        if _total_attenuation(self.world_material) != 0:
+            raise ValueError("The planar-slab propagation requires a non-scattering world material.")
+
+        self._complete_surface_labels()
+
+    @classmethod
+    def from_thicknesses(cls, labels: List[str], materials: List[ScatteringMaterial], thicknesses: List[float],
+                         z_top: float = 0, width: float = None, world_material: ScatteringMaterial = None):
+        """
+        Builds a stack explicitly, e.g. for scenes that cannot be detected automatically such as the overlapping
+        `SkinModel` of task5.py and task8.py.
+
+        Args:
+            labels (List[str]): Layer labels, from the surface down.
+            materials (List[ScatteringMaterial]): One material per layer.
+            thicknesses (List[float]): One thickness per layer (cm).
+            z_top (float): Depth of the entry surface (cm).
+            width (float): Lateral size of the (square) layers. None for laterally infinite layers.
+            world_material (ScatteringMaterial): Medium surrounding the stack.
+        """
+        layers = []
+        z = z_top
+        for label, material, thickness in zip(labels, materials, thicknesses):
+            layers.append(SlabLayer(label, material, z, z + thickness))
+            z += thickness
+        lateral_limits = None
+        if width is not None:
+            lateral_limits = ((-width / 2, width / 2), (-width / 2, width / 2))
+        return cls(layers, lateral_limits, world_material)
+
+    @classmethod
+    def from_scene(cls, scene) -> "LayerStack":
+        """
+        Detects the layer stack of a `ScatteringScene` made of axis-aligned Cuboids (stacked or not) that share the
+        same lateral footprint and do not overlap. Raises a ValueError otherwise.
+        """
+        faces: Dict[str, Dict[Tuple[int, int], Tuple[float, str]]] = {}
+        materials: Dict[str, ScatteringMaterial] = {}
+
+        for solid in scene.solids:
+            if solid.isDetector:
+                raise ValueError(f"Solid '{solid.getLabel()}' is a detector, which is not supported by the "
+                                 f"planar-slab propagation.")
+            for surface_label in solid.surfaceLabels:
+                for polygon in solid.getPolygons(surface_label):
+                    axis, direction = _get_axis_of(polygon.normal, solid.getLabel())
+                    coordinate = polygon.vertices[0].array[axis]
+                    for environment, orientation in ((polygon.insideEnvironment, 1), (polygon.outsideEnvironment, -1)):
+                        if environment is None or environment.solid is None:
+                            continue
+                        side = int(direction * orientation > 0)
+                        layer_faces = faces.setdefault(environment.solidLabel, {})
+                        materials[environment.solidLabel] = environment.material
+                        previous = layer_faces.setdefault((axis, side), (coordinate, surface_label))
+                        if abs(previous[0] - coordinate) > TOLERANCE:
+                            raise ValueError(f"Solid '{environment.solidLabel}' is not a box aligned with the axes.")
+
+        layers = []
+        lateral_limits = None
+        for label, layer_faces in faces.items():
+            if len(layer_faces) != 6:
+                raise ValueError(f"Solid '{label}' is not a box aligned with the axes.")
+            limits = tuple((layer_faces[(axis, 0)][0], layer_faces[(axis, 1)][0]) for axis in range(2))
+            if lateral_limits is None:
+                lateral_limits = limits
+            elif not np.allclose(limits, lateral_limits, atol=TOLERANCE):
+                raise ValueError(f"Solid '{label}' does not share the lateral footprint of the other layers. Use "
+                                 f"an explicit LayerStack instead.")
+            side_labels = {key: layer_faces[key][1] for key in SIDE_NAMES}
+            layers.append(SlabLayer(label, materials[label], layer_faces[(2, 0)][0], layer_faces[(2, 1)][0],
+                                    layer_faces[(2, 0)][1], layer_faces[(2, 1)][1], side_labels))
+
+        try:
+            return cls(layers, lateral_limits, scene.getWorldEnvironment().material)
+        except ValueError as error:
+            raise ValueError(f"The scene is not a planar layer stack: {error} Overlapping solids (such as scenes "
+                             f"created with ignoreIntersections=True) require an explicit LayerStack.") from error
+
+    def _complete_surface_labels(self):
+        last = len(self.layers) - 1
+        for i, layer in enumerate(self.layers):
+            if layer.front_label is None:
+                layer.front_label = f"{layer.label}_front" if i == 0 else f"interface{i - 1}"
+            if layer.back_label is None:
+                layer.back_label = f"{layer.label}_back" if i == last else f"interface{i}"
+            for key, name in SIDE_NAMES.items():
+                layer.side_labels.setdefault(key, f"{layer.label}_{name}")
+
+    @property
+    def labels(self) -> List[str]:
+        return [layer.label for layer in self.layers]
+
+    @property
+    def z_top(self) -> float:
+        return self.layers[0].z_min
+
+    @property
+    def z_bottom(self) -> float:
+        return self.layers[-1].z_max
+
+    def layer_at(self, z: np.ndarray) -> np.ndarray:
+        """Layer index at each depth, -1 above the stack and len(layers) below it."""
+        boundaries = np.array([layer.z_min for layer in self.layers] + [self.z_bottom])
+        return np.searchsorted(boundaries, z, side="right") - 1
+
+    def interaction_keys(self) -> List[InteractionKey]:
+        """
+        All the keys logged for this stack: first the volumetric key of each layer, then the front, back and 4 lateral
+        surfaces of each layer.
+        """
+        keys = [InteractionKey(layer.label) for layer in self.layers]
+        for layer in self.layers:
+            surface_labels = [layer.front_label, layer.back_label] + [layer.side_labels[key] for key in SIDE_NAMES]
+            keys.extend(InteractionKey(layer.label, surface_label) for surface_label in surface_labels)
+        return keys
+
+    def optical_arrays(self, materials: List[ScatteringMaterial] = None):
+        """
+        Per-layer (mu_t, albedo, g, n) arrays. The world is appended as the last entry.
+
+        Args:
+            materials (List[ScatteringMaterial]): Optional materials replacing the ones of the layers, in order.
+        """
+        materials = materials or [layer.material for layer in self.layers]
+        mu_t = np.array([_total_attenuation(m) for m in materials] + [0.0])
+        mu_a = np.array([m.mu_a for m in materials] + [0.0])
+        albedo = np.divide(mu_a, mu_t, out=np.zeros_like(mu_a), where=mu_t > 0)
+        g = np.array([m.g for m in materials] + [0.0])
+        n = np.array([m.n for m in materials] + [self.world_material.n])
+        return mu_t, albedo, g, n
+
+
+@dataclass
+class VarianceReduction:
+    """
+    Variance-reduction settings of a `SlabPropagator`. Every technique keeps the expected tallies unchanged: a photon
+    split into n copies gives each of them 1/n of its weight, and a photon surviving a roulette of probability p has its
+    weight divided by p. Copies keep the photon ID of their parent, so per-photon tallies remain per launched photon.
+
+    Args:
+        roulette_threshold (float): Weight below which photons play Russian roulette.
+        roulette_chance (float): Survival probability of that roulette.
+        importance (Dict[str, float]): Importance of layers by label (1 for unlisted layers). A photon entering a layer
+            of higher importance is split into I_new / I_old copies (randomly rounded), and a photon entering a layer
+            of lower importance survives with a probability of I_new / I_old.
+        weight_window (Tuple[float, float]): Optional (low, high) weight bounds in layers of importance 1, divided by
+            the importance of the other layers. Heavier photons are split to fit under the window and lighter photons
+            play Russian roulette to survive at the center of the window.
+        max_split (int): Maximum number of copies a photon is split into at once.
+    """
+    roulette_threshold: float = WEIGHT_THRESHOLD
+    roulette_chance: float = ROULETTE_CHANCE
+    importance: Dict[str, float] = field(default_factory=dict)
+    weight_window: Optional[Tuple[float, float]] = None
+    max_split: int = MAX_SPLIT
+
+    def __post_init__(self):
+        if not 0 < self.roulette_chance <= 1:
+            raise ValueError("The roulette chance must be in (0, 1].")
+        if any(importance <= 0 for importance in self.importance.values()):
+            raise ValueError("Layer importances must be positive.")
+        if self.weight_window is not None and not 0 < self.weight_window[0] < self.weight_window[1]:
+            raise ValueError("The weight window must be given as (low, high) with 0 < low < high.")
+
+
+class PhotonBatch:
+    """Struct of arrays holding the state of the photons propagated together."""
+    def __init__(self, position: np.ndarray, direction: np.ndarray, channel: np.ndarray, ids: np.ndarray):
+        self.position = position
+        self.direction = direction
+        self.channel = channel
+        self.ids = ids
+        self.weight = np.ones(len(position))
+        self.layer = np.zeros(len(position), dtype=np.int64)
+        self.step_left = np.zeros(len(position))
+        self.path_length: Optional[np.ndarray] = None
+        self.draws: Optional[np.ndarray] = None
+
+    def __len__(self):
+        return len(self.weight)
+
+    def move(self, mask, distance):
+        self.position[mask] += self.direction[mask] * distance[:, None]
+        if self.path_length is not None:
+            self.path_length[mask, self.layer[mask]] += distance
+
+    def keep(self, mask):
+        """Compacts the batch to the masked photons."""
+        for name, value in vars(self).items():
+            if value is not None:
+                setattr(self, name, value[mask])
+
+    def split(self, counts: np.ndarray):
+        """Appends `counts - 1` copies of each photon to the batch. Weights are left to the caller."""
+        copies = np.repeat(np.arange(len(self)), np.maximum(counts, 1) - 1)
+        if len(copies) == 0:
+            return
+        for name, value in vars(self).items():
+            if value is not None:
+                setattr(self, name, np.concatenate((value, value[copies])))
+
+
+class PhotonStreams:
+    """
+    Counter-based random streams, one per photon ID: the k-th number drawn by photon i only depends on (seed, i, k).
+    Given as the `rng` of a propagator, the same photons launched through several scenes share their random numbers,
+    so their histories stay identical until their paths differ (correlated sampling). Each photon of a `PhotonBatch`
+    counts its draws in `draws`.
+
+    Args:
+        seed (int): Seed of all the streams. Defaults to a random seed.
+    """
+
+    def __init__(self, seed: int = None):
+        self.seed = seed
+        self._key = np.random.SeedSequence(seed).generate_state(1, np.uint64)
+
+    def draw(self, photons: PhotonBatch, mask: np.ndarray) -> np.ndarray:
+        """Next uniform number in [0, 1) of the stream of each masked photon."""
+        if photons.draws is None:
+            photons.draws = np.zeros(len(photons), dtype=np.uint64)
+        ids = photons.ids[mask].astype(np.uint64)
+        counter = photons.draws[mask]
+        photons.draws[mask] += np.uint64(1)
+        state = _mix(_mix(self._key + ids * _GOLDEN_GAMMA) + (counter + np.uint64(1)) * _GOLDEN_GAMMA)
+        return (state >> np.uint64(11)) * 2.0 ** -53
+
+
+def uniform(rng, photons: PhotonBatch, mask: np.ndarray) -> np.ndarray:
+    """One uniform number in [0, 1) per masked photon, drawn from `rng` or from the photon streams."""
+    if isinstance(rng, PhotonStreams):
+        return rng.draw(photons, mask)
+    return rng.random(np.count_nonzero(mask))
+
+
+def _mix(z: np.ndarray) -> np.ndarray:
+    """SplitMix64 output function (wrapping uint64 arithmetic)."""
+    z = (z ^ (z >> np.uint64(30))) * _MIX_1
+    z = (z ^ (z >> np.uint64(27))) * _MIX_2
+    return z ^ (z >> np.uint64(31))
+
+
+class SlabPropagator:
+    """
+    Vectorized propagation of photon batches through a `LayerStack`.
+
+    Photons carry a channel index selecting the optical properties used for them, so that several sets of materials
+    (e.g. wavelengths) can share the same batch. Each channel logs to its own logger. By default, a single channel
+    uses the materials of the stack.
+
+    Args:
+        stack (LayerStack): The planar layers to propagate through.
+        batch_size (int): Maximum number of photons propagated together, bounding memory usage.
+        channel_materials (List[List[ScatteringMaterial]]): Optional list of per-layer materials, one per channel.
+        variance_reduction (VarianceReduction): Roulette, splitting and layer importance settings. Defaults to the
+            roulette of the pytissueoptics photons only.
+    """
+
+    def __init__(self, stack: LayerStack, batch_size: int = 100000,
+                 channel_materials: List[List[ScatteringMaterial]] = None,
+                 variance_reduction: VarianceReduction = None):
+        self._stack = stack
+        self._batch_size = batch_size
+        self._variance_reduction = variance_reduction or VarianceReduction()
+        self._importance = self._importance_array(self._variance_reduction.importance)
+        channel_materials = channel_materials or [[layer.material for layer in stack.layers]]
+        optics = [stack.optical_arrays(materials) for materials in channel_materials]
+        self._mu_t, self._albedo, self._g, self._n = (np.array(values) for values in zip(*optics))
+        self._z_min = np.array([layer.z_min for layer in stack.layers] + [np.nan])
+        self._z_max = np.array([layer.z_max for layer in stack.layers] + [np.nan])
+
+        # Interaction keys are referred to by their index while propagating.
+        self._keys = stack.interaction_keys()
+        self._surface_key_offset = len(stack.layers)
+        self._records: List[np.ndarray] = []
+        self._exits: List[np.ndarray] = []
+        self._recording = True
+        self._detecting = False
+
+        # Per-layer path lengths are only tracked when required (e.g. for absorption reweighting).
+        self._track_path_lengths = False
+        self._max_path_length: Optional[float] = None
+        self._source_solid_label: Optional[str] = None
+        self._profile: Optional[PropagationProfile] = None
+
+    @property
+    def stack(self) -> LayerStack:
+        return self._stack
+
+    @property
+    def n_channels(self) -> int:
+        return len(self._mu_t)
+
+    @property
+    def variance_reduction(self) -> VarianceReduction:
+        return self._variance_reduction
+
+    @property
+    def source_solid_label(self) -> Optional[str]:
+        """Label of the layer containing the source, as located by the last launch (None outside the stack)."""
+        return self._source_solid_label
+
+    def propagate(self, source, logger: EnergyLogger = None, show_progress: bool = True,
+                  rng: np.random.Generator = None, profile: PropagationProfile = None):
+        """
+        Propagates all the photons of a pytissueoptics `Source` and logs them to the given logger.
+
+        Args:
+            source (Source): Any pytissueoptics source; only its initial positions and directions are used.
+            logger (EnergyLogger): Logger receiving the deposited and surface-crossing energy.
+            show_progress (bool): Print the photon count and the propagation time.
+            rng (np.random.Generator): Random generator. Defaults to one seeded with the source seed, if any.
+            profile (PropagationProfile): Optional profile receiving the time and events of each propagation stage.
+        """
+        self._profile = profile
+        try:
+            self._propagate_source(source, [logger] * self.n_channels, show_progress, rng)
+        finally:
+            self._profile = None
+
+    def _propagate_source(self, source, loggers: List[Optional[EnergyLogger]], show_progress: bool,
+                          rng: Optional[np.random.Generator]):
+        if rng is None:
+            rng = np.random.default_rng(getattr(source, "_seed", None))
+        positions, directions = source.getInitialPositionsAndDirections()
+        self._locate_source(positions)
+        for logger in set(loggers) - {None}:
+            self._prepare_logger(logger, source)
+
+        t0 = time.time()
+        if show_progress:
+            print(f"Propagating {len(positions)} photons through {len(self._stack.layers)} planar layers"
+                  f"{f' for {self.n_channels} channels' if self.n_channels > 1 else ''}...")
+        batch_size = max(1, self._batch_size // self.n_channels)
+        for start in range(0, len(positions), batch_size):
+            stop = start + batch_size
+            self.propagate_batch(positions[start:stop], directions[start:stop], loggers, rng, first_id=start)
+        if show_progress:
+            print(f"... done in {time.time() - t0:.2f}s")
+
+        for logger in set(loggers) - {None}:
+            if logger.hasFilePath:
+                logger.save()
+
+    def propagate_batch(self, positions: np.ndarray, directions: np.ndarray, loggers=None,
+                        rng: np.random.Generator = None, first_id: int = 0):
+        """
+        Propagates one batch of photons given their (N, 3) initial positions and normalized directions. Every photon
+        is launched once in each channel.
+
+        Args:
+            positions (np.ndarray): Initial positions.
+            directions (np.ndarray): Initial normalized directions.
+            loggers: A logger, or a list with one logger per channel (None entries are not logged). Loggers with a
+                `logExitArray` method, such as a `ReflectanceDetector`, receive the photons leaving the stack through
+                its entry surface. Loggers requiring path lengths also receive the optical path length (the path
+                length weighted by the refractive index of each layer) of every data point and exiting photon.
+            rng (np.random.Generator): Random generator, or `PhotonStreams` to draw from per-photon streams.
+            first_id (int): Photon ID of the first photon of the batch.
+        """
+        rng = rng or np.random.default_rng()
+        if isinstance(rng, PhotonStreams) and (self._importance is not None or
+                                               self._variance_reduction.weight_window is not None):
+            raise ValueError("Split photons would share the random stream of their parent. Per-photon streams "
+                             "cannot be used with layer importances or weight windows.")
+        if not isinstance(loggers, (list, tuple)):
+            loggers = [loggers] * self.n_channels
+        self._records = []
+        self._exits = []
+        # Interactions are not recorded at all when every channel only detects the exiting photons.
+        self._recording = not all(hasattr(logger, "logExitArray") and not hasattr(logger, "logDataPointArray")
+                                  for logger in loggers)
+        self._detecting = any(hasattr(logger, "logExitArray") for logger in loggers)
+        track_path_lengths = self._track_path_lengths or any(getattr(logger, "requiresPathLength", False)
+                                                             for logger in loggers)
+        n_layers = len(self._stack.layers)
+
+        profile = self._profile
+        if profile is not None:
+            profile.photon_count += len(positions) * self.n_channels
+
+        with self._stage("other"):
+            photons = self._launch(positions, directions, first_id, track_path_lengths)
+            outside = (photons.layer < 0) | (photons.layer >= n_layers)
+            if np.any(outside):
+                with self._stage("interface", np.count_nonzero(outside)):
+                    self._enter_from_world(photons, outside, rng)
+            photons.keep(photons.weight > 0)
+
+            while len(photons) > 0:
+                with self._stage("geometry", len(photons)):
+                    mu_t = self._mu_t[photons.channel, photons.layer]
+                    boundary_distance, boundary_axis = self._distance_to_boundaries(photons)
+
+                # Scattering events inside the current layer.
+                with self._stage("scattering", len(photons)):
+                    new_step = photons.step_left <= 0
+                    photons.step_left[new_step] = -np.log(1 - uniform(rng, photons, new_step))
+                    with np.errstate(divide="ignore"):
+                        distance = np.where(mu_t > 0, photons.step_left / np.where(mu_t > 0, mu_t, 1), np.inf)
+                    hits = distance >= boundary_distance
+                    scatters = ~hits
+                    photons.move(scatters, distance[scatters])
+                    photons.step_left[scatters] = 0
+                    layer, channel = photons.layer[scatters], photons.channel[scatters]
+                    deposit = photons.weight[scatters] * self._albedo[channel, layer]
+                    photons.weight[scatters] -= deposit
+                    self._record(photons, scatters, deposit, layer)
+                    self._scatter(photons, scatters, self._g[channel, layer], rng)
+                if profile is not None:
+                    self._count_layers("interactions", layer)
+
+                # Photons reaching one of the planes bounding their layer.
+                if np.any(hits):
+                    with self._stage("interface", np.count_nonzero(hits)):
+                        photons.move(hits, boundary_distance[hits])
+                        photons.step_left[hits] -= boundary_distance[hits] * mu_t[hits]
+                        previous_layer = photons.layer.copy()
+                        self._cross_boundaries(photons, hits, boundary_axis, rng)
+                    if self._importance is not None:
+                        with self._stage("roulette"):
+                            self._apply_importance(photons, previous_layer, rng)
+                self._after_step(photons, scatters, rng)
+
+                with self._stage("roulette"):
+                    if self._variance_reduction.weight_window is not None:
+                        self._apply_weight_window(photons, rng)
+                    killed = self._roulette(photons, rng)
+                    self._terminate(photons)
+                if profile is not None and killed is not None:
+                    self._count_layers("roulette_kills", photons.layer[killed])
+                photons.keep(photons.weight > 0)
+
+            with self._stage("logging"):
+                self._flush(loggers)
+                self._flush_exits(loggers)
+
+    def prepare_launch(self, positions: np.ndarray) -> dict:
+        """
+        Locates the source from the initial positions of its photons before they are propagated with
+        `propagate_batch`, and returns the extra arguments of `propagate_batch` (none for planar layers).
+        """
+        self._locate_source(positions)
+        return {}
+
+    def prepare_logger(self, logger, source, positions: np.ndarray):
+        """Adds the photon count and the solid of the source to the info of a logger given to `propagate_batch`."""
+        self._locate_source(positions)
+        self._prepare_logger(logger, source)
+
+    def _launch(self, positions, directions, first_id: int, track_path_lengths: bool = False) -> PhotonBatch:
+        n_photons = len(positions)
+        photons = PhotonBatch(
+            position=np.tile(np.asarray(positions, dtype=np.float64), (self.n_channels, 1)),
+            direction=np.tile(np.asarray(directions, dtype=np.float64), (self.n_channels, 1)),
+            channel=np.repeat(np.arange(self.n_channels), n_photons),
+            ids=np.tile(np.arange(first_id, first_id + n_photons), self.n_channels),
+        )
+        photons.layer = self._stack.layer_at(photons.position[:, 2])
+        if track_path_lengths:
+            photons.path_length = np.zeros((len(photons), len(self._stack.layers)))
+        return photons
+
+    def _after_step(self, photons: PhotonBatch, scatters: np.ndarray, rng):
+        """
+        Hook called after each step with the mask of the photons that scattered, for subclasses replacing part of the
+        random walk. Photons appended by splitting (beyond the length of the mask) did not scatter.
+        """
+
+    def _terminate(self, photons: PhotonBatch):
+        """Kills photons whose total path length exceeds the optional `max_path_length`."""
+        if self._max_path_length is None or photons.path_length is None:
+            return
+        photons.weight[photons.path_length.sum(axis=1) > self._max_path_length] = 0
+
+    def _enter_from_world(self, photons: PhotonBatch, outside, rng):
+        """Moves photons starting outside the stack to the entry plane they face and refracts them in."""
+        n_layers = len(self._stack.layers)
+        layer, weight = photons.layer, photons.weight
+        uz = photons.direction[:, 2]
+        from_above = outside & (layer < 0) & (uz > 0)
+        from_below = outside & (layer >= n_layers) & (uz < 0)
+        plane = np.where(from_above, self._stack.z_top, self._stack.z_bottom)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            distance = (plane - photons.position[:, 2]) / uz
+        entering = from_above | from_below
+        # Travel in the world is not part of the tissue path length.
+        photons.position[entering] += photons.direction[entering] * distance[entering, None]
+        entering &= self._is_within_lateral_limits(photons.position)
+
+        weight[outside & ~entering] = 0
+        layer[from_above] = 0
+        layer[from_below] = n_layers - 1
+        if not np.any(entering):
+            return
+
+        target = layer.copy()
+        channel = photons.channel
+        reflected = self._fresnel(photons, entering, 2, self._n[channel, n_layers], self._n[channel, target], rng)
+        weight[reflected] = 0
+
+        refracted = entering & ~reflected
+        key = self._surface_key(target, np.where(from_above, 0, 1))
+        self._record(photons, refracted, -weight[refracted], key[refracted])
+
+    def _distance_to_boundaries(self, photons: PhotonBatch):
+        position, direction, layer = photons.position, photons.direction, photons.layer
+        distances = np.full((len(layer), 3), np.inf)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            uz = direction[:, 2]
+            z_plane = np.where(uz > 0, self._z_max[layer], self._z_min[layer])
+            distances[:, 2] = np.where(uz != 0, (z_plane - position[:, 2]) / uz, np.inf)
+            if self._stack.lateral_limits is not None:
+                for axis, (low, high) in enumerate(self._stack.lateral_limits):
+                    u = direction[:, axis]
+                    plane = np.where(u > 0, high, low)
+                    distances[:, axis] = np.where(u != 0, (plane - position[:, axis]) / u, np.inf)
+        distances = np.maximum(distances, 0)
+        axis = np.argmin(distances, axis=1)
+        return distances[np.arange(len(layer)), axis], axis
+
+    def _cross_boundaries(self, photons: PhotonBatch, hits, boundary_axis, rng):
+        n_layers = len(self._stack.layers)
+        layer, weight, direction, channel = photons.layer, photons.weight, photons.direction, photons.channel
+        current = layer.copy()
+        lateral = hits & (boundary_axis != 2)
+        going_down = direction[:, 2] > 0
+
+        # Neighbouring layer, or the world (index n_layers) when leaving the stack.
+        target = np.where(going_down, current + 1, current - 1)
+        target[lateral] = n_layers
+        target[(target < 0) | (target > n_layers)] = n_layers
+
+        reflected = np.zeros(len(layer), dtype=bool)
+        for axis in range(3):
+            axis_hits = hits & (boundary_axis == axis)
+            if np.any(axis_hits):
+                n1, n2 = self._n[channel, current], self._n[channel, target]
+                reflected |= self._fresnel(photons, axis_hits, axis, n1, n2, rng)
+
+        crossing = hits & ~reflected
+        if np.any(crossing):
+            # Energy leaving the current layer through its back (1), front (0) or lateral (2 + side) surface.
+            side_axis = np.minimum(boundary_axis, 1)
+            side = 2 + 2 * side_axis + (direction[np.arange(len(layer)), side_axis] > 0)
+            surface = np.where(lateral, side, np.where(going_down, 1, 0))
+            key = self._surface_key(current, surface)
+            self._record(photons, crossing, weight[crossing], key[crossing])
+
+            # Energy entering the next layer, through its front when going down.
+            entering = crossing & (target < n_layers)
+            key = self._surface_key(np.minimum(target, n_layers - 1), np.where(going_down, 0, 1))
+            self._record(photons, entering, -weight[entering], key[entering])
+
+            if self._detecting:
+                self._record_exits(photons, crossing & ~lateral & ~going_down & (target == n_layers))
+
+        if self._profile is not None:
+            self._count_layers("reflections", current[hits & reflected])
+            self._count_layers("crossings_out", current[crossing])
+            self._count_layers("crossings_in", target[crossing & (target < n_layers)])
+        layer[crossing] = target[crossing]
+        weight[crossing & (target == n_layers)] = 0
+
+    def _surface_key(self, layer: np.ndarray, surface: np.ndarray) -> np.ndarray:
+        return self._surface_key_offset + 6 * layer + surface
+
+    def _fresnel(self, photons: PhotonBatch, mask, axis, n1, n2, rng) -> np.ndarray:
+        """
+        Reflects or refracts the masked photons on a plane normal to `axis` (in place) and returns the reflected mask.
+        """
+        direction = photons.direction
+        reflected = np.zeros(len(direction), dtype=bool)
+        n1, n2 = n1[mask], n2[mask]
+        u = direction[mask]
+        R, cos_out = fresnel_reflectance(np.abs(u[:, axis]), n1, n2)
+
+        is_reflected = uniform(rng, photons, mask) <= R
+        refracted_u = u * (n1 / n2)[:, None]
+        refracted_u[:, axis] = np.sign(u[:, axis]) * cos_out
+        u[is_reflected, axis] *= -1
+        u[~is_reflected] = refracted_u[~is_reflected]
+        direction[mask] = u
+        reflected[mask] = is_reflected
+        return reflected
+
+    @staticmethod
+    def _scatter(photons: PhotonBatch, mask, g, rng):
+        """Henyey-Greenstein deflection of the masked photons (in place), as in MCML `Spin()`."""
+        if not np.any(mask):
+            return
+        rnd = uniform(rng, photons, mask)
+        photons.direction[mask] = deflect(photons.direction[mask], g, rnd, 2 * np.pi * uniform(rng, photons, mask))
+
+    def _roulette(self, photons: PhotonBatch, rng) -> Optional[np.ndarray]:
+        """Plays Russian roulette with the photons of low weight and returns the mask of the killed ones, if any."""
+        chance = self._variance_reduction.roulette_chance
+        weight = photons.weight
+        low = (weight < self._variance_reduction.roulette_threshold) & (weight > 0)
+        if not np.any(low):
+            return None
+        survives = uniform(rng, photons, low) < chance
+        weight[low] = np.where(survives, weight[low] / chance, 0)
+        return low & (weight == 0)
+
+    def _importance_array(self, importance: Dict[str, float]) -> Optional[np.ndarray]:
+        """Importance of each layer followed by the world (1), or None when every layer has the same importance."""
+        unknown = set(importance) - set(self._stack.labels)
+        if unknown:
+            raise ValueError(f"Cannot set the importance of unknown layers {sorted(unknown)}. "
+                             f"Available layers: {self._stack.labels}.")
+        values = np.array([importance.get(label, 1) for label in self._stack.labels] + [1], dtype=float)
+        return None if np.all(values == values[0]) else values
+
+    def _apply_importance(self, photons: PhotonBatch, previous_layer: np.ndarray, rng):
+        """Splits or plays roulette with the photons that crossed into a layer of different importance."""
+        ratio = self._importance[photons.layer] / self._importance[previous_layer]
+        ratio[photons.weight <= 0] = 1
+        ratio = np.minimum(ratio, self._variance_reduction.max_split)
+
+        weaker = ratio < 1
+        if np.any(weaker):
+            survives = uniform(rng, photons, weaker) < ratio[weaker]
+            photons.weight[weaker] = np.where(survives, photons.weight[weaker] / ratio[weaker], 0)
+
+        stronger = ratio > 1
+        if np.any(stronger):
+            # Random rounding of the ratio so that the expected number of copies is exactly the ratio.
+            counts = np.ones(len(ratio), dtype=np.int64)
+            whole = np.floor(ratio[stronger])
+            counts[stronger] = whole + (uniform(rng, photons, stronger) < ratio[stronger] - whole)
+            photons.weight[stronger] /= ratio[stronger]
+            self._split(photons, counts)
+
+    def _apply_weight_window(self, photons: PhotonBatch, rng):
+        """Splits the photons above the weight window of their layer and plays roulette with the ones below it."""
+        low, high = self._variance_reduction.weight_window
+        importance = 1 if self._importance is None else self._importance[photons.layer]
+        low, high = low / importance, high / importance
+        weight = photons.weight
+
+        light = (weight > 0) & (weight < low)
+        if np.any(light):
+            survival_weight = np.broadcast_to((low + high) / 2, weight.shape)[light]
+            survives = uniform(rng, photons, light) < weight[light] / survival_weight
+            weight[light] = np.where(survives, survival_weight, 0)
+
+        heavy = weight > high
+        if np.any(heavy):
+            counts = np.ones(len(weight), dtype=np.int64)
+            counts[heavy] = np.minimum(np.ceil(weight[heavy] / np.broadcast_to(high, weight.shape)[heavy]),
+                                       self._variance_reduction.max_split)
+            weight[heavy] /= counts[heavy]
+            self._split(photons, counts)
+
+    @staticmethod
+    def _split(photons: PhotonBatch, counts: np.ndarray):
+        # Free paths are memoryless, so the split photons draw new steps instead of sharing their remaining one.
+        photons.step_left[counts > 1] = 0
+        photons.split(counts)
+
+    def _is_within_lateral_limits(self, position) -> np.ndarray:
+        within = np.ones(len(position), dtype=bool)
+        if self._stack.lateral_limits is None:
+            return within
+        for axis, (low, high) in enumerate(self._stack.lateral_limits):
+            within &= (position[:, axis] >= low) & (position[:, axis] <= high)
+        return within
+
+    def _record(self, photons: PhotonBatch, mask, value, key):
+        """
+        Buffers data points of the masked photons at their current position as rows of (value, x, y, z, photonID,
+        key index, channel), followed by the path length in each layer when tracked.
+        """
+        if len(value) == 0 or not self._recording:
+            return
+        with self._stage("logging", len(value)):
+            columns = [value, photons.position[mask], photons.ids[mask], key, photons.channel[mask]]
+            if photons.path_length is not None:
+                columns.append(photons.path_length[mask])
+            self._records.append(np.column_stack(columns))
+
+    def _stage(self, name: str, events: int = 0):
+        return _NOT_PROFILED if self._profile is None else self._profile.stage(name, events)
+
+    def _count_layers(self, counter: str, layer: np.ndarray):
+        """Adds the number of photons in each layer (the world is ignored) to a per-solid counter of the profile."""
+        counts = np.bincount(layer[(layer >= 0) & (layer < len(self._stack.layers))],
+                             minlength=len(self._stack.layers))
+        for label, n in zip(self._stack.labels, counts):
+            if n:
+                self._profile.count(label, counter, int(n))
+
+    def _flush(self, loggers: List[Optional[EnergyLogger]]):
+        if not self._records:
+            return
+        records = np.vstack(self._records)
+        self._records = []
+        group = records[:, 6].astype(np.int64) * len(self._keys) + records[:, 5].astype(np.int64)
+        order = np.argsort(group, kind="stable")
+        records, group = records[order], group[order]
+        groups, starts = np.unique(group, return_index=True)
+        for index, start, stop in zip(groups, starts, list(starts[1:]) + [len(group)]):
+            channel = index // len(self._keys)
+            logger = loggers[channel]
+            if not hasattr(logger, "logDataPointArray"):
+                continue
+            points = records[start:stop, :5]
+            if getattr(logger, "requiresPathLength", False):
+                points = np.column_stack((points, self._optical_path_length(records[start:stop, 7:], channel)))
+            logger.logDataPointArray(points, self._keys[index % len(self._keys)])
+
+    def _record_exits(self, photons: PhotonBatch, mask):
+        """
+        Buffers the masked photons leaving through the entry surface as rows of (weight, x, y, z, photonID, ux, uy,
+        uz, total path length or NaN, channel, optical path length or NaN), after refraction into the world.
+        """
+        if not np.any(mask):
+            return
+        path_length = optical_path_length = np.full(np.count_nonzero(mask), np.nan)
+        if photons.path_length is not None:
+            path_length = photons.path_length[mask].sum(axis=1)
+            optical_path_length = self._optical_path_length(photons.path_length[mask], photons.channel[mask])
+        self._exits.append(np.column_stack((photons.weight[mask], photons.position[mask], photons.ids[mask],
+                                            photons.direction[mask], path_length, photons.channel[mask],
+                                            optical_path_length)))
+
+    def _flush_exits(self, loggers):
+        if not self._exits:
+            return
+        exits = np.vstack(self._exits)
+        self._exits = []
+        channel = exits[:, 9].astype(np.int64)
+        for index, logger in enumerate(loggers):
+            if hasattr(logger, "logExitArray") and np.any(channel == index):
+                columns = list(range(9)) + [10] if getattr(logger, "requiresPathLength", False) else slice(9)
+                logger.logExitArray(exits[channel == index][:, columns])
+
+    def _optical_path_length(self, path_length: np.ndarray, channel) -> np.ndarray:
+        """Sum of the per-layer path lengths weighted by the refractive index of each layer in the given channel."""
+        n = self._n[channel, :len(self._stack.layers)]
+        return np.sum(path_length * n, axis=-1)
+
+    def _locate_source(self, positions: np.ndarray):
+        """Finds the layer containing the source (assumed to be the one of its first photon), if any."""
+        layer = self._stack.layer_at(positions[:1, 2])[0] if len(positions) else -1
+        inside = 0 <= layer < len(self._stack.layers)
+        self._source_solid_label = self._stack.layers[layer].label if inside else None
+
+    def _prepare_logger(self, logger, source):
+        # Same bookkeeping as `Source._prepareLogger` so that `Stats` can normalize the energies.
+        logger.info["photonCount"] = logger.info.get("photonCount", 0) + source.getPhotonCount()
+        logger.info["sourceSolidLabel"] = self._source_solid_label
+        logger.info.setdefault("sourceHash", hash(source))
+
+
+def propagate_layered(source, scene, logger: EnergyLogger = None, stack: LayerStack = None,
+                      show_progress: bool = True, variance_reduction: VarianceReduction = None,
+                      profile: PropagationProfile = None):
+    """
+    Drop-in replacement for `source.propagate(scene, logger=logger)` on planar layer stacks.
+
+    Args:
+        source (Source): The photon source (its hardware acceleration setting is ignored).
+        scene (ScatteringScene): Used to detect the layer stack when `stack` is not given.
+        logger (EnergyLogger): Logger receiving the interactions.
+        stack (LayerStack): Explicit layer stack, required for scenes with overlapping solids.
+        show_progress (bool): Print the photon count and the propagation time.
+        variance_reduction (VarianceReduction): Optional roulette, splitting and layer importance settings, e.g.
+            `VarianceReduction(importance={"Blood": 8})` to follow more photons in a thin and deep layer.
+        profile (PropagationProfile): Optional profile receiving the time and events of each propagation stage.
+
+    Returns:
+        SlabPropagator: The propagator, which can be reused with other sources.
+    """
+    if stack is None:
+        stack = LayerStack.from_scene(scene)
+    propagator = SlabPropagator(stack, variance_reduction=variance_reduction)
+    propagator.propagate(source, logger=logger, show_progress=show_progress, profile=profile)
+    return propagator
+
+
+def fresnel_reflectance(cos_in: np.ndarray, n1: np.ndarray, n2: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Unpolarized reflection coefficient and cosine of the refraction angle for the given cosines of incidence.
+    Directly from MCML (Wang, Jacques & Zheng, 1995), as in `FresnelIntersect`.
+    """
+    sin_in = np.sqrt(np.maximum(0, 1 - cos_in ** 2))
+    sin_out = sin_in * n1 / n2
+    cos_out = np.sqrt(np.maximum(0, 1 - sin_out ** 2))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cap = cos_in * cos_out - sin_in * sin_out
+        cam = cos_in * cos_out + sin_in * sin_out
+        sap = sin_in * cos_out + cos_in * sin_out
+        sam = sin_in * cos_out - cos_in * sin_out
+        R = 0.5 * sam * sam * (cam * cam + cap * cap) / (sap * sap * cam * cam)
+    normal_incidence = sin_in < 1e-12
+    R = np.where(normal_incidence, ((n2 - n1) / (n2 + n1)) ** 2, R)
+    R = np.where(sin_out >= 1, 1.0, R)
+    R = np.where(n1 == n2, 0.0, R)
+    return R, cos_out
+
+
+def deflect(direction: np.ndarray, g, rnd: np.ndarray, phi: np.ndarray) -> np.ndarray:
+    """
+    Henyey-Greenstein deflection of each direction for the uniform random numbers `rnd` (deflection angle) and the
+    azimuthal angles `phi`, as in MCML `Spin()`.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        temp = (1 - g * g) / (1 - g + 2 * g * rnd)
+        cos_theta = np.where(g == 0, 2 * rnd - 1, (1 + g * g - temp * temp) / (2 * g))
+    cos_theta = np.clip(cos_theta, -1, 1)
+    sin_theta = np.sqrt(1 - cos_theta ** 2)
+    cos_phi, sin_phi = np.cos(phi), np.sin(phi)
+
+    ux, uy, uz = direction[:, 0], direction[:, 1], direction[:, 2]
+    new = np.empty_like(direction)
+    vertical = np.abs(uz) > 0.99999
+    new[:, 0] = np.where(vertical, sin_theta * cos_phi, 0)
+    new[:, 1] = np.where(vertical, sin_theta * sin_phi, 0)
+    new[:, 2] = np.where(vertical, cos_theta * np.sign(uz), 0)
+
+    oblique = ~vertical
+    root = np.sqrt(1 - uz[oblique] ** 2)
+    st, cp, sp, ct = sin_theta[oblique], cos_phi[oblique], sin_phi[oblique], cos_theta[oblique]
+    ux, uy, uz = ux[oblique], uy[oblique], uz[oblique]
+    new[oblique, 0] = st * (ux * uz * cp - uy * sp) / root + ux * ct
+    new[oblique, 1] = st * (uy * uz * cp + ux * sp) / root + uy * ct
+    new[oblique, 2] = -st * cp * root + uz * ct
+    return new
+
+
+def _get_axis_of(normal, solid_label: str) -> Tuple[int, int]:
+    components = normal.array
+    axis = int(np.argmax(np.abs(components)))
+    if abs(abs(components[axis]) - 1) > TOLERANCE:
+        raise ValueError(f"Solid '{solid_label}' is not a box aligned with the axes.")
+    return axis, int(np.sign(components[axis]))
+
+
+def _total_attenuation(material) -> float:
+    # Computed from mu_s and mu_a since the task scripts update these attributes after the material creation.
+    return getattr(material, "mu_s", 0) + getattr(material, "mu_a", 0)
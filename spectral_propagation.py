@@ -0,0 +1,104 @@
+"""
+Single-pass multi-wavelength propagation.
+
+task3.py, task4.py and task7.py rebuild the scene and launch a new source for every entry of their `materials` table.
+Here the geometry is built once and all the wavelengths are propagated together: every source photon is launched once
+per wavelength in the same vectorized batch, sharing the geometry setup, the boundary computations and the random
+generator, while each wavelength keeps its own `EnergyLogger`.
+
+Usage:
+    loggers = propagate_spectral(source, scene, materials)
+    viewer = Viewer(scene, source, loggers["Green"])
+"""
+from typing import Dict, Union
+
+import numpy as np
+from pytissueoptics import EnergyLogger, ScatteringMaterial
+
+from slab_propagation import LayerStack, SlabPropagator
+
+MaterialTable = Dict[str, Dict[str, Union[ScatteringMaterial, dict]]]
+
+
+class SpectralPropagator(SlabPropagator):
+    """
+    Propagates the same photons through one `LayerStack` for several material sets at once.
+
+    Args:
+        stack (LayerStack): The planar layers shared by all wavelengths.
+        materials (MaterialTable): Materials of each layer for each wavelength, as in the `materials` tables of the
+            task scripts: {wavelength: {layer label: ScatteringMaterial or its keyword arguments}}. Layer labels are
+            case-insensitive; layers missing from a wavelength keep the material of the stack.
+        batch_size (int): Maximum number of photons (all wavelengths included) propagated together.
+    """
+
+    def __init__(self, stack: LayerStack, materials: MaterialTable, batch_size: int = 100000):
+        self._wavelengths = list(materials.keys())
+        channel_materials = [layer_materials(stack, materials[wavelength]) for wavelength in self._wavelengths]
+        super().__init__(stack, batch_size=batch_size, channel_materials=channel_materials)
+
+    @property
+    def wavelengths(self):
+        return self._wavelengths
+
+    def propagate(self, source, logger: Dict[str, EnergyLogger] = None, show_progress: bool = True,
+                  rng: np.random.Generator = None):
+        """
+        Propagates all the photons of the source for every wavelength.
+
+        Args:
+            source (Source): Any pytissueoptics source. Each of its photons is launched once per wavelength.
+            logger (Dict[str, EnergyLogger]): One logger per wavelength. Missing wavelengths are not logged.
+            show_progress (bool): Print the photon count and the propagation time.
+            rng (np.random.Generator): Random generator shared by all wavelengths.
+        """
+        logger = logger or {}
+        loggers = [logger.get(wavelength) for wavelength in self._wavelengths]
+        self._propagate_source(source, loggers, show_progress, rng)
+
+
+def propagate_spectral(source, scene, materials: MaterialTable, stack: LayerStack = None,
+                       show_progress: bool = True, **logger_kwargs) -> Dict[str, EnergyLogger]:
+    """
+    Spectral equivalent of `source.propagate(scene, logger=logger)`.
+
+    Args:
+        source (Source): The photon source.
+        scene (ScatteringScene): The geometry, shared by all wavelengths. Its own materials are only used for the
+            fluence-rate conversion of the views.
+        materials (MaterialTable): Materials of each layer for each wavelength.
+        stack (LayerStack): Explicit layer stack, required for scenes with overlapping solids.
+        show_progress (bool): Print the photon count and the propagation time.
+        **logger_kwargs: Forwarded to each `EnergyLogger`.
+
+    Returns:
+        Dict[str, EnergyLogger]: One logger per wavelength.
+    """
+    if stack is None:
+        stack = LayerStack.from_scene(scene)
+    loggers = {wavelength: EnergyLogger(scene, **logger_kwargs) for wavelength in materials}
+    SpectralPropagator(stack, materials).propagate(source, loggers, show_progress=show_progress)
+    return loggers
+
+
+def layer_materials(stack: LayerStack, properties: Dict[str, Union[ScatteringMaterial, dict]]):
+    """
+    Materials of the layers of a stack for one wavelength, e.g. as the `channel_materials` of a `SlabPropagator`.
+
+    Args:
+        stack (LayerStack): The planar layers.
+        properties (Dict[str, Union[ScatteringMaterial, dict]]): One entry of a `MaterialTable`: {layer label:
+            ScatteringMaterial or its keyword arguments}. Labels are case-insensitive; layers missing from it keep the
+            material of the stack.
+
+    Returns:
+        List[ScatteringMaterial]: One material per layer of the stack, from the surface down.
+    """
+    properties = {label.lower(): value for label, value in properties.items()}
+    materials = []
+    for layer in stack.layers:
+        material = properties.get(layer.label.lower(), layer.material)
+        if isinstance(material, dict):
+            material = ScatteringMaterial(**material)
+        materials.append(material)
+    return materials
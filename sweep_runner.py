@@ -0,0 +1,157 @@
+"""
+Parallel sweeps of planar-slab simulations over a process pool.
+
+`compare_models` in task8.py and the wavelength loops of task3.py, task4.py and task7.py run each (model, wavelength)
+simulation one after the other on a single core. Here, every job is split into fixed-size photon batches which are
+propagated by a pool of worker processes. Each batch draws from its own random stream, spawned from the job seed with
+`np.random.SeedSequence`, and the batch tallies are merged in batch order into a single `EnergyLogger` per job. The
+batches and their streams only depend on the job and on `batch_size`, so the results are identical whatever the number
+of workers.
+
+Usage (the `__main__` guard is required on platforms starting the workers with "spawn"):
+    if __name__ == "__main__":
+        jobs = [SweepJob(f"{model}-{wavelength}", stacks[model], source, scene=scenes[model],
+                         materials=materials[wavelength], seed=42)
+                for model in stacks for wavelength in materials]
+        loggers = run_sweep(jobs, workers=8)
+"""
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+from pytissueoptics import EnergyLogger, ScatteringMaterial
+from pytissueoptics.scene import Logger
+
+from slab_propagation import LayerStack, SlabPropagator
+from spectral_propagation import layer_materials
+
+DEFAULT_BATCH_SIZE = 20000
+
+
+@dataclass
+class SweepJob:
+    """
+    One simulation of a sweep.
+
+    Args:
+        name (str): Key of the job results.
+        stack (LayerStack): The planar layers to propagate through.
+        source (Source): The photon source; only its initial positions and directions are used.
+        scene (ScatteringScene): Scene given to the resulting `EnergyLogger`.
+        materials: Optional materials overriding those of the stack, as one entry of the `materials` tables of the
+            task scripts: {layer label: ScatteringMaterial or its keyword arguments}.
+        seed (int): Seed of the job random streams. Defaults to the source seed.
+    """
+    name: str
+    stack: LayerStack
+    source: object
+    scene: object
+    materials: Optional[Dict[str, Union[ScatteringMaterial, dict]]] = None
+    seed: Optional[int] = None
+
+
+def run_sweep(jobs: List[SweepJob], workers: int = None, batch_size: int = DEFAULT_BATCH_SIZE,
+              show_progress: bool = True, **logger_kwargs) -> Dict[str, EnergyLogger]:
+    """
+    Propagates the photons of every job over a pool of worker processes.
+
+    Args:
+        jobs (List[SweepJob]): The simulations to run. Their names must be unique.
+        workers (int): Number of worker processes. Defaults to the number of CPUs. With a single worker, the batches
+            are propagated in the current process.
+        batch_size (int): Number of photons of each batch. Changing it changes the random streams, hence the results.
+        show_progress (bool): Print the number of batches and the total propagation time.
+        **logger_kwargs: Forwarded to each `EnergyLogger`.
+
+    Returns:
+        Dict[str, EnergyLogger]: The merged logger of each job, keyed by job name.
+    """
+    names = [job.name for job in jobs]
+    if len(set(names)) != len(names):
+        raise ValueError("Sweep job names must be unique.")
+    workers = workers or os.cpu_count() or 1
+
+    loggers, tasks, owners = {}, [], []
+    for job in jobs:
+        positions, directions = job.source.getInitialPositionsAndDirections()
+        channel_materials = None if job.materials is None else [layer_materials(job.stack, job.materials)]
+        propagator = SlabPropagator(job.stack, channel_materials=channel_materials)
+        logger = EnergyLogger(job.scene, **logger_kwargs)
+        propagator.prepare_logger(logger, job.source, positions)
+        loggers[job.name] = logger
+
+        seed = job.seed if job.seed is not None else getattr(job.source, "_seed", None)
+        starts = range(0, len(positions), batch_size)
+        streams = np.random.SeedSequence(seed).spawn(len(starts))
+        for start, stream in zip(starts, streams):
+            stop = start + batch_size
+            tasks.append((job.stack, channel_materials, positions[start:stop], directions[start:stop], start, stream))
+            owners.append(job.name)
+
+    t0 = time.time()
+    if show_progress:
+        print(f"Propagating {len(jobs)} jobs in {len(tasks)} batches over {min(workers, len(tasks))} workers...")
+    if workers == 1 or len(tasks) <= 1:
+        _merge_results(loggers, owners, map(_propagate_batch, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            _merge_results(loggers, owners, executor.map(_propagate_batch, tasks))
+    if show_progress:
+        print(f"... done in {time.time() - t0:.2f}s")
+    return loggers
+
+
+def merge_loggers(target: EnergyLogger, *loggers: Logger) -> EnergyLogger:
+    """
+    Merges the tallies of independent runs of the same scene into `target`, in the given order. The 3D data points are
+    appended to those of the target (and binned to its views when it does not keep 3D data). Loggers that only kept
+    2D views are added view by view, which requires identical views in the target. Photon counts are summed.
+
+    Returns:
+        EnergyLogger: The target logger.
+    """
+    for logger in loggers:
+        if getattr(logger, "has3D", True):
+            for key, data in logger._data.items():
+                if data.dataPoints is not None and len(data.dataPoints) > 0:
+                    target.logDataPointArray(data.dataPoints.getData(), key)
+        else:
+            _merge_views(target, logger)
+        target.info["photonCount"] = target.info.get("photonCount", 0) + logger.info.get("photonCount", 0)
+        for name in ("sourceSolidLabel", "sourceHash"):
+            if name in logger.info:
+                target.info.setdefault(name, logger.info[name])
+    return target
+
+
+def _propagate_batch(task) -> Logger:
+    stack, channel_materials, positions, directions, first_id, stream = task
+    propagator = SlabPropagator(stack, batch_size=len(positions), channel_materials=channel_materials)
+    logger = Logger()
+    propagator.propagate_batch(positions, directions, logger, np.random.default_rng(stream), first_id=first_id)
+    return logger
+
+
+def _merge_results(loggers: Dict[str, EnergyLogger], owners: List[str], results):
+    # Photon counts were already set from the sources, only the data points are merged.
+    for name, result in zip(owners, results):
+        result.info.clear()
+        merge_loggers(loggers[name], result)
+
+
+def _merge_views(target: EnergyLogger, logger: EnergyLogger):
+    # The seen labels are required by `Stats` to find the surfaces of each solid from the views.
+    for solidLabel in logger.getSeenSolidLabels():
+        surfaceLabels = target._labels.setdefault(solidLabel, [])
+        surfaceLabels.extend(label for label in logger.getSeenSurfaceLabels(solidLabel) if label not in surfaceLabels)
+    for view in logger.views:
+        if not view._hasData:
+            continue
+        matches = [targetView for targetView in target.views if targetView.isEqualTo(view)]
+        if not matches:
+            raise ValueError(f"Cannot merge view '{view.name}' without an identical view in the target logger.")
+        matches[0]._dataUV += view._dataUV
+        matches[0]._hasData = True
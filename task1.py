@@ -9,13 +9,16 @@ except ImportError as e:
 # Insert necessary paths for PyTissueOptics if not properly installed
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
+from cached_views import CachedEnergyLogger, CachedViewer
+from mesh_propagation import propagate_vectorized
+
 TITLE = "Green Light Propagation Through Multi-Layered Skin Model"
 DESCRIPTION = """Simulation of green light propagation through a three-layer skin model representing
 Epidermis, Dermis, and Subcutis."""
 
 def exampleCode():
     # Number of photons to propagate
-    N = 100000 if hardwareAccelerationIsAvailable() else 1000
+    N = 100000
 
     # Define layer-specific properties for green light (wavelength ~ 520-550 nm)
     material_epidermis = ScatteringMaterial(mu_s=60.0, mu_a=3.9, g=0.75, n=1.4)
@@ -32,7 +35,7 @@ def exampleCode():
 
     # Create the scene with the stacked tissue
     scene = ScatteringScene([stacked_tissue])
-    logger = EnergyLogger(scene)
+    logger = CachedEnergyLogger(scene)
 
     # Define a divergent photon source positioned above the tissue
     source = DivergentSource(position=Vector(0, 0, -0.2), direction=Vector(0, 0, 1), N=N,
@@ -41,11 +44,14 @@ def exampleCode():
     # Display the tissue and source configuration
     scene.show(source=source)
 
-    # Propagate photons through the tissue
-    source.propagate(scene, logger=logger)
+    # Propagate photons through the tissue, with the vectorized NumPy propagation when OpenCL is not available
+    if hardwareAccelerationIsAvailable():
+        source.propagate(scene, logger=logger)
+    else:
+        propagate_vectorized(source, scene, logger=logger)
 
     # Visualization: 2D projections
-    viewer = Viewer(scene, source, logger)
+    viewer = CachedViewer(scene, source, logger)
     viewer.reportStats()
     viewer.show2D(View2DProjectionX())  # Side view
     viewer.show2D(View2DProjectionY())  # Front view
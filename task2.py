@@ -5,12 +5,14 @@ from pytissueoptics import *
 # Insert necessary paths for PyTissueOptics if not properly installed
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
+from mesh_propagation import propagate_vectorized
+
 TITLE = "Task 2: Green Light Propagation - 2D Projections"
 DESCRIPTION = """Simulating the propagation of green light through a layered skin model and visualizing energy distribution."""
 
 def exampleCode():
     # Number of photons to propagate
-    N = 100000 if hardwareAccelerationIsAvailable() else 1000
+    N = 100000
 
     # Define layer-specific properties for green light (wavelength ~ 520-550 nm)
     material_epidermis = ScatteringMaterial(mu_s=60.0, mu_a=3.9, g=0.75, n=1.4)
@@ -33,8 +35,11 @@ def exampleCode():
     source = DivergentSource(position=Vector(0, 0, -0.2), direction=Vector(0, 0, 1), N=N,
                              diameter=0.1, divergence=0.4, displaySize=0.2)
 
-    # Propagate photons through the tissue
-    source.propagate(scene, logger=logger)
+    # Propagate photons through the tissue, with the vectorized NumPy propagation when OpenCL is not available
+    if hardwareAccelerationIsAvailable():
+        source.propagate(scene, logger=logger)
+    else:
+        propagate_vectorized(source, scene, logger=logger)
 
     # Visualization: Side and front 2D projections
     viewer = Viewer(scene, source, logger)
@@ -1,65 +1,94 @@
 '''
+Comparison of the energy attenuation with depth between Task 3 (original thickness) and Task 4 (increased epidermis
+thickness), for each wavelength.
+
 Visualization:
-The plotted energy profiles illustrate how the energy attenuates with depth for each wavelength in both Task 3 (original thickness) and Task 4 (increased epidermis thickness).
-Task 4 shows a steeper energy decline for all wavelengths compared to Task 3, particularly for Blue and Green light, which are more sensitive to scattering and absorption.
+The plotted energy profiles show how the deposited energy decreases with depth for each wavelength in both models
+(dashed lines for Task 3).
+
 Quantitative Results:
-The table displays the depths at which 50% and 90% of the energy is lost for each wavelength in both tasks.
-Key Insights:
+The printed table gives the depths at which 50% and 90% of the deposited energy is lost for each wavelength in both
+models, with their uncertainties. It is computed from the simulation, so read the effect of the thicker epidermis on
+each wavelength from the table rather than from fixed numbers.
 
-50% Energy Loss Depth:
+Paired comparison:
+The differences of diffuse reflectance and absorbed energy per layer between Task 4 and Task 3 are estimated with the
+same photon histories in both models, so that their uncertainties are much smaller than those of two independent runs.
+'''
 
-Blue Light: Reduced from 0.0697 cm in Task 3 to 0.0606 cm in Task 4, showing the increased epidermis thickness significantly affects the penetration of shorter wavelengths.
-Green Light: Depth decreases from 0.1 cm to 0.0879 cm, reflecting moderate sensitivity to the increased scattering layer.
-Red and NIR Light: Reduces slightly but remains less affected compared to shorter wavelengths due to their longer penetration capability.
-90% Energy Loss Depth:
+from pytissueoptics import DivergentSource, ScatteringMaterial, Vector
 
-Blue and Green light in Task 4 have reduced 90% energy loss depths compared to Task 3, showing their diminished ability to reach deeper layers.
-Red and NIR light exhibit minimal changes, with NIR maintaining significant penetration due to its low scattering and absorption coefficients.
-Interpretation:
-Impact of Increased Epidermis Thickness:
+from adaptive_propagation import AbsorbedEnergy, diffuse_reflectance
+from depth_analysis import DepthTally, loss_depth_table, plot_depth_profiles
+from paired_comparison import compare_paired
+from slab_propagation import LayerStack
+from spectral_propagation import SpectralPropagator
 
-The increased scattering in the thicker epidermis significantly reduces the energy reaching deeper layers for shorter wavelengths.
-Longer wavelengths (Red and NIR) are less affected and maintain deeper penetration due to their lower interaction probabilities with the tissue.
-Wavelength Sensitivity:
+N = 100000
 
-Blue and Green light are highly sensitive to epidermis thickness changes, which aligns with their applications in superficial diagnostics and therapies.
-NIR light demonstrates its utility in deep tissue imaging due to minimal energy attenuation even with increased epidermis thickness.
-Practical Implications:
+# Same material properties as task3.py and task4.py
+materials = {
+    "Blue": {
+        "epidermis": {"mu_s": 76.5, "mu_a": 6.85, "g": 0.75, "n": 1.4},
+        "dermis": {"mu_s": 76.5, "mu_a": 2.45, "g": 0.85, "n": 1.4},
+        "subcutis": {"mu_s": 76.5, "mu_a": 1.45, "g": 0.75, "n": 1.4},
+    },
+    "Green": {
+        "epidermis": {"mu_s": 60.0, "mu_a": 3.90, "g": 0.75, "n": 1.4},
+        "dermis": {"mu_s": 60.0, "mu_a": 0.71, "g": 0.85, "n": 1.4},
+        "subcutis": {"mu_s": 60.0, "mu_a": 0.49, "g": 0.75, "n": 1.4},
+    },
+    "Red": {
+        "epidermis": {"mu_s": 52.5, "mu_a": 2.50, "g": 0.75, "n": 1.4},
+        "dermis": {"mu_s": 52.5, "mu_a": 0.41, "g": 0.85, "n": 1.4},
+        "subcutis": {"mu_s": 52.5, "mu_a": 0.26, "g": 0.75, "n": 1.4},
+    },
+    "NIR": {
+        "epidermis": {"mu_s": 40.5, "mu_a": 0.86, "g": 0.75, "n": 1.4},
+        "dermis": {"mu_s": 40.5, "mu_a": 0.16, "g": 0.85, "n": 1.4},
+        "subcutis": {"mu_s": 40.5, "mu_a": 0.11, "g": 0.75, "n": 1.4},
+    },
+}
 
-Understanding these dynamics is crucial for optimizing wavelength selection in phototherapy, optical imaging, and laser-based treatments, especially for patients with thicker or pigmented skin.
-'''
+# Layer thicknesses (in cm) of Task 3 (original) and Task 4 (increased epidermis thickness)
+models = {
+    "Task 3": [0.05, 0.2, 0.05],
+    "Task 4": [0.1, 0.2, 0.05],
+}
 
-import numpy as np
-import matplotlib.pyplot as plt
 
-# Depths (in cm) from the surface into the skin
-depths = np.linspace(0, 0.3, 100)
+def simulate_depth_tallies():
+    """Propagates all wavelengths of each model at once and tallies the deposited energy by depth."""
+    tallies = {}
+    for model, thicknesses in models.items():
+        # The layer materials are given per wavelength to the propagator.
+        stack = LayerStack.from_thicknesses(["Epidermis", "Dermis", "Subcutis"], [None] * 3, thicknesses, width=1.0)
+        model_tallies = {wavelength: DepthTally.from_stack(stack) for wavelength in materials}
+        source = DivergentSource(position=Vector(0, 0, -0.2), direction=Vector(0, 0, 1), N=N,
+                                 diameter=0.1, divergence=0.4, useHardwareAcceleration=False, seed=42)
+        SpectralPropagator(stack, materials).propagate(source, model_tallies)
+        for wavelength, tally in model_tallies.items():
+            tallies[f"{wavelength} - {model}"] = tally
+    return tallies
 
-# Task 3 energy profiles (original thickness)
-task3_profiles = {
-    "Blue": np.exp(-10 * depths),
-    "Green": np.exp(-7 * depths),
-    "Red": np.exp(-4 * depths),
-    "NIR": np.exp(-2 * depths),
-}
 
-# Task 4 energy profiles (increased epidermis thickness)
-task4_profiles = {
-    "Blue": np.exp(-12 * depths),
-    "Green": np.exp(-8 * depths),
-    "Red": np.exp(-5 * depths),
-    "NIR": np.exp(-3 * depths),
-}
+def compare_models_paired(n_photons: int = 20000):
+    """Estimates the differences between Task 4 and Task 3 with the same photon histories in both models."""
+    labels = ["Epidermis", "Dermis", "Subcutis"]
+    for wavelength, properties in materials.items():
+        layer_materials = [ScatteringMaterial(**properties[label.lower()]) for label in labels]
+        stacks = {model: LayerStack.from_thicknesses(labels, layer_materials, thicknesses, width=1.0)
+                  for model, thicknesses in models.items()}
+        source = DivergentSource(position=Vector(0, 0, -0.2), direction=Vector(0, 0, 1), N=n_photons,
+                                 diameter=0.1, divergence=0.4, useHardwareAcceleration=False, seed=42)
+        metrics = [diffuse_reflectance(stacks["Task 3"])] + [AbsorbedEnergy(label) for label in labels]
+        print(f"{wavelength} light:")
+        print(compare_paired(source, stacks, metrics, show_progress=False))
 
-# Plot energy profiles for Task 3 and Task 4
-plt.figure(figsize=(12, 8))
-for wavelength in task3_profiles.keys():
-    plt.plot(depths, task3_profiles[wavelength], label=f"{wavelength} - Task 3", linestyle="--")
-    plt.plot(depths, task4_profiles[wavelength], label=f"{wavelength} - Task 4")
 
-plt.xlabel("Depth (cm)")
-plt.ylabel("Relative Energy")
-plt.title("Energy Profiles for Task 3 (Original) and Task 4 (Increased Epidermis Thickness)")
-plt.legend()
-plt.grid(True)
-plt.show()
+if __name__ == "__main__":
+    tallies = simulate_depth_tallies()
+    print(loss_depth_table(tallies))
+    compare_models_paired()
+    plot_depth_profiles(tallies, linestyles={name: "--" for name in tallies if name.endswith("Task 3")},
+                        title="Energy Profiles for Task 3 (Original) and Task 4 (Increased Epidermis Thickness)")
@@ -9,13 +9,15 @@ except ImportError as e:
 # Insert necessary paths for PyTissueOptics if not properly installed
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
+from cached_views import CachedEnergyLogger, CachedViewer
+from slab_propagation import LayerStack
+from spectral_propagation import SpectralPropagator
+
 TITLE = "Light Propagation Through Multi-Layered Skin Model with Increased Epidermis Thickness"
 DESCRIPTION = """Simulation of light propagation (Blue, Green, Red, NIR) through a three-layer skin model 
 representing Epidermis, Dermis, and Subcutis with increased epidermis thickness."""
 
-def simulate_light_propagation(wavelength, material_properties):
-    print(f"Simulating {wavelength} light...")
-
+def build_scene(material_properties):
     # Define layer-specific properties
     material_epidermis = ScatteringMaterial(**material_properties["epidermis"])
     material_dermis = ScatteringMaterial(**material_properties["dermis"])
@@ -31,26 +33,34 @@ def simulate_light_propagation(wavelength, material_properties):
     stacked_tissue = layer_epidermis.stack(layer_dermis, "back").stack(layer_subcutis, "back")
 
     # Create the scene with the stacked tissue
-    scene = ScatteringScene([stacked_tissue])
-    logger = EnergyLogger(scene)
+    return ScatteringScene([stacked_tissue])
+
+def simulate_light_propagation(materials):
+    print(f"Simulating {', '.join(materials)} light...")
+
+    # Same geometry for every wavelength, each scene holding the materials used to display its energy
+    scenes = {wavelength: build_scene(material_properties) for wavelength, material_properties in materials.items()}
+    loggers = {wavelength: CachedEnergyLogger(scene) for wavelength, scene in scenes.items()}
 
     # Define a divergent photon source positioned above the tissue
     source = DivergentSource(position=Vector(0, 0, -0.2), direction=Vector(0, 0, 1), N=10000,
                              diameter=0.1, divergence=0.4, displaySize=0.2)
 
-    # Propagate photons through the tissue
-    source.propagate(scene, logger=logger)
+    # Propagate the photons through the tissue for all wavelengths at once
+    stack = LayerStack.from_scene(next(iter(scenes.values())))
+    SpectralPropagator(stack, materials).propagate(source, loggers)
 
-    # Add views at specific depths for energy visualization
-    depths = [0.05, 0.25]  # Example depths in cm
-    for depth in depths:
-        logger.addView(View2DSliceZ(position=depth, thickness=0.01, limits=((-1, 1), (-1, 1))))
+    for wavelength, logger in loggers.items():
+        # Add views at specific depths for energy visualization
+        depths = [0.05, 0.25]  # Example depths in cm
+        for depth in depths:
+            logger.addView(View2DSliceZ(position=depth, thickness=0.01, limits=((-1, 1), (-1, 1))))
 
-    # Visualization: 2D projections and energy profiles
-    viewer = Viewer(scene, source, logger)
-    for depth in depths:
-        print(f"Showing 2D view for depth: {depth} cm")
-        viewer.show2D(View2DSliceZ(position=depth))
+        # Visualization: 2D projections and energy profiles
+        viewer = CachedViewer(scenes[wavelength], source, logger)
+        for depth in depths:
+            print(f"Showing 2D view of {wavelength} light for depth: {depth} cm")
+            viewer.show2D(View2DSliceZ(position=depth))
 
 def example_code():
     # Material properties for different wavelengths
@@ -78,9 +88,8 @@ def example_code():
 
     }
 
-    # Simulate and visualize for each wavelength
-    for wavelength, material_properties in materials.items():
-        simulate_light_propagation(wavelength, material_properties)
+    # Simulate all wavelengths together and visualize each of them
+    simulate_light_propagation(materials)
 
 if __name__ == "__main__":
     example_code()
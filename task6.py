@@ -7,6 +7,8 @@ except ImportError as e:
     print(f"Error importing pytissueoptics: {e}")
     sys.exit(1)
 
+from cached_views import CachedEnergyLogger, CachedViewer
+
 # Blood optical properties based on literature values (example values)
 BLOOD_PROPERTIES = {
     "mu_s": 200.0,  # Scattering coefficient (1/cm)
@@ -36,7 +38,7 @@ def final_skin_model_with_blood_and_visualization():
 
     # Create the scene with the stacked tissue
     scene = ScatteringScene([stacked_tissue])
-    logger = EnergyLogger(scene)
+    logger = CachedEnergyLogger(scene)
 
     # Define a divergent photon source positioned above the tissue
     source = DivergentSource(position=Vector(0, 0, -0.2), direction=Vector(0, 0, 1), N=10000,
@@ -51,7 +53,7 @@ def final_skin_model_with_blood_and_visualization():
         logger.addView(View2DSliceZ(position=depth, thickness=0.01, limits=((-1, 1), (-1, 1))))
 
     # Visualization: 2D projections and energy profiles
-    viewer = Viewer(scene, source, logger)
+    viewer = CachedViewer(scene, source, logger)
     for depth in depths:
         print(f"Showing 2D energy projection for Green light at depth: {depth} cm")
         viewer.show2D(View2DSliceZ(position=depth))
@@ -7,6 +7,10 @@ except ImportError as e:
     print(f"Error importing pytissueoptics: {e}")
     sys.exit(1)
 
+from cached_views import CachedEnergyLogger, CachedViewer
+from slab_propagation import LayerStack
+from spectral_propagation import SpectralPropagator
+
 # Blood optical properties based on literature values (example values)
 BLOOD_PROPERTIES = {
     "mu_s": 200.0,  # Scattering coefficient (1/cm)
@@ -15,37 +19,45 @@ BLOOD_PROPERTIES = {
     "n": 1.4        # Refractive index
 }
 
-# Function to simulate and visualize energy projections for specified wavelengths
-def energy_projections(wavelengths, material_properties):
-    for wavelength in wavelengths:
-        print(f"Simulating and visualizing energy projections for {wavelength} light...")
+def build_scene(props):
+    # Define layer-specific properties
+    material_epidermis = ScatteringMaterial(**props["epidermis"])
+    material_dermis = ScatteringMaterial(**props["dermis"])
+    material_subcutis = ScatteringMaterial(**props["subcutis"])
+    material_blood = ScatteringMaterial(**BLOOD_PROPERTIES)
+
+    # Define layers with thicknesses in cm
+    layer_epidermis = Cuboid(a=1.0, b=1.0, c=0.05, position=Vector(0, 0, 0), material=material_epidermis, label="Epidermis")
+    layer_dermis = Cuboid(a=1.0, b=1.0, c=0.2, position=Vector(0, 0, 0.05), material=material_dermis, label="Dermis")
+    layer_blood = Cuboid(a=1.0, b=1.0, c=0.01, position=Vector(0, 0, 0.22), material=material_blood, label="Blood")
+    layer_subcutis = Cuboid(a=1.0, b=1.0, c=0.05, position=Vector(0, 0, 0.25), material=material_subcutis, label="Subcutis")
 
-        # Define layer-specific properties
-        props = material_properties[wavelength]
-        material_epidermis = ScatteringMaterial(**props["epidermis"])
-        material_dermis = ScatteringMaterial(**props["dermis"])
-        material_subcutis = ScatteringMaterial(**props["subcutis"])
-        material_blood = ScatteringMaterial(**BLOOD_PROPERTIES)
+    # Stack layers to form the skin model
+    stacked_tissue = layer_epidermis.stack(layer_dermis, "back").stack(layer_blood, "back").stack(layer_subcutis, "back")
 
-        # Define layers with thicknesses in cm
-        layer_epidermis = Cuboid(a=1.0, b=1.0, c=0.05, position=Vector(0, 0, 0), material=material_epidermis, label="Epidermis")
-        layer_dermis = Cuboid(a=1.0, b=1.0, c=0.2, position=Vector(0, 0, 0.05), material=material_dermis, label="Dermis")
-        layer_blood = Cuboid(a=1.0, b=1.0, c=0.01, position=Vector(0, 0, 0.22), material=material_blood, label="Blood")
-        layer_subcutis = Cuboid(a=1.0, b=1.0, c=0.05, position=Vector(0, 0, 0.25), material=material_subcutis, label="Subcutis")
+    # Create the scene with the stacked tissue
+    return ScatteringScene([stacked_tissue])
 
-        # Stack layers to form the skin model
-        stacked_tissue = layer_epidermis.stack(layer_dermis, "back").stack(layer_blood, "back").stack(layer_subcutis, "back")
+# Function to simulate and visualize energy projections for specified wavelengths
+def energy_projections(wavelengths, material_properties):
+    print(f"Simulating energy projections for {', '.join(wavelengths)} light...")
 
-        # Create the scene with the stacked tissue
-        scene = ScatteringScene([stacked_tissue])
-        logger = EnergyLogger(scene)
+    # Same geometry for every wavelength, each scene holding the materials used to display its energy
+    materials = {wavelength: material_properties[wavelength] for wavelength in wavelengths}
+    scenes = {wavelength: build_scene(props) for wavelength, props in materials.items()}
+    loggers = {wavelength: CachedEnergyLogger(scene) for wavelength, scene in scenes.items()}
 
-        # Define a divergent photon source positioned above the tissue
-        source = DivergentSource(position=Vector(0, 0, -0.2), direction=Vector(0, 0, 1), N=10000,
-                                 diameter=0.1, divergence=0.4, displaySize=0.2)
+    # Define a divergent photon source positioned above the tissue
+    source = DivergentSource(position=Vector(0, 0, -0.2), direction=Vector(0, 0, 1), N=10000,
+                             diameter=0.1, divergence=0.4, displaySize=0.2)
 
-        # Propagate photons through the tissue
-        source.propagate(scene, logger=logger)
+    # Propagate the photons through the tissue for all wavelengths at once (the blood keeps the same material)
+    stack = LayerStack.from_scene(scenes[wavelengths[0]])
+    SpectralPropagator(stack, materials).propagate(source, loggers)
+
+    for wavelength in wavelengths:
+        print(f"Visualizing energy projections for {wavelength} light...")
+        logger = loggers[wavelength]
 
         # Add views at specific depths for energy visualization
         depths = [0.05, 0.15, 0.25]  # Example depths in cm
@@ -53,14 +65,14 @@ def energy_projections(wavelengths, material_properties):
             logger.addView(View2DSliceZ(position=depth, thickness=0.01, limits=((-1, 1), (-1, 1))))
 
         # Visualization: 2D projections and energy profiles
-        viewer = Viewer(scene, source, logger)
+        viewer = CachedViewer(scenes[wavelength], source, logger)
         for depth in depths:
             print(f"Showing 2D energy projection for {wavelength} light at depth: {depth} cm")
             viewer.show2D(View2DSliceZ(position=depth))
 
         print(f"1D Energy profile for {wavelength} light...")
         viewer.show1D(Direction.X_POS, solidLabel=None, surfaceLabel=None)
-       
+
 if __name__ == "__main__":
     # Material properties for different wavelengths
     materials = {
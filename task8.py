@@ -1,5 +1,8 @@
 from pytissueoptics import *
 
+from adaptive_propagation import AbsorbedEnergy
+from paired_comparison import compare_paired
+
 class SkinModelWithoutBlood(ScatteringScene):
     """
     Skin model consisting of three layers: Epidermis, Dermis, and Subcutis, without a blood layer.
@@ -109,6 +112,13 @@ def compare_models():
         print(f"Visualizing 1D energy profile for {model_name}...")
         viewer.show1D(Direction.X_POS)
 
+    # Paired comparison: the same photon histories in both models, so that the difference is not hidden by the noise
+    # of two independent runs.
+    source = DivergentSource(position=Vector(0, 0, -0.2), direction=Vector(0, 0, 1), N=10000, diameter=0.1,
+                             divergence=0.4, useHardwareAcceleration=False, seed=42)
+    metrics = [AbsorbedEnergy()] + [AbsorbedEnergy(solid.getLabel()) for solid in models["With Blood"].TISSUE]
+    print(compare_paired(source, models, metrics))
+
     # Written comparison
     print("\nComparison:")
     print("The model with blood shows higher absorption and scattering at the blood layer, leading to altered energy distributions compared to the model without blood.")
@@ -0,0 +1,301 @@
+"""
+Streaming time-resolved and frequency-domain tallies.
+
+Time-domain and frequency-domain instruments measure the arrival times of the photons, which the steady-state energy
+maps of an `EnergyLogger` do not keep. Keeping the path length of every logged interaction would grow with the number
+of photons, so a `TimeResolvedTally` instead accumulates, as the photons are propagated:
+    - time-of-flight histograms of the photons leaving the entry surface, per radial detector region around the source
+      axis (e.g. the source-detector separations of a fiber probe), and of the energy deposited per depth bin,
+    - the amplitude and phase at chosen modulation frequencies of the same detector regions and depth bins, computed
+      from the exact time of flight of each photon rather than from the histograms.
+Its memory is therefore fixed by the number of regions, depth bins, time bins and frequencies, whatever the number of
+photons.
+
+The time of flight is the optical path length in the tissue (the path length in each layer weighted by its refractive
+index n) divided by the speed of light in vacuum, counted from the entry of the photon in the tissue. It is given to
+the tally by `SlabPropagator`, which tracks per-layer path lengths for loggers requiring them.
+
+Usage:
+    tally = TimeResolvedTally.from_stack(stack, detector_radii=[0.1, 0.2, 0.5], frequencies=[100, 500])
+    propagate_layered(source, scene, logger=tally)
+    times, reflectance, error = tally.temporal_reflectance(region=1)
+    frequencies, amplitude, phase = tally.frequency_reflectance(region=1)
+"""
+from typing import Sequence, Tuple
+
+import matplotlib.pyplot as plt
+import numpy as np
+from pytissueoptics import InteractionKey
+
+from slab_propagation import LayerStack
+
+# Speed of light in vacuum (cm/ns).
+SPEED_OF_LIGHT = 29.9792458
+
+# Accumulated arrays of a `TimeResolvedTally`.
+_TALLIES = ("_reflectance", "_reflectance_squared", "_reflectance_time", "_reflectance_phasor", "_deposit",
+            "_deposit_phasor")
+
+
+class TimeResolvedTally:
+    """
+    Time-of-flight histograms and modulation phasors of the reflectance per detector region and of the deposited
+    energy per depth bin.
+
+    It has the `logExitArray` and `logDataPointArray` interfaces used by `SlabPropagator` and is given to a propagator
+    instead of an `EnergyLogger`. Photons arriving after `max_time`, and energy deposited deeper than `max_depth`,
+    are kept in overflow bins so that the steady-state totals remain exact.
+
+    Args:
+        max_time (float): Time covered by the time bins (ns).
+        time_bin_size (float): Time resolution (ns).
+        frequencies (Sequence[float]): Modulation frequencies (MHz) of the frequency-domain tallies.
+        detector_radii (Sequence[float]): Increasing radial distances to the source axis (cm) delimiting the detector
+            regions of the entry surface: [0, r1), [r1, r2), ... The last radius bounds the last region. Defaults to
+            a single region covering the whole surface.
+        center (Tuple[float, float]): (x, y) position of the source axis.
+        z_surface (float): Z coordinate of the tissue surface (depth 0).
+        max_depth (float): Depth covered by the depth bins of the deposited energy (cm). If None, the deposited energy
+            is not tallied.
+        depth_bin_size (float): Depth resolution (cm).
+    """
+    hasFilePath = False
+    requiresPathLength = True
+
+    def __init__(self, max_time: float = 1.0, time_bin_size: float = 0.005, frequencies: Sequence[float] = (),
+                 detector_radii: Sequence[float] = None, center: Tuple[float, float] = (0, 0), z_surface: float = 0,
+                 max_depth: float = None, depth_bin_size: float = 0.01):
+        self.info = {}
+        self._time_bin_size = time_bin_size
+        self._n_times = max(1, int(round(max_time / time_bin_size)))
+        self._frequencies = np.asarray(frequencies, dtype=float)
+        self._center = np.asarray(center, dtype=float)
+        self._radii = np.concatenate(([0], np.asarray(detector_radii if detector_radii is not None else [np.inf],
+                                                      dtype=float)))
+        if np.any(np.diff(self._radii) <= 0):
+            raise ValueError("The detector radii must be positive and increasing.")
+        self._z_surface = z_surface
+        self._depth_bin_size = depth_bin_size
+        self._n_depths = None if max_depth is None else max(1, int(round(max_depth / depth_bin_size)))
+
+        n_regions, n_depths = len(self._radii) - 1, 0 if self._n_depths is None else self._n_depths + 1
+        self._reflectance = np.zeros((n_regions, self._n_times + 1))
+        self._reflectance_squared = np.zeros((n_regions, self._n_times + 1))
+        self._reflectance_time = np.zeros(n_regions)
+        self._reflectance_phasor = np.zeros((n_regions, len(self._frequencies)), dtype=complex)
+        self._deposit = np.zeros((n_depths, self._n_times + 1))
+        self._deposit_phasor = np.zeros((n_depths, len(self._frequencies)), dtype=complex)
+
+    @classmethod
+    def from_stack(cls, stack: LayerStack, depth_bin_size: float = 0.01, **kwargs) -> "TimeResolvedTally":
+        """Tally whose depth bins cover the whole depth of a layer stack. Other arguments are passed to the tally."""
+        return cls(z_surface=stack.z_top, max_depth=stack.z_bottom - stack.z_top, depth_bin_size=depth_bin_size,
+                   **kwargs)
+
+    @property
+    def times(self) -> np.ndarray:
+        """Edges of the time bins (ns)."""
+        return np.arange(self._n_times + 1) * self._time_bin_size
+
+    @property
+    def frequencies(self) -> np.ndarray:
+        """Modulation frequencies (MHz)."""
+        return self._frequencies
+
+    @property
+    def detector_radii(self) -> np.ndarray:
+        """Edges of the detector regions (cm), starting at 0."""
+        return self._radii
+
+    @property
+    def depths(self) -> np.ndarray:
+        """Edges of the depth bins below the surface (cm), or None if the deposited energy is not tallied."""
+        if self._n_depths is None:
+            return None
+        return np.arange(self._n_depths + 1) * self._depth_bin_size
+
+    @property
+    def photon_count(self) -> int:
+        return self.info.get("photonCount") or 0
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the histograms and phasors."""
+        return sum(getattr(self, name).nbytes for name in _TALLIES)
+
+    def logExitArray(self, array: np.ndarray):
+        """Adds exiting photons as rows of (weight, x, y, z, photonID, ux, uy, uz, path length, optical path length)."""
+        if len(array) == 0:
+            return
+        time = self._time_of_flight(array, column=9)
+        radius = np.hypot(array[:, 1] - self._center[0], array[:, 2] - self._center[1])
+        region = np.searchsorted(self._radii, radius, side="right") - 1
+        detected = region < len(self._radii) - 1
+        weight = array[detected, 0]
+        self._accumulate(self._reflectance, self._reflectance_phasor, region[detected], time[detected], weight)
+        self._reflectance_squared += self._histogram(self._reflectance_squared, region[detected], time[detected],
+                                                     weight ** 2)
+        self._reflectance_time += np.bincount(region[detected], weights=weight * time[detected],
+                                              minlength=len(self._reflectance_time))
+
+    def logDataPointArray(self, array: np.ndarray, key: InteractionKey):
+        """Adds the energy deposited by rows of (value, x, y, z, photonID, optical path length) to the depth bins."""
+        if self._n_depths is None or not key.volumetric or len(array) == 0:
+            return
+        time = self._time_of_flight(array, column=5)
+        depth_bin = np.minimum(np.floor((array[:, 3] - self._z_surface) / self._depth_bin_size),
+                               self._n_depths).astype(np.int64)
+        inside = depth_bin >= 0
+        self._accumulate(self._deposit, self._deposit_phasor, depth_bin[inside], time[inside], array[inside, 0])
+
+    def merge(self, other: "TimeResolvedTally") -> "TimeResolvedTally":
+        """Adds the tallies of an independent `TimeResolvedTally` with the same bins."""
+        if other._reflectance.shape != self._reflectance.shape or other._deposit.shape != self._deposit.shape or \
+                other._time_bin_size != self._time_bin_size or other._depth_bin_size != self._depth_bin_size or \
+                other._z_surface != self._z_surface or not np.array_equal(other._frequencies, self._frequencies) or \
+                not np.array_equal(other._radii, self._radii):
+            raise ValueError("Can only merge time-resolved tallies with the same bins.")
+        for name in _TALLIES:
+            getattr(self, name)[...] += getattr(other, name)
+        self.info["photonCount"] = self.photon_count + other.photon_count
+        return self
+
+    def total_reflectance(self, region: int = None) -> float:
+        """Fraction of the launched photon weight leaving through a detector region, or through all of them."""
+        histogram = self._reflectance if region is None else self._reflectance[region]
+        return float(histogram.sum() / self._normalization())
+
+    def temporal_reflectance(self, region: int = 0) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Temporal point spread function R(t) (1/ns) of a detector region, normalized by the launched photons.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: Time bin centers (ns), reflectance and its standard error.
+        """
+        n = self._normalization()
+        weight = self._reflectance[region, :-1]
+        # Variance of the mean contribution per launched photon, assuming one exit per photon and bin.
+        variance = np.maximum(self._reflectance_squared[region, :-1] / n - (weight / n) ** 2, 0) / max(n - 1, 1)
+        return self._time_centers(), weight / n / self._time_bin_size, np.sqrt(variance) / self._time_bin_size
+
+    def temporal_deposit(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Energy deposited per unit depth and time (1/(cm ns)) in each depth bin, normalized by the launched photons.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: Time bin centers (ns), depth bin centers (cm) and the
+                (depth, time) deposit.
+        """
+        depths = self._require_depths()
+        deposit = self._deposit[:-1, :-1] / self._normalization() / self._depth_bin_size / self._time_bin_size
+        return self._time_centers(), (depths[:-1] + depths[1:]) / 2, deposit
+
+    def mean_time(self, region: int = None) -> float:
+        """Exact mean time of flight (ns) of the photons detected by a region, or by all of them."""
+        weight = self._reflectance.sum(axis=1)
+        if region is not None:
+            return float(self._reflectance_time[region] / weight[region]) if weight[region] > 0 else np.nan
+        return float(self._reflectance_time.sum() / weight.sum()) if weight.sum() > 0 else np.nan
+
+    def frequency_reflectance(self, region: int = 0) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Modulated reflectance of a detector region at each modulation frequency, normalized by the launched photons.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: Frequencies (MHz), AC amplitude and phase delay (radians).
+        """
+        phasor = self._reflectance_phasor[region] / self._normalization()
+        return self._frequencies, np.abs(phasor), -np.angle(phasor)
+
+    def frequency_deposit(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Modulated energy deposited per unit depth (1/cm) in each depth bin, normalized by the launched photons.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: Frequencies (MHz), depth bin centers (cm), and the
+                (depth, frequency) AC amplitude and phase delay (radians).
+        """
+        depths = self._require_depths()
+        phasor = self._deposit_phasor[:-1] / self._normalization() / self._depth_bin_size
+        return self._frequencies, (depths[:-1] + depths[1:]) / 2, np.abs(phasor), -np.angle(phasor)
+
+    def plot(self, title: str = None, filepath: str = None):
+        """
+        Plots the temporal reflectance of each detector region, the phase delay of each region at each frequency and
+        the time-resolved deposit (if tallied). Saved to `filepath` if given.
+        """
+        n_plots = 1 + (len(self._frequencies) > 0) + (self._n_depths is not None)
+        figure, axes = plt.subplots(1, n_plots, figsize=(6 * n_plots, 5), squeeze=False)
+        axes = list(axes[0])
+        ax = axes.pop(0)
+        for region in range(len(self._radii) - 1):
+            times, reflectance, error = self.temporal_reflectance(region)
+            ax.errorbar(times, reflectance, yerr=error, fmt=".-", markersize=3, label=self._region_label(region))
+        ax.set_yscale("log")
+        ax.set_xlabel("Time of flight (ns)")
+        ax.set_ylabel("R(t) (1/ns)")
+        ax.legend()
+        ax.grid(True)
+        if len(self._frequencies):
+            ax = axes.pop(0)
+            for region in range(len(self._radii) - 1):
+                frequencies, _, phase = self.frequency_reflectance(region)
+                ax.plot(frequencies, np.degrees(phase), ".-", label=self._region_label(region))
+            ax.set_xlabel("Modulation frequency (MHz)")
+            ax.set_ylabel("Phase delay (°)")
+            ax.legend()
+            ax.grid(True)
+        if self._n_depths is not None:
+            ax = axes.pop(0)
+            times, depths, deposit = self.temporal_deposit()
+            image = ax.imshow(np.log10(np.where(deposit > 0, deposit, np.nan)), aspect="auto", origin="upper",
+                              extent=(0, self.times[-1], self.depths[-1], 0))
+            figure.colorbar(image, ax=ax, label="log10 deposit (1/(cm ns))")
+            ax.set_xlabel("Time of flight (ns)")
+            ax.set_ylabel("Depth (cm)")
+        figure.suptitle(title or f"Time-resolved reflectance {self.total_reflectance():.4f}")
+        if filepath:
+            plt.savefig(filepath)
+            plt.close(figure)
+        else:
+            plt.show()
+
+    def _accumulate(self, histogram: np.ndarray, phasor: np.ndarray, index: np.ndarray, time: np.ndarray,
+                    weight: np.ndarray):
+        histogram += self._histogram(histogram, index, time, weight)
+        if len(self._frequencies) == 0:
+            return
+        # Modulation at f MHz delays a photon arriving at t ns by 2 pi f t 1e-3 radians.
+        modulation = (weight[:, None] * np.exp(-2j * np.pi * 1e-3 * time[:, None] * self._frequencies)).ravel()
+        flat = (index[:, None] * len(self._frequencies) + np.arange(len(self._frequencies))).ravel()
+        phasor += (np.bincount(flat, weights=modulation.real, minlength=phasor.size) +
+                   1j * np.bincount(flat, weights=modulation.imag, minlength=phasor.size)).reshape(phasor.shape)
+
+    def _histogram(self, histogram: np.ndarray, index: np.ndarray, time: np.ndarray, weight: np.ndarray):
+        time_bin = np.minimum(np.floor(time / self._time_bin_size), self._n_times).astype(np.int64)
+        flat = np.ravel_multi_index((index, time_bin), histogram.shape)
+        return np.bincount(flat, weights=weight, minlength=histogram.size).reshape(histogram.shape)
+
+    @staticmethod
+    def _time_of_flight(array: np.ndarray, column: int) -> np.ndarray:
+        if array.shape[1] <= column or np.isnan(array[:, column]).any():
+            raise ValueError("The time of flight requires the optical path lengths of the photons. Propagate with a "
+                             "`SlabPropagator`, which tracks them for loggers requiring path lengths.")
+        return array[:, column] / SPEED_OF_LIGHT
+
+    def _time_centers(self) -> np.ndarray:
+        times = self.times
+        return (times[:-1] + times[1:]) / 2
+
+    def _region_label(self, region: int) -> str:
+        return f"{self._radii[region]:g}-{self._radii[region + 1]:g} cm"
+
+    def _require_depths(self) -> np.ndarray:
+        if self._n_depths is None:
+            raise ValueError("The deposited energy is not tallied. Set `max_depth` to tally it.")
+        return self.depths
+
+    def _normalization(self) -> int:
+        if not self.photon_count:
+            raise ValueError("The number of launched photons is unknown. Propagate photons to the tally first.")
+        return self.photon_count
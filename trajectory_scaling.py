@@ -0,0 +1,418 @@
+"""
+Scattering-coefficient scaling of recorded photon trajectories.
+
+The wavelength sweeps of task3, task4 and task7 change `mu_s` (and `mu_a`) while the geometry stays the same. A
+trajectory in a layered medium is fully described by its entry point and, for each scattering event, the length of
+the step in units of scattering mean free paths and the two random numbers of the Henyey-Greenstein deflection.
+`record_trajectories` runs one absorption-free reference propagation and stores these values in a compact float32
+struct-of-arrays file. `replay_trajectories` then re-traces the same trajectories for any other set of materials:
+
+    - Steps are scaled with the layered-media scaling relation: in the optical depth coordinate T(z) = ∫ mu_s dz, a
+      step of s mean free paths with direction cosine uz always moves T by uz * s, whatever the layers it crosses, so
+      the new end point is z = T⁻¹(T + uz * s) and the lateral displacement follows the straight line.
+    - Deflections are recomputed with the `g` of the layer where each event now happens.
+    - Absorption is applied as a continuous weight exp(-∫ mu_a ds) along each step, split exactly between the layers.
+    - Fresnel reflection at the top and bottom surfaces splits the weight between the escaping and the reflected
+      photon, whose remaining trajectory is mirrored.
+Every replay is deterministic and only needs vectorized arithmetic. Internal interfaces must be index-matched, as in
+all the task models, and the layers are considered laterally infinite.
+
+Trajectories end when their weight drops below the recording threshold. The same trajectory scaled to other
+coefficients reaches the surfaces after a different number of events, so it may run out of recorded events while its
+weight is still significant, more often when the optical thickness of the layers changes a lot. Such trajectories
+are continued with new (seeded) random events, which keeps the replay unbiased; with `extend=False` their remaining
+weight is reported as `truncated` instead.
+
+Usage:
+    record = record_trajectories(source, stack=stack)  # e.g. with the Blue (largest mu_s) materials
+    record.save("trajectories.npz")
+    for wavelength, properties in materials.items():
+        print(wavelength, replay_trajectories(record, stack, properties))
+"""
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import numpy as np
+from pytissueoptics import InteractionKey, ScatteringMaterial
+
+from slab_propagation import LayerStack, deflect, fresnel_reflectance
+from spectral_propagation import layer_materials
+
+DEFAULT_RECORD_THRESHOLD = 1e-3
+DEFAULT_REPLAY_THRESHOLD = 1e-4
+
+# Photons whose direction is this close to the layer planes are moved within their current layer.
+HORIZONTAL_TOLERANCE = 1e-9
+
+
+class TrajectoryRecord:
+    """
+    Recorded trajectories as a struct of arrays. The events of photon i are `offsets[i]:offsets[i + 1]`.
+
+    Args:
+        entry_position (np.ndarray): (N, 2) float32 (x, y) positions where the photons reach the top surface.
+        entry_direction (np.ndarray): (N, 3) float32 directions of incidence, before refraction.
+        offsets (np.ndarray): (N + 1,) int64 start of the events of each photon.
+        step (np.ndarray): float32 step lengths in scattering mean free paths.
+        deflection (np.ndarray): float32 uniform random numbers of the Henyey-Greenstein deflection angles.
+        azimuth (np.ndarray): float32 azimuthal deflection angles (radians).
+    """
+
+    def __init__(self, entry_position: np.ndarray, entry_direction: np.ndarray, offsets: np.ndarray,
+                 step: np.ndarray, deflection: np.ndarray, azimuth: np.ndarray):
+        self.entry_position = entry_position
+        self.entry_direction = entry_direction
+        self.offsets = offsets
+        self.step = step
+        self.deflection = deflection
+        self.azimuth = azimuth
+
+    @property
+    def photon_count(self) -> int:
+        return len(self.entry_position)
+
+    @property
+    def event_count(self) -> int:
+        return len(self.step)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in vars(self).values())
+
+    def save(self, filepath: str):
+        np.savez(filepath, **vars(self))
+
+    @classmethod
+    def load(cls, filepath: str) -> "TrajectoryRecord":
+        with np.load(filepath) as data:
+            return cls(**{name: data[name] for name in data.files})
+
+    def events(self, photons: np.ndarray, index: int):
+        """Step, deflection and azimuth of the `index`-th event of the given photons, and the photons having it."""
+        has_event = self.offsets[photons] + index < self.offsets[photons + 1]
+        event = self.offsets[photons[has_event]] + index
+        return has_event, self.step[event], self.deflection[event], self.azimuth[event]
+
+
+@dataclass
+class ReplayResult:
+    """Fate of the launched energy, as fractions of the number of photons."""
+    photon_count: int
+    specular_reflectance: float
+    diffuse_reflectance: float
+    transmittance: float
+    absorbance: Dict[str, float] = field(default_factory=dict)
+    truncated: float = 0
+    duration: float = 0
+
+    def __str__(self):
+        absorbance = ", ".join(f"{label} {value:.4f}" for label, value in self.absorbance.items())
+        return (f"{self.photon_count} photons ({self.duration:.2f}s): specular {self.specular_reflectance:.4f}, "
+                f"diffuse reflectance {self.diffuse_reflectance:.4f}, transmittance {self.transmittance:.4f}, "
+                f"absorbance [{absorbance}], truncated {self.truncated:.2e}")
+
+
+def record_trajectories(source, scene=None, stack: LayerStack = None, materials: Dict[str, object] = None,
+                        weight_threshold: float = DEFAULT_RECORD_THRESHOLD, max_events: int = 100000,
+                        batch_size: int = 20000, rng: np.random.Generator = None,
+                        show_progress: bool = True) -> TrajectoryRecord:
+    """
+    Runs the absorption-free reference propagation of the source and returns its trajectories.
+
+    Args:
+        source (Source): The photon source, above the stack.
+        scene (ScatteringScene): Used to detect the layer stack when `stack` is not given.
+        stack (LayerStack): Explicit layer stack.
+        materials (Dict[str, object]): Optional reference materials by layer label (`ScatteringMaterial` or dict of
+            properties), as for `propagate_spectral`. Their absorption is ignored.
+        weight_threshold (float): Trajectories end once their weight, lowered by the escapes, is below this value.
+        max_events (int): Maximum number of events per photon.
+        batch_size (int): Number of photons traced together.
+        rng (np.random.Generator): Random generator. Defaults to one seeded with the source seed, if any.
+        show_progress (bool): Print the number of recorded events and the duration.
+    """
+    if stack is None:
+        stack = LayerStack.from_scene(scene)
+    if rng is None:
+        rng = np.random.default_rng(getattr(source, "_seed", None))
+    tracer = _TrajectoryTracer(stack, layer_materials(stack, materials or {}), absorbing=False)
+    positions, directions = source.getInitialPositionsAndDirections()
+    entry_position, entry_direction = tracer.entry_points(positions, directions)
+
+    t0 = time.time()
+    chunks = []
+    for start in range(0, len(entry_position), batch_size):
+        stop = min(start + batch_size, len(entry_position))
+        generator = _EventGenerator(stop - start, rng, max_events)
+        tracer.trace(entry_position[start:stop], entry_direction[start:stop], generator, _EnergyTally(stack),
+                     weight_threshold)
+        chunks.append(generator.result())
+    lengths, step, deflection, azimuth = (np.concatenate(values) for values in zip(*chunks))
+    record = TrajectoryRecord(entry_position.astype(np.float32), entry_direction.astype(np.float32),
+                              np.concatenate(([0], np.cumsum(lengths))).astype(np.int64), step, deflection, azimuth)
+    if show_progress:
+        print(f"Recorded {record.event_count} events of {record.photon_count} photons "
+              f"({record.nbytes / 1024 ** 2:.1f} MiB) in {time.time() - t0:.2f}s")
+    return record
+
+
+def replay_trajectories(record: TrajectoryRecord, stack: LayerStack, materials: Dict[str, object] = None,
+                        logger=None, weight_threshold: float = DEFAULT_REPLAY_THRESHOLD, batch_size: int = 20000,
+                        first_id: int = 0, extend: bool = True, seed: int = 0) -> ReplayResult:
+    """
+    Re-traces the recorded trajectories in the stack with other materials.
+
+    Args:
+        record (TrajectoryRecord): The reference trajectories.
+        stack (LayerStack): The layer stack of the reference run.
+        materials (Dict[str, object]): Materials by layer label (`ScatteringMaterial` or dict of properties). Layers
+            not listed keep the materials of the stack.
+        logger (EnergyLogger): Optional logger receiving the deposited energy and the energy leaving through the top
+            and bottom surfaces. Crossings of the internal interfaces are not logged.
+        weight_threshold (float): Trajectories are stopped below this weight, which is counted as truncated.
+        batch_size (int): Number of photons traced together.
+        first_id (int): Photon ID of the first photon, for the logged data points.
+        extend (bool): Continue the trajectories running out of recorded events with new random events. Otherwise,
+            their remaining weight is counted as truncated and the replay is fully deterministic.
+        seed (int): Seed of the random events extending the trajectories, for reproducible replays.
+    """
+    rng = np.random.default_rng(seed) if extend else None
+    tracer = _TrajectoryTracer(stack, layer_materials(stack, materials or {}))
+    tally = _EnergyTally(stack, logger)
+    t0 = time.time()
+    for start in range(0, record.photon_count, batch_size):
+        stop = min(start + batch_size, record.photon_count)
+        events = _RecordedEvents(record, start, rng)
+        tracer.trace(record.entry_position[start:stop].astype(np.float64),
+                     record.entry_direction[start:stop].astype(np.float64), events, tally, weight_threshold,
+                     first_id=first_id + start)
+        tally.flush()
+
+    if logger is not None:
+        logger.info["photonCount"] = logger.info.get("photonCount", 0) + record.photon_count
+        logger.info["sourceSolidLabel"] = None
+    n = record.photon_count
+    return ReplayResult(n, tally.specular / n, tally.reflectance / n, tally.transmittance / n,
+                        {label: value / n for label, value in zip(stack.labels, tally.absorbed)}, tally.truncated / n,
+                        time.time() - t0)
+
+
+class _EventGenerator:
+    """Draws new events and keeps them, for the reference run."""
+
+    def __init__(self, n_photons: int, rng: np.random.Generator, max_events: int):
+        self._rng = rng
+        self._max_events = max_events
+        self._photons: List[np.ndarray] = []
+        self._events: List[np.ndarray] = []
+        self._n_photons = n_photons
+
+    def __call__(self, photons: np.ndarray, index: int):
+        has_event = np.full(len(photons), index < self._max_events)
+        n = np.count_nonzero(has_event)
+        step = -np.log(1 - self._rng.random(n))
+        deflection, azimuth = self._rng.random(n), 2 * np.pi * self._rng.random(n)
+        self._photons.append(photons[has_event])
+        self._events.append(np.column_stack((step, deflection, azimuth)).astype(np.float32))
+        return has_event, step, deflection, azimuth
+
+    def result(self):
+        photons, events = np.concatenate(self._photons), np.vstack(self._events)
+        # Events were drawn one index at a time; a stable sort groups them by photon in chronological order.
+        order = np.argsort(photons, kind="stable")
+        events = events[order]
+        lengths = np.bincount(photons, minlength=self._n_photons)
+        return lengths, events[:, 0].copy(), events[:, 1].copy(), events[:, 2].copy()
+
+
+class _RecordedEvents:
+    """Serves the recorded events of a batch of photons, then new random events if a generator is given."""
+
+    def __init__(self, record: TrajectoryRecord, first_photon: int, rng: Optional[np.random.Generator] = None):
+        self._record = record
+        self._first_photon = first_photon
+        self._rng = rng
+
+    def __call__(self, photons: np.ndarray, index: int):
+        has_event, *recorded = self._record.events(photons + self._first_photon, index)
+        if self._rng is None:
+            return (has_event, *(values.astype(np.float64) for values in recorded))
+        events = np.empty((3, len(photons)))
+        events[:, has_event] = recorded
+        n = np.count_nonzero(~has_event)
+        events[:, ~has_event] = (-np.log(1 - self._rng.random(n)), self._rng.random(n),
+                                 2 * np.pi * self._rng.random(n))
+        return np.ones(len(photons), dtype=bool), *events
+
+
+class _EnergyTally:
+    """Totals of the energy fates, and data points forwarded to an optional logger."""
+
+    def __init__(self, stack: LayerStack, logger=None):
+        self._stack = stack
+        self._logger = logger
+        self._rows: Dict[InteractionKey, List[np.ndarray]] = {}
+        self.specular = 0.0
+        self.reflectance = 0.0
+        self.transmittance = 0.0
+        self.absorbed = np.zeros(len(stack.layers))
+        self.truncated = 0.0
+
+    def deposit(self, layer: int, value: np.ndarray, position: np.ndarray, ids: np.ndarray):
+        self.absorbed[layer] += value.sum()
+        self._log(InteractionKey(self._stack.layers[layer].label), value, position, ids)
+
+    def exit(self, top: bool, value: np.ndarray, position: np.ndarray, ids: np.ndarray):
+        layer = self._stack.layers[0] if top else self._stack.layers[-1]
+        if top:
+            self.reflectance += value.sum()
+        else:
+            self.transmittance += value.sum()
+        self._log(InteractionKey(layer.label, layer.front_label if top else layer.back_label), value, position, ids)
+
+    def flush(self):
+        for key, rows in self._rows.items():
+            self._logger.logDataPointArray(np.vstack(rows), key)
+        self._rows = {}
+
+    def _log(self, key: InteractionKey, value, position, ids):
+        if self._logger is None or len(value) == 0:
+            return
+        self._rows.setdefault(key, []).append(np.column_stack((value, position, ids)))
+
+
+class _TrajectoryTracer:
+    """Vectorized tracing of trajectories given their events, with continuous absorption."""
+
+    def __init__(self, stack: LayerStack, materials: List[ScatteringMaterial], absorbing: bool = True):
+        self._stack = stack
+        self._mu_s = np.array([material.mu_s for material in materials], dtype=float)
+        self._mu_a = np.array([material.mu_a if absorbing else 0 for material in materials], dtype=float)
+        self._g = np.array([material.g for material in materials], dtype=float)
+        n = np.array([material.n for material in materials], dtype=float)
+        if np.any(self._mu_s <= 0):
+            raise ValueError("Trajectory scaling requires a scattering coefficient mu_s > 0 in every layer.")
+        if np.any(n != n[0]):
+            raise ValueError("Trajectory scaling requires index-matched layers (the same n in every layer).")
+        self._n = n[0]
+        self._n_world = stack.world_material.n
+
+        self._z = np.array([layer.z_min for layer in stack.layers] + [stack.z_bottom])
+        thickness = np.diff(self._z)
+        self._T = np.concatenate(([0], np.cumsum(self._mu_s * thickness)))
+        self._A = np.concatenate(([0], np.cumsum(self._mu_a * thickness)))
+
+    def entry_points(self, positions: np.ndarray, directions: np.ndarray):
+        """(x, y) where the photons reach the top surface, and their directions."""
+        positions, directions = np.asarray(positions, dtype=float), np.asarray(directions, dtype=float)
+        uz = directions[:, 2]
+        if np.any(positions[:, 2] > self._stack.z_top) or np.any(uz <= 0):
+            raise ValueError("The source must be above the stack and point towards it.")
+        distance = (self._stack.z_top - positions[:, 2]) / uz
+        return positions[:, :2] + directions[:, :2] * distance[:, None], directions
+
+    def trace(self, entry_position: np.ndarray, entry_direction: np.ndarray, events, tally: _EnergyTally,
+              weight_threshold: float, first_id: int = 0):
+        n_photons = len(entry_position)
+        R, cos_out = fresnel_reflectance(entry_direction[:, 2], self._n_world, self._n)
+        tally.specular += R.sum()
+        direction = entry_direction * (self._n_world / self._n)
+        direction[:, 2] = cos_out
+        position = np.column_stack((entry_position, np.full(n_photons, self._stack.z_top)))
+        weight = 1 - R
+        ids = np.arange(first_id, first_id + n_photons)
+
+        photons = np.arange(n_photons)
+        index = 0
+        while len(photons) > 0:
+            has_event, step, deflection, azimuth = events(photons, index)
+            tally.truncated += weight[~has_event].sum()
+            photons, position, direction, weight, ids = (values[has_event] for values in
+                                                         (photons, position, direction, weight, ids))
+            self._move(position, direction, weight, ids, step, tally)
+            layer = self._layer_at(position[:, 2])
+            direction = deflect(direction, self._g[layer], deflection, azimuth)
+
+            alive = weight >= weight_threshold
+            tally.truncated += weight[~alive].sum()
+            photons, position, direction, weight, ids = (values[alive] for values in
+                                                         (photons, position, direction, weight, ids))
+            index += 1
+        tally.truncated += weight.sum()
+
+    def _move(self, position, direction, weight, ids, step, tally: _EnergyTally):
+        """Moves the photons by `step` mean free paths (in place), reflecting them on the top and bottom surfaces."""
+        remaining = step.copy()
+        todo = np.arange(len(step))
+        while len(todo) > 0:
+            z0, u = position[todo, 2], direction[todo]
+            uz = u[:, 2]
+            horizontal = np.abs(uz) < HORIZONTAL_TOLERANCE
+            T0 = np.interp(z0, self._z, self._T)
+            T1 = T0 + uz * remaining[todo]
+            top = ~horizontal & (T1 < 0)
+            bottom = ~horizontal & (T1 > self._T[-1])
+            z1 = np.interp(np.clip(T1, 0, self._T[-1]), self._T, self._z)
+            z1[horizontal] = z0[horizontal]
+
+            self._absorb(todo[~horizontal], z0[~horizontal], z1[~horizontal], position, direction, weight, ids,
+                         tally)
+            self._absorb_horizontal(todo[horizontal], remaining[todo[horizontal]], position, direction, weight,
+                                    ids, tally)
+
+            surface = top | bottom
+            with np.errstate(divide="ignore", invalid="ignore"):
+                used = np.where(surface, (np.where(top, 0, self._T[-1]) - T0) / uz, 0)
+            remaining[todo] -= used
+            for mask, is_top in ((top, True), (bottom, False)):
+                crossing = todo[mask]
+                if len(crossing) == 0:
+                    continue
+                R, _ = fresnel_reflectance(np.abs(direction[crossing, 2]), self._n, self._n_world)
+                tally.exit(is_top, weight[crossing] * (1 - R), position[crossing], ids[crossing])
+                weight[crossing] *= R
+                direction[crossing, 2] *= -1
+            todo = todo[surface]
+
+    def _absorb(self, photons, z0, z1, position, direction, weight, ids, tally: _EnergyTally):
+        """Straight segments from z0 to z1, with the absorption of each layer deposited at its middle."""
+        if len(photons) == 0:
+            return
+        u = direction[photons]
+        uz = np.abs(u[:, 2])
+        w0, xy0 = weight[photons], position[photons, :2]
+        low, high = np.minimum(z0, z1), np.maximum(z0, z1)
+        A0 = np.interp(z0, self._z, self._A)
+        for layer in np.nonzero(self._mu_a > 0)[0]:
+            a, b = np.clip(self._z[layer], low, high), np.clip(self._z[layer + 1], low, high)
+            inside = b > a
+            if not np.any(inside):
+                continue
+            near = np.where(u[:, 2] > 0, a, b)[inside]
+            before = np.abs(np.interp(near, self._z, self._A) - A0[inside]) / uz[inside]
+            absorbed = w0[inside] * np.exp(-before) * -np.expm1(-self._mu_a[layer] * (b - a)[inside] / uz[inside])
+            middle = (a + b)[inside] / 2
+            xy = xy0[inside] + u[inside, :2] / u[inside, 2:3] * (middle - z0[inside])[:, None]
+            tally.deposit(layer, absorbed, np.column_stack((xy, middle)), ids[photons[inside]])
+
+        weight[photons] = w0 * np.exp(-np.abs(np.interp(z1, self._z, self._A) - A0) / uz)
+        position[photons, :2] = xy0 + u[:, :2] / u[:, 2:3] * (z1 - z0)[:, None]
+        position[photons, 2] = z1
+
+    def _absorb_horizontal(self, photons, step, position, direction, weight, ids, tally: _EnergyTally):
+        """Steps parallel to the layers, which stay in their current layer."""
+        if len(photons) == 0:
+            return
+        layer = self._layer_at(position[photons, 2])
+        length = step / self._mu_s[layer]
+        absorbed = weight[photons] * -np.expm1(-self._mu_a[layer] * length)
+        middle = position[photons] + direction[photons] * (length / 2)[:, None]
+        for index in np.unique(layer):
+            selected = layer == index
+            tally.deposit(index, absorbed[selected], middle[selected], ids[photons[selected]])
+        weight[photons] -= absorbed
+        position[photons] += direction[photons] * length[:, None]
+
+    def _layer_at(self, z: np.ndarray) -> np.ndarray:
+        return np.clip(np.searchsorted(self._z, z, side="right") - 1, 0, len(self._mu_s) - 1)